@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Forwarder load and throughput benchmarks.
+
+Forwarder and test backends run in separate processes, load is generated
+by this process. Results are printed as JSON, so runs of different
+releases and relay engines can be compared. Run from repository root:
+
+    python benchmarks/bench.py --engines=tornado,splice --output=results.json
+
+Scenarios:
+    bulk   - bulk transfer to a sink backend, MiB/s
+    rr     - small request/response exchanges with an echo backend, requests/s and latency
+    storm  - short connections opened as fast as possible, connections/s and latency
+    idle   - many idle connections, forwarder memory per connection
+    startup - parsing and binding of a config with a lot of listeners written
+              as one port range and as separate lines, seconds
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+
+from forwarder import ForwardServer
+
+SCENARIOS = ('bulk', 'rr', 'storm', 'idle', 'startup')
+CHUNK = 256 * 1024
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def get_unused_port():
+    sock, port = bind_unused_port()
+    sock.close()
+    return port
+
+
+class EchoServer(TCPServer):
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        try:
+            while True:
+                data = yield stream.read_bytes(CHUNK, partial=True)
+                yield stream.write(data)
+        except StreamClosedError:
+            pass
+
+
+class SinkServer(TCPServer):
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        try:
+            while True:
+                yield stream.read_bytes(CHUNK, partial=True)
+        except StreamClosedError:
+            pass
+
+
+def new_io_loop():
+    """
+    Forked process must not share poller of the parent loop.
+    """
+    io_loop = IOLoop()
+    io_loop.make_current()
+    return io_loop
+
+
+def run_backends(echo_sock, sink_sock, ready):
+    raise_fd_limit()
+    io_loop = new_io_loop()
+    EchoServer().add_socket(echo_sock)
+    SinkServer().add_socket(sink_sock)
+    ready.set()
+    io_loop.start()
+
+
+def run_forwarder(engine, conf, ready):
+    raise_fd_limit()
+    io_loop = new_io_loop()
+    server = ForwardServer(engine=engine)
+    server.bind_conf(conf)
+    ready.set()
+    io_loop.start()
+
+
+def start_process(target, *args):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=target, args=args + (ready,))
+    process.daemon = True
+    process.start()
+    ready.wait()
+    return process
+
+
+def get_rss(pid):
+    """
+    Returns resident memory of process in bytes.
+    """
+    with open('/proc/{0}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return dict(('p{0:g}'.format(p), values[min(len(values) - 1, int(len(values) * p / 100.0))])
+                for p in points)
+
+
+def measure_startup(args, results):
+    raise_fd_limit()
+    new_io_loop()
+    server = ForwardServer()
+    first = args.startup_port
+    last = first + args.startup_listeners - 1
+    configs = (
+        ('range', '{0}:{1}-{2} => 127.0.0.1:{1}-{2}'.format(args.startup_address, first, last)),
+        ('lines', '\n'.join('{0}:{1} => 127.0.0.1:{1}'.format(args.startup_address, port)
+                            for port in range(first, last + 1))),
+    )
+    for name, data in configs:
+        rss_before = get_rss(os.getpid())
+        started = time.time()
+        conf = server.parse_config(data=data)
+        parsed = time.time()
+        server.bind_conf(conf)
+        bound = time.time()
+        rss_after = get_rss(os.getpid())
+        server.bind_conf({})
+        results.put({
+            'config': name,
+            'listeners': args.startup_listeners,
+            'parse_duration': parsed - started,
+            'bind_duration': bound - parsed,
+            'unbind_duration': time.time() - bound,
+            'bytes_per_listener': (rss_after - rss_before) / float(args.startup_listeners),
+        })
+    results.put(None)
+
+
+def startup(args):
+    """
+    Runs `measure_startup` in a separate process, so memory and
+    descriptors of other scenarios don't affect it.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_startup, args=(args, results))
+    process.start()
+    runs = list(iter(results.get, None))
+    process.join()
+    return {'runs': runs}
+
+
+class Benchmark(object):
+    def __init__(self, engine, args):
+        self.engine = engine
+        self.args = args
+        self.client = TCPClient()
+
+    def setup(self):
+        echo_sock, echo_port = bind_unused_port()
+        sink_sock, sink_port = bind_unused_port()
+        self.backends = start_process(run_backends, echo_sock, sink_sock)
+        echo_sock.close()
+        sink_sock.close()
+        self.echo_port = get_unused_port()
+        self.sink_port = get_unused_port()
+        conf = {
+            ('127.0.0.1', self.echo_port): ('127.0.0.1', echo_port),
+            ('127.0.0.1', self.sink_port): ('127.0.0.1', sink_port),
+        }
+        self.forwarder = start_process(run_forwarder, self.engine, conf)
+
+    def teardown(self):
+        for process in (self.forwarder, self.backends):
+            process.terminate()
+            process.join()
+
+    @gen.coroutine
+    def bulk(self):
+        size = self.args.bulk_size * 1024 * 1024
+        payload = b'x' * CHUNK
+
+        @gen.coroutine
+        def transfer():
+            stream = yield self.client.connect('127.0.0.1', self.sink_port)
+            stream.set_nodelay(True)
+            for _ in range(size // CHUNK):
+                yield stream.write(payload)
+            stream.close()
+
+        started = time.time()
+        yield [transfer() for _ in range(self.args.bulk_connections)]
+        duration = time.time() - started
+        total = size * self.args.bulk_connections
+        raise gen.Return({
+            'connections': self.args.bulk_connections,
+            'bytes': total,
+            'duration': duration,
+            'mib_per_second': total / duration / 1024 / 1024,
+        })
+
+    @gen.coroutine
+    def rr(self):
+        latencies = []
+        payload = b'x' * self.args.rr_size
+
+        @gen.coroutine
+        def exchange():
+            stream = yield self.client.connect('127.0.0.1', self.echo_port)
+            stream.set_nodelay(True)
+            for _ in range(self.args.rr_requests):
+                started = time.time()
+                yield stream.write(payload)
+                yield stream.read_bytes(len(payload))
+                latencies.append(time.time() - started)
+            stream.close()
+
+        started = time.time()
+        yield [exchange() for _ in range(self.args.concurrency)]
+        duration = time.time() - started
+        result = {
+            'requests': len(latencies),
+            'size': self.args.rr_size,
+            'concurrency': self.args.concurrency,
+            'duration': duration,
+            'requests_per_second': len(latencies) / duration,
+        }
+        result.update(('latency_' + k, v) for k, v in percentiles(latencies).items())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def storm(self):
+        latencies = []
+        remaining = [self.args.storm_connections]
+
+        @gen.coroutine
+        def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                started = time.time()
+                stream = yield self.client.connect('127.0.0.1', self.echo_port)
+                yield stream.write(b'x')
+                yield stream.read_bytes(1)
+                latencies.append(time.time() - started)
+                stream.close()
+
+        started = time.time()
+        yield [worker() for _ in range(self.args.concurrency)]
+        duration = time.time() - started
+        result = {
+            'connections': len(latencies),
+            'concurrency': self.args.concurrency,
+            'duration': duration,
+            'connections_per_second': len(latencies) / duration,
+        }
+        result.update(('latency_' + k, v) for k, v in percentiles(latencies).items())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def idle(self):
+        rss_before = get_rss(self.forwarder.pid)
+        streams = []
+        for _ in range(self.args.idle_connections):
+            stream = yield self.client.connect('127.0.0.1', self.echo_port)
+            streams.append(stream)
+        # Make sure every connection is relayed to backend.
+        for stream in streams:
+            yield stream.write(b'x')
+            yield stream.read_bytes(1)
+        rss_after = get_rss(self.forwarder.pid)
+        for stream in streams:
+            stream.close()
+        raise gen.Return({
+            'connections': len(streams),
+            'rss_before': rss_before,
+            'rss_after': rss_after,
+            'bytes_per_connection': (rss_after - rss_before) / float(len(streams)),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', default='tornado', help='comma separated relay engines')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--bulk-size', type=int, default=256, help='MiB sent by each bulk connection')
+    parser.add_argument('--bulk-connections', type=int, default=1)
+    parser.add_argument('--rr-size', type=int, default=128, help='request size in bytes')
+    parser.add_argument('--rr-requests', type=int, default=200, help='requests per connection')
+    parser.add_argument('--storm-connections', type=int, default=5000)
+    parser.add_argument('--idle-connections', type=int, default=2000)
+    parser.add_argument('--startup-listeners', type=int, default=50000,
+                        help='listeners of startup scenario, needs as many open files allowed')
+    parser.add_argument('--startup-address', default='127.0.0.2')
+    parser.add_argument('--startup-port', type=int, default=10000, help='first port of startup scenario')
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    results = []
+    for engine in args.engines.split(','):
+        for scenario in args.scenarios.split(','):
+            if scenario not in SCENARIOS:
+                parser.error('Unknown scenario: {0}'.format(scenario))
+            if scenario == 'startup':
+                # Listeners are bound the same way by every engine
+                result = startup(args)
+            else:
+                benchmark = Benchmark(engine, args)
+                benchmark.setup()
+                try:
+                    result = IOLoop.current().run_sync(getattr(benchmark, scenario))
+                finally:
+                    benchmark.teardown()
+            result.update(engine=engine, scenario=scenario)
+            results.append(result)
+            sys.stderr.write('{0} {1}: {2}\n'.format(engine, scenario, json.dumps(result, sort_keys=True)))
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'tornado': tornado.version,
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
+import errno
+import functools
 import glob
 import logging
 import os
+import re
 import socket
 
-from tornado.ioloop import PeriodicCallback
-from tornado.iostream import IOStream
-from tornado.util import basestring_type
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, SSLIOStream, StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.platform.auto import set_close_exec
+from tornado.util import basestring_type, errno_from_exception
 try:
     # tornado>=3.0
     from tornado.tcpserver import TCPServer
@@ -14,19 +19,52 @@ except ImportError:
     # tornado<3.0
     from tornado.netutil import TCPServer
 
-from forwarder.utils import DictDiff
+from forwarder.aio import ASYNCIO_AVAILABLE, AsyncioConnection
+from forwarder.balancer import (BackendPool, BALANCE_METHODS, BALANCE_ROUNDROBIN,
+                                DEFAULT_CHECK_INTERVAL, DEFAULT_MAX_FAILS)
+from forwarder.metrics import Metrics
+from forwarder.ranges import PortRange, RangeIndex, find_overlap, iter_listeners, parse_port, resolve_port
+from forwarder.resolver import get_default_resolver
+from forwarder.splice import SPLICE_AVAILABLE, SpliceConnection
+from forwarder.timers import TimerWheel
+from forwarder.tls import DEFAULT_HANDSHAKE_TIMEOUT, TLS_AVAILABLE, Handshaker, TLSContexts
+from forwarder.udp import UDPForwarding, bind_udp_socket
+from forwarder.warm import DEFAULT_WARM_IDLE, WarmPool
+from forwarder.utils import (ConnectionRegistry, DictDiff, TokenBucket, bind_ipv4_socket, create_socket,
+                             get_forwarding_str, is_ipv4_address, set_socket_options)
+from forwarder.watcher import InotifyWatcher, file_stamp, inotify_available, watch_paths
 
 
-def get_forwarding_str(addr_from, port_from, addr_to, port_to):
-    """
-    Returns log string for connection forwarding.
-    """
-    return "{addr_from}:{port_from} => {addr_to}:{port_to}".format(
-        addr_from=addr_from,
-        port_from=port_from,
-        addr_to=addr_to,
-        port_to=port_to
-    )
+DEFAULT_READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_HIGH_WATER_MARK = 1024 * 1024
+DEFAULT_LOW_WATER_MARK = 256 * 1024
+
+ENGINE_TORNADO = 'tornado'
+ENGINE_SPLICE = 'splice'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = (ENGINE_TORNADO, ENGINE_SPLICE, ENGINE_ASYNCIO)
+
+PROTO_TCP = 'tcp'
+PROTO_UDP = 'udp'
+
+# Admission limits, which pause accepting on a listener.
+LIMIT_GLOBAL = 'global'
+LIMIT_MAX_CONNS = 'max_conns'
+LIMIT_RATE = 'rate'
+
+# Timeouts of connection states. Connection is closed if it stays
+# in a state for longer than a value of the option.
+CONNECT_TIMEOUT = 'connect_timeout'  # Backend connection is not established
+IDLE_TIMEOUT = 'idle_timeout'  # No data is relayed in both directions
+HALF_CLOSE_TIMEOUT = 'half_close_timeout'  # One peer closed connection, data to the other isn't flushed
+TIMEOUTS = (CONNECT_TIMEOUT, IDLE_TIMEOUT, HALF_CLOSE_TIMEOUT)
+
+ACCEPT_BATCH = 128  # Connections accepted at once, so other listeners are not starved
+
+WILDCARD_ADDRESS = '0.0.0.0'
+WILDCARD_ADDRESSES = ('', WILDCARD_ADDRESS, '::')  # Listeners on them take the port of every address
+
+_ERRNO_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
 
 
 class ParseError(SyntaxError):
@@ -36,46 +74,461 @@ class ParseError(SyntaxError):
         super(ParseError, self).__init__(messsage)
 
 
+def choice(*values):
+    def convert(value):
+        if value not in values:
+            raise ValueError('Expected one of: {0}'.format(', '.join(values)))
+        return value
+    return convert
+
+
+def boolean(value):
+    if value.lower() in ('1', 'yes', 'on', 'true'):
+        return True
+    if value.lower() in ('0', 'no', 'off', 'false'):
+        return False
+    raise ValueError('Expected boolean: {0}'.format(value))
+
+
+def size(value):
+    """
+    Converts size in bytes with optional `k` or `m` suffix to int.
+    """
+    multiplier = {'k': 1024, 'm': 1024 * 1024}.get(value[-1:].lower())
+    if multiplier:
+        return int(value[:-1]) * multiplier
+    return int(value)
+
+
+# Forwarding options, which may follow backends in a config line as
+# `name=value`. Each option name is mapped to value converter.
+FORWARDING_OPTIONS = {
+    'balance': choice(*BALANCE_METHODS),
+    'max_fails': int,
+    'check_interval': float,
+    'warm': int,
+    'warm_idle': float,
+    'nodelay': boolean,
+    'keepalive': boolean,
+    'rcvbuf': size,
+    'sndbuf': size,
+    'backlog': int,
+    'read_chunk_size': size,
+    'max_conns': int,
+    'rate': float,
+    CONNECT_TIMEOUT: float,
+    IDLE_TIMEOUT: float,
+    HALF_CLOSE_TIMEOUT: float,
+    'proto': choice(PROTO_TCP, PROTO_UDP),
+    'max_sessions': int,
+    'drain_timeout': float,
+    'tls_cert': str,
+    'tls_key': str,
+    'tls_ciphers': str,
+    'tls_upstream': boolean,
+    'tls_upstream_ca': str,
+    'tls_upstream_verify': boolean,
+    'bandwidth_up': size,
+    'bandwidth_down': size,
+    'conn_bandwidth_up': size,
+    'conn_bandwidth_down': size,
+}
+
+# Options which make no sense for UDP forwardings.
+TCP_ONLY_OPTIONS = ('warm', 'warm_idle', 'nodelay', 'keepalive', 'backlog', 'max_conns', 'rate',
+                    CONNECT_TIMEOUT, HALF_CLOSE_TIMEOUT, 'drain_timeout', 'tls_cert', 'tls_key', 'tls_ciphers',
+                    'tls_upstream', 'tls_upstream_ca', 'tls_upstream_verify', 'bandwidth_up', 'bandwidth_down',
+                    'conn_bandwidth_up', 'conn_bandwidth_down')
+TLS_OPTIONS = ('tls_cert', 'tls_key', 'tls_ciphers', 'tls_upstream', 'tls_upstream_ca', 'tls_upstream_verify')
+# Bytes per second limits of forwarding and of each its connection
+# for data sent to backends (up) and to clients (down).
+BANDWIDTH_OPTIONS = ('bandwidth_up', 'bandwidth_down', 'conn_bandwidth_up', 'conn_bandwidth_down')
+
+OPTION_RE = re.compile(r'(?:^|\s)([a-z_]+)=(?!>)(\S+)')
+
+
+class Forwarding(tuple):
+    """
+    Forwarding target. For backward compatibility it is a tuple (addr, port)
+    of the first backend. All backends are listed in ``backends`` and
+    forwarding options are in ``options`` dict.
+    """
+    def __new__(cls, backends, options=None):
+        backends = tuple(tuple(b) for b in backends)
+        self = super(Forwarding, cls).__new__(cls, backends[0])
+        self.backends = backends
+        self.options = options or {}
+        return self
+
+    def __eq__(self, other):
+        if not isinstance(other, tuple):
+            return NotImplemented
+        return (tuple(self) == tuple(other) and
+                self.backends == getattr(other, 'backends', (tuple(other),)) and
+                self.options == getattr(other, 'options', {}))
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return 'Forwarding({0!r}, {1!r})'.format(list(self.backends), self.options)
+
+
+def get_backends(forwarding):
+    """
+    Returns list of backends of config forwarding value.
+    """
+    return getattr(forwarding, 'backends', (tuple(forwarding),))
+
+
+def get_options(forwarding):
+    """
+    Returns options dict of config forwarding value.
+    """
+    return getattr(forwarding, 'options', {})
+
+
+def get_proto(forwarding):
+    """
+    Returns protocol of config forwarding value.
+    """
+    return get_options(forwarding).get('proto', PROTO_TCP)
+
+
+def expand_conf(conf, keys):
+    """
+    Returns dict mapping each listener (addr, port) of ``conf`` entries
+    with ``keys`` to its forwarding. Port ranges are expanded.
+    """
+    result = {}
+    for key in keys:
+        addr, port = key
+        if isinstance(port, PortRange):
+            for p in port:
+                result[addr, p] = expand_forwarding(conf[key], port, p)
+        else:
+            result[key] = conf[key]
+    return result
+
+
+def expand_forwarding(forwarding, listener, port):
+    """
+    Returns `Forwarding` of ``port`` of forwarding listening on ``listener`` port range.
+    """
+    backends = [(host, resolve_port(p, listener, port)) for host, p in get_backends(forwarding)]
+    return Forwarding(backends, get_options(forwarding))
+
+
+def format_forwarding(addr, port, forwarding):
+    """
+    Returns configuration line of forwarding, which `ForwardServer.parse_config` reads back.
+    """
+    options = get_options(forwarding)
+    values = []
+    for name in sorted(options):
+        value = options[name]
+        if isinstance(value, bool):
+            value = 'on' if value else 'off'
+        values.append('{0}={1}'.format(name, value))
+    return ' '.join([describe_forwarding(addr, port, forwarding)] + values)
+
+
+def describe_forwarding(addr, port, forwarding):
+    """
+    Returns log string for forwarding with all its backends.
+    """
+    return '{0}:{1} => {2}'.format(addr, port, ', '.join('{0}:{1}'.format(*b) for b in get_backends(forwarding)))
+
+
+class TimeoutsState(object):
+    """
+    Timeouts tracking state of a connection.
+    """
+    __slots__ = ('timer', 'opened', 'transferred', 'active', 'options')
+
+    def __init__(self, opened, options):
+        self.timer = None
+        self.opened = opened
+        self.options = options  # Options of forwarding, kept once it is removed
+        self.transferred = 0  # Bytes relayed by connection at last check
+        self.active = opened  # Time of last check, which noticed relayed data
+
+
 class ForwardServer(TCPServer):
     def __init__(self, *args, **kwargs):
+        # Every connection stops reading from one peer when more than
+        # `high_water_mark` bytes are waiting to be written to the other one.
+        self.high_water_mark = kwargs.pop('high_water_mark', DEFAULT_HIGH_WATER_MARK)
+        self.low_water_mark = kwargs.pop('low_water_mark', DEFAULT_LOW_WATER_MARK)
+        engine = kwargs.pop('engine', ENGINE_TORNADO)
+        # Bind listeners with SO_REUSEPORT, so several worker processes can
+        # accept connections on the same addresses.
+        self.reuse_port = kwargs.pop('reuse_port', False)
+        # Accepting on all listeners is paused while server has
+        # `max_connections` connections.
+        self.max_connections = kwargs.pop('max_connections', None)
+        # Serve all IPv4 addresses of a port with one wildcard listening
+        # socket, accepted connections are dispatched by local address.
+        self.wildcard = kwargs.pop('wildcard', False)
+        # Connections of changed or removed forwardings are closed after
+        # `drain_timeout` seconds, if forwarding doesn't set its own timeout.
+        self.drain_timeout = kwargs.pop('drain_timeout', None)
+        # Server side TLS handshakes of forwardings with `tls_cert` option
+        # are performed in `tls_threads` threads, 0 means IOLoop thread.
+        tls_threads = kwargs.pop('tls_threads', 0)
+        handshake_timeout = kwargs.pop('handshake_timeout', DEFAULT_HANDSHAKE_TIMEOUT)
+        # `forwarder.accesslog.AccessLog` which records closed connections.
+        self.access_log = kwargs.pop('access_log', None)
+        # `forwarder.resolver.CachedResolver` of backend host names.
+        self.resolver = kwargs.pop('resolver', None) or get_default_resolver()
         super(ForwardServer, self).__init__(*args, **kwargs)
+        if getattr(self, 'io_loop', None) is None:
+            # tornado>=5.0 doesn't set it
+            self.io_loop = IOLoop.current()
+        self.read_chunk_size = self.read_chunk_size or DEFAULT_READ_CHUNK_SIZE
+        self.connection_class = self.get_connection_class(engine)
         self.conf = {}
+        self._ranges = RangeIndex({})  # Port range forwardings of `conf`
+        self._resolved = {}  # Forwardings of port range ports, by listener (addr, port)
         self._config_file = None
-        self._config_files_mtime_cache = {}
-        self._connections = []  # List of server active connections. Each exposed by tuple (addr, port).
+        # Parsed configuration files cache. Each file path is mapped to tuple
+        # (file stamp, parsed file configuration).
+        self._config_files_cache = {}
+        self._config_definitions = {}  # Paths of files defining each forwarding
+        self._files_conf = {}  # Configuration merged from all files
+        # Forwardings set by `apply_changes` over configuration files, None
+        # for removed ones. Kept until files define the same forwardings.
+        self._overrides = {}
+        self._connections = ConnectionRegistry()  # Server active connections indexed by listener (addr, port).
         self._fds = {}  # List of sockets descriptors. Each exposed by tuple (addr, port).
-        self._config_reload_callback = None
+        self._shared = {}  # Port => set of listeners (addr, port) served by wildcard socket of the port
+        self._pools = {}  # Backends pool of each forwarding. Each exposed by tuple (addr, port).
+        self._warm_pools = {}  # Idle backend connections of forwardings with `warm` option.
+        self._rate_limiters = {}  # `TokenBucket` of forwardings with `rate` option.
+        self._bandwidth_limiters = {}  # Forwardings with bandwidth limits => {option name: `TokenBucket`}
+        self._paused = {}  # Listeners (addr, port) which don't accept connections, mapped to limit reached.
+        self._timers = TimerWheel(io_loop=self.io_loop)
+        self._timeouts = {}  # `TimeoutsState` of connections of forwardings with timeouts
+        self._draining = {}  # Connections of changed or removed forwardings => set of connections drained with them
+        self.metrics = Metrics(self)
+        self._tls = TLSContexts()  # SSL contexts of forwardings with TLS options
+        self._handshaker = Handshaker(tls_threads, handshake_timeout, io_loop=self.io_loop)
+        self._udp = {}  # `UDPForwarding` of each UDP listener (addr, port)
+        self._inherited = {}  # Listening sockets taken from another process, by (addr, port)
+        self._prebound = {}  # UDP sockets bound by `bind_conf` before configuration is changed
+        self._drain_callback = None
+        self._drain_timeout = None
+        self._config_reload_callback = None  # Polling fallback, used when inotify is unavailable
+        self._config_watcher = None
 
     def bind_from_config_file(self, config_file, autoreload=True):
         """
         Sets `Forwarder` instance config file and binds config from it.
         Checks for configuration file changes and applies them if `autoreload`
-        parameter is True.
+        parameter is True. Changes are detected with inotify where available,
+        otherwise files are polled twice a second.
         """
         self._config_file = config_file
+        if autoreload and inotify_available():
+            self._config_watcher = InotifyWatcher(self._handle_config_reload)
+            try:
+                self._config_watcher.start()
+            except OSError as e:
+                logging.warning('Failed to start inotify watcher, polling config files: %s', e)
+                self._config_watcher = None
         self._handle_config_reload()
-        if autoreload:
+        if autoreload and self._config_watcher is None:
             self._config_reload_callback = PeriodicCallback(self._handle_config_reload, 500)
             self._config_reload_callback.start()
 
+    def stop_config_reload(self):
+        """
+        Stops checking for configuration file changes.
+        """
+        if self._config_watcher:
+            self._config_watcher.stop()
+            self._config_watcher = None
+        if self._config_reload_callback:
+            self._config_reload_callback.stop()
+            self._config_reload_callback = None
+
     def _handle_config_reload(self):
         """
-        Reloads config files and binds parsed configuration.
+        Reloads changed config files and binds merged configuration.
+        Unchanged files are not parsed again.
         """
-        config_files_mtime = {}
+        config_files_stamp = {}
         config_file = self._config_file
         if os.path.isdir(self._config_file):
             config_file = os.path.join(config_file, '*')
+        if self._config_watcher:
+            self._config_watcher.watch(watch_paths(config_file))
         for path in glob.iglob(config_file):
-            config_files_mtime[path] = os.path.getmtime(path)
-        if config_files_mtime != self._config_files_mtime_cache:
-            self._config_files_mtime_cache = config_files_mtime
+            try:
+                config_files_stamp[path] = file_stamp(path)
+            except OSError:
+                continue  # File was removed right after listing
+        cache = self._config_files_cache
+        changed = set(path for path in config_files_stamp
+                      if path not in cache or cache[path][0] != config_files_stamp[path])
+        removed = set(cache) - set(config_files_stamp)
+        if changed or removed:
             logging.info("Configuration reload")
-            config_files = config_files_mtime.keys()
-            config = {}
-            for path in config_files:
-                config.update(self.parse_config(filename=path))
-            self.bind_conf(config)
+            # Parse everything before changing any state, so a broken file
+            # leaves previous configuration intact and is retried on next change.
+            parsed = dict((path, self.parse_config(filename=path)) for path in changed)
+            affected = set()
+            for path in changed | removed:
+                if path in cache:
+                    for key in cache.pop(path)[1]:
+                        self._config_definitions[key].discard(path)
+                        affected.add(key)
+            for path in changed:
+                cache[path] = config_files_stamp[path], parsed[path]
+                for key in parsed[path]:
+                    self._config_definitions.setdefault(key, set()).add(path)
+                    affected.add(key)
+            for key in affected:
+                paths = sorted(self._config_definitions[key])
+                if not paths:
+                    del self._config_definitions[key]
+                    self._files_conf.pop(key, None)
+                    continue
+                self._files_conf[key] = cache[paths[0]][1][key]
+                if len(paths) > 1:
+                    logging.warning('Forwarding from %s:%s is defined in several files: %s. Using one from %s',
+                                    key[0], key[1], ', '.join(paths), paths[0])
+            conf = self._apply_overrides(self._files_conf)
+            overlap = find_overlap(conf)
+            if overlap:
+                # Current configuration is kept until files are changed again
+                raise ParseError('Forwardings from {0}:{1} and {2}:{3} overlap'.format(
+                    *(overlap[0] + overlap[1])), ', '.join(sorted(
+                        path for key in overlap for path in self._config_definitions.get(key, ()))))
+            self.bind_conf(conf)
+
+    def _apply_overrides(self, conf):
+        """
+        Returns ``conf`` with forwardings changed by `apply_changes`.
+        Overrides which ``conf`` matches already are dropped.
+        """
+        conf = dict(conf)
+        for key, forwarding in list(self._overrides.items()):
+            if conf.get(key) == forwarding:
+                del self._overrides[key]
+            elif forwarding is None:
+                conf.pop(key, None)
+            else:
+                conf[key] = forwarding
+        return conf
+
+    def apply_changes(self, added=None, changed=None, removed=()):
+        """
+        Adds ``added`` and replaces ``changed`` forwardings, which are dicts
+        like `parse_config` returns, and removes forwardings of ``removed``
+        listeners, all with a single `bind_conf` call. Nothing is changed
+        if any of the forwardings to add exists or the others don't.
+        Changes are kept over configuration files until `save_changes`.
+        """
+        added = added or {}
+        changed = changed or {}
+        keys = list(added) + list(changed) + list(removed)
+        duplicates = set(key for key in keys if keys.count(key) > 1)
+        if duplicates:
+            raise ValueError('Forwarding changed twice: {0}'.format(
+                ', '.join('{0}:{1}'.format(*key) for key in sorted(duplicates, key=str))))
+        for key in added:
+            if key in self.conf:
+                raise ValueError('Forwarding from {0}:{1} exists already'.format(*key))
+        for key in list(changed) + list(removed):
+            if key not in self.conf:
+                raise ValueError('Forwarding from {0}:{1} does not exist'.format(*key))
+        conf = dict(self.conf)
+        conf.update(added)
+        conf.update(changed)
+        for key in removed:
+            del conf[key]
+        overlap = find_overlap(conf)
+        if overlap:
+            raise ValueError('Forwardings from {0}:{1} and {2}:{3} overlap'.format(*(overlap[0] + overlap[1])))
+        self.bind_conf(conf)
+        for key in keys:
+            self._overrides[key] = conf.get(key)
+
+    def save_changes(self, path):
+        """
+        Writes forwardings changed by `apply_changes` to configuration files.
+        Their lines are replaced in files defining them, forwardings not
+        defined in any file are appended to ``path``. Returns sorted list
+        of written files.
+        """
+        files = {}
+        for key, forwarding in self._overrides.items():
+            paths = self._config_definitions.get(key) or ([path] if forwarding is not None else [])
+            for p in paths:
+                files.setdefault(p, {})[key] = forwarding
+        for p, changes in files.items():
+            self._rewrite_config_file(p, changes)
+        if self._config_file:
+            # Overrides which files match now are dropped
+            self._handle_config_reload()
+        return sorted(files)
+
+    def _rewrite_config_file(self, path, changes):
+        lines = []
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().splitlines()
+        result = []
+        changes = dict(changes)
+        for line in lines:
+            keys = []
+            if line.strip() and not line.startswith('#'):
+                try:
+                    keys = list(self.parse_config(data=line))
+                except ParseError:
+                    pass  # Broken line is kept as is
+            if keys and keys[0] in changes:
+                forwarding = changes.pop(keys[0])
+                if forwarding is not None:
+                    result.append(format_forwarding(keys[0][0], keys[0][1], forwarding))
+                continue
+            result.append(line)
+        for key, forwarding in sorted(changes.items(), key=lambda item: str(item[0])):
+            if forwarding is not None:
+                result.append(format_forwarding(key[0], key[1], forwarding))
+        # Replaced at once, so reload doesn't read a partially written file
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(line + '\n' for line in result))
+        os.rename(tmp_path, path)
+
+    def get_forwardings(self):
+        """
+        Returns list of dicts describing configured forwardings with
+        number of their active connections (UDP sessions), sorted by
+        listener.
+        """
+        result = []
+        for key in sorted(self.conf, key=lambda k: (k[0], getattr(k[1], 'first', k[1]))):
+            forwarding = self.conf[key]
+            connections = 0
+            for address in iter_listeners([key]):
+                if address in self._udp:
+                    connections += len(self._udp[address].sessions)
+                else:
+                    connections += self._connections.count(address)
+            result.append({
+                'listener': '{0}:{1}'.format(*key),
+                'backends': ['{0}:{1}'.format(*b) for b in get_backends(forwarding)],
+                'options': get_options(forwarding),
+                'config': format_forwarding(key[0], key[1], forwarding),
+                'connections': connections,
+            })
+        return result
 
     def parse_config(self, data='', filename=''):
         """
@@ -90,6 +543,50 @@ class ForwardServer(TCPServer):
             127.0.0.1 8089 => 127.0.0.1 8080
             127.0.0.1:8090, 127.0.0.1:8080
             127.0.0.1 8091    127.0.0.1 8080
+            # Connections may be balanced between several backends.
+            # Options follow backends as `name=value`:
+            #   balance - `roundrobin` (default) or `leastconn`
+            #   max_fails - connect failures in a row to eject backend (1)
+            #   check_interval - seconds between ejected backend checks (5)
+            #   warm - number of idle connections to backends kept open (0)
+            #   warm_idle - seconds after which idle connection is reopened (60)
+            #   nodelay - set TCP_NODELAY on sockets, `on` or `off` (OS default)
+            #   keepalive - set SO_KEEPALIVE on sockets, `on` or `off` (OS default)
+            #   rcvbuf, sndbuf - socket buffers size, e.g. `4m` (OS default)
+            #   backlog - listening socket accept queue length (128)
+            #   read_chunk_size - bytes read from a socket at once, e.g. `256k` (64k)
+            #   max_conns - maximum number of concurrent connections (unlimited)
+            #   rate - maximum number of new connections per second (unlimited)
+            #   connect_timeout - seconds to wait for backend connection (unlimited)
+            #   idle_timeout - seconds without data in both directions (unlimited)
+            #   half_close_timeout - seconds to flush data after a peer closed connection (unlimited)
+            #   proto - `tcp` (default) or `udp`
+            #   max_sessions - maximum number of UDP client sessions (10000)
+            #   drain_timeout - seconds connections of changed forwarding are kept (unlimited)
+            #   tls_cert, tls_key - certificate and key files to accept TLS connections
+            #   tls_ciphers - OpenSSL cipher list of accepted TLS connections
+            #   tls_upstream - connect to backends with TLS, `on` or `off` (off)
+            #   tls_upstream_ca - CA file to verify backends (system CAs)
+            #   tls_upstream_verify - verify backend certificates, `on` or `off` (on)
+            #   bandwidth_up, bandwidth_down - bytes per second sent to backends and to clients
+            #       by all connections of the forwarding (unlimited)
+            #   conn_bandwidth_up, conn_bandwidth_down - the same limits of each connection (unlimited)
+            127.0.0.1:8092 => 127.0.0.1:8080 127.0.0.1:8081 balance=leastconn
+            127.0.0.1:8093 => 127.0.0.1:8080 nodelay=on keepalive=on
+            # UDP sessions are closed after idle_timeout, 30 seconds by default.
+            127.0.0.1:53 => 10.0.0.1:53 10.0.0.2:53 proto=udp idle_timeout=10
+            # Port ranges are forwarded to ranges of the same length in
+            # order, or all to a single port.
+            10.0.0.1:8000-8999 => 10.0.0.2:9000-9999
+            10.0.0.1:7000-7099 => 10.0.0.2:7000
+            # TLS is terminated with certificate and key of the forwarding.
+            0.0.0.0:443 => 10.0.0.1:8080 tls_cert=/etc/ssl/site.pem tls_key=/etc/ssl/site.key
+            # Clients download at most 10 MB/s together and 1 MB/s each.
+            127.0.0.1:8094 => 127.0.0.1:8080 bandwidth_down=10m conn_bandwidth_down=1m
+
+        Returns dict, which maps (addr, port) of listener to `Forwarding`.
+        Port of range forwarding is `forwarder.ranges.PortRange`, backend
+        ports of range forwarding may be ranges too.
         """
         if all([data, filename]):
             raise ValueError('Parameters are exclusive each other')
@@ -104,67 +601,800 @@ class ForwardServer(TCPServer):
             data = data
 
         conf = {}
+        lines = {}  # Config line of each listener, to report overlaps
         for lineno, line in enumerate(data):
             # Skip blank lines or commented lines
             if not line or line.startswith('#'):
                 continue
             try:
+                options = self.parse_options(OPTION_RE.findall(line))
+                values = OPTION_RE.sub(' ', line)
                 # Clear format
                 for i in (',', '=>', ':'):
-                    line = line.replace(i, ' ')
-                f_addr, f_port, t_addr, t_port = line.split()
-                conf[f_addr, int(f_port)] = t_addr, int(t_port)
-            except ValueError:
+                    values = values.replace(i, ' ')
+                values = values.split()
+                f_addr, f_port, targets = values[0], parse_port(values[1]), values[2:]
+                if not targets or len(targets) % 2:
+                    raise ValueError('Backends must be pairs of address and port')
+                backends = [(targets[i], parse_port(targets[i + 1])) for i in range(0, len(targets), 2)]
+                for _, port in backends:
+                    if isinstance(port, PortRange) and (not isinstance(f_port, PortRange) or
+                                                        len(port) != len(f_port)):
+                        raise ValueError('Backend port range must be as long as listener one')
+                if options.get('proto') == PROTO_UDP:
+                    for name in TCP_ONLY_OPTIONS:
+                        if name in options:
+                            raise ValueError('Option {0} is not supported by UDP forwardings'.format(name))
+                if any(name in options for name in TLS_OPTIONS):
+                    if not TLS_AVAILABLE:
+                        raise ValueError('TLS requires python ssl module with SSLContext')
+                    if 'tls_cert' not in options and ('tls_key' in options or 'tls_ciphers' in options):
+                        raise ValueError('Options tls_key and tls_ciphers require tls_cert')
+                    if options.get('tls_upstream') and options.get('warm'):
+                        raise ValueError('Warm connections can not be used with tls_upstream')
+                conf[f_addr, f_port] = Forwarding(backends, options)
+                lines[f_addr, f_port] = lineno, line
+            except (ValueError, IndexError):
                 raise ParseError('Failed to parse config line: `{0}`'.format(line), filename, lineno+1)
+        overlap = find_overlap(conf)
+        if overlap:
+            lineno, line = max(lines[key] for key in overlap)
+            raise ParseError('Ports of config line `{0}` overlap {1}:{2}'.format(
+                line, *min(overlap, key=lambda key: lines[key])), filename, lineno+1)
         return conf
 
+    def parse_options(self, options):
+        """
+        Converts list of (name, value) pairs to forwarding options dict.
+        """
+        result = {}
+        for name, value in options:
+            if name not in FORWARDING_OPTIONS:
+                raise ValueError('Unknown option: {0}'.format(name))
+            result[name] = FORWARDING_OPTIONS[name](value)
+        return result
+
     def bind_conf(self, conf):
         """
         Binds new added sockets, restarts changed and closes removed
-        from new configuration dictionary.
+        from new configuration dictionary. Connections to backends which
+        remain in changed forwarding are kept. Port ranges are compared
+        port by port, so listeners of ports which stay forwarded to the
+        same backends are not touched when a range is changed.
+        If a listener fails to bind, previous configuration is bound
+        again and the error is raised.
+        """
+        previous = self.conf
+        failed = self._bind_conf(conf)
+        if not failed:
+            return
+        logging.error('Failed to bind new configuration, restoring previous one')
+        restore_failed = self._bind_conf(previous)
+        if restore_failed:
+            # Listeners taken meanwhile by another process can't be restored,
+            # their forwardings are dropped and bound again on next change.
+            keys = set(key for key in previous if any(a in restore_failed for a in iter_listeners([key])))
+            self._bind_conf(dict((key, f) for key, f in previous.items() if key not in keys))
+        raise list(failed.values())[0]
+
+    def _bind_conf(self, conf):
         """
+        Applies ``conf`` for `bind_conf`. Listeners which don't conflict with
+        the removed ones are bound before anything is changed, an error is
+        raised then. Returns dict of listeners failed to bind later to errors.
+        """
+        failed = {}
         if self.conf != conf:
             diff = DictDiff(self.conf, conf)
             for addr, port in diff.removed:
-                logging.info('Forwarding %s removed from config. Closing all connections on it.',
-                             get_forwarding_str(addr, port, *self.conf[(addr, port)]))
-                self.close_connections((addr, port))
-                self.unbind(port, addr)
+                logging.info('Forwarding %s removed from config. Draining all connections on it.',
+                             describe_forwarding(addr, port, self.conf[(addr, port)]))
             for addr, port in diff.changed:
-                logging.info('Forwarding %s was changed in config. Reinitialize all connections on it',
-                             get_forwarding_str(addr, port, *conf[(addr, port)]))
-                self.close_connections((addr, port))
+                forwarding = conf[(addr, port)]
+                if not set(get_backends(self.conf[(addr, port)])) & set(get_backends(forwarding)):
+                    logging.info('Forwarding %s was changed in config. Draining all connections on it',
+                                 describe_forwarding(addr, port, forwarding))
+                else:
+                    logging.info('Forwarding %s was changed in config. Draining connections to removed backends',
+                                 describe_forwarding(addr, port, forwarding))
             for addr, port in diff.added:
                 logging.info('New forwarding %s was added in config. Start listening on it',
-                             get_forwarding_str(addr, port, *conf[(addr, port)]))
-                self.listen(port, addr)
+                             describe_forwarding(addr, port, conf[(addr, port)]))
+            old = expand_conf(self.conf, diff.removed | diff.changed)
+            new = expand_conf(conf, diff.added | diff.changed)
+            listeners = DictDiff(old, new)
+            # Forwardings which changed protocol are bound again.
+            rebound = set(a for a in listeners.changed if get_proto(old[a]) != get_proto(new[a]))
+            # New listeners are bound before anything is changed, so a failure
+            # leaves the current configuration intact. Ones which need a port
+            # of removed listeners are bound after they are closed.
+            freed = {}
+            for addr, port in listeners.removed | rebound:
+                freed.setdefault((port, get_proto(old[(addr, port)])), []).append(addr)
+            early = set(a for a in listeners.added
+                        if not any(self._conflicts(a[0], addr) for addr in freed.get((a[1], get_proto(new[a])), ())))
+            self._bind_listeners(early, new)
             self.conf = conf
+            self._ranges = RangeIndex(conf)
+            self._resolved = {}
+            self._tls.update([get_options(forwarding) for forwarding in conf.values()])
+            for addr, port in listeners.removed | rebound:
+                if (addr, port) in self._udp:
+                    self._unbind_udp((addr, port))
+                else:
+                    # Accepted connections are kept until they finish or drain timeout expires.
+                    self.drain_connections((addr, port), timeout=self.get_drain_timeout(old[(addr, port)]))
+                    self.unbind(port, addr)
+                    # Connections in TLS handshake would be closed once it finishes
+                    self._handshaker.cancel((addr, port))
+                self._rate_limiters.pop((addr, port), None)
+                self._bandwidth_limiters.pop((addr, port), None)
+                for pools in (self._warm_pools, self._pools):
+                    pool = pools.pop((addr, port), None)
+                    if pool:
+                        pool.stop()
+                self.metrics.forget((addr, port))
+            for addr, port in listeners.changed - rebound:
+                forwarding = new[(addr, port)]
+                old_backends = set(get_backends(old[(addr, port)]))
+                removed_backends = old_backends - set(get_backends(forwarding))
+                timeout = self.get_drain_timeout(forwarding)
+                if removed_backends == old_backends:
+                    self.drain_connections((addr, port), timeout=timeout)
+                elif removed_backends:
+                    self.drain_connections((addr, port), removed_backends, timeout)
+                self._update_pool((addr, port), forwarding)
+                if (addr, port) in self._udp:
+                    self._udp[(addr, port)].update(get_options(forwarding))
+                    continue
+                self._update_listener((addr, port), get_options(forwarding))
+                self._update_rate_limiter((addr, port), get_options(forwarding))
+                self._update_bandwidth_limiters((addr, port), get_options(forwarding))
+                # Limits may be changed, check them again
+                self._resume_accept((addr, port))
+                for connection in self._connections.get((addr, port)):
+                    if connection not in self._timeouts:
+                        self._watch_timeouts(connection)
+                    if isinstance(connection, ForwardConnection):
+                        connection.update_limiters()
+            for addr, port in listeners.added | rebound:
+                forwarding = new[(addr, port)]
+                try:
+                    if get_proto(forwarding) == PROTO_UDP:
+                        self._bind_udp((addr, port), forwarding)
+                        continue
+                    if (addr, port) not in early:
+                        self.listen(port, addr)
+                except (IOError, OSError) as e:
+                    logging.error('Failed to bind %s:%s: %s', addr, port, e)
+                    failed[addr, port] = e
+                    continue
+                self._update_listener((addr, port), get_options(forwarding))
+                self._update_rate_limiter((addr, port), get_options(forwarding))
+                self._update_bandwidth_limiters((addr, port), get_options(forwarding))
+                self._update_pool((addr, port), forwarding)
+        return failed
+
+    def _is_shared(self, address):
+        """
+        Returns True if listeners on ``address`` are served by wildcard socket.
+        """
+        return self.wildcard and is_ipv4_address(address) and address != WILDCARD_ADDRESS
+
+    def _conflicts(self, address, other):
+        """
+        Returns True if listeners of the same port on ``address`` and
+        ``other`` can't be bound at once.
+        """
+        if self._is_shared(address) and self._is_shared(other):
+            return False  # Both are served by the same wildcard socket
+        addresses = set(WILDCARD_ADDRESS if self._is_shared(a) else a for a in (address, other))
+        return len(addresses) == 1 or any(a in WILDCARD_ADDRESSES for a in addresses)
+
+    def _bind_listeners(self, listeners, conf):
+        """
+        Binds ``listeners`` of expanded ``conf``. If any of them fails to
+        bind, the ones bound already are closed and the error is raised.
+        UDP sockets wait in `_prebound` until `_bind_udp` serves them.
+        """
+        bound = []
+        try:
+            for addr, port in sorted(listeners):
+                if get_proto(conf[(addr, port)]) != PROTO_UDP:
+                    self.listen(port, addr)
+                elif (addr, port) not in self._inherited:
+                    self._prebound[addr, port] = bind_udp_socket(port, addr, reuse_port=self.reuse_port)
+                bound.append((addr, port))
+        except (IOError, OSError) as e:
+            logging.error('Failed to bind %s:%s: %s', addr, port, e)
+            for addr, port in bound:
+                sock = self._prebound.pop((addr, port), None)
+                if sock is not None:
+                    sock.close()
+                elif get_proto(conf[(addr, port)]) != PROTO_UDP:
+                    self.unbind(port, addr)
+            raise
+
+    def _bind_udp(self, address, forwarding):
+        sock = self._prebound.pop(address, None) or self._inherited.pop(address, None)
+        if sock is None:
+            sock = bind_udp_socket(address[1], address[0], reuse_port=self.reuse_port)
+        self._udp[address] = UDPForwarding(self, sock, self.get_pool(address), get_options(forwarding))
+
+    def _unbind_udp(self, address):
+        udp = self._udp.pop(address)
+        udp.stop()
+        udp.socket.close()
+
+    def on_session_closed(self, udp, session):
+        """
+        Called by `forwarder.udp.UDPForwarding` when a session is closed.
+        """
+        self.metrics.add_transferred(udp.address, session.bytes_upstream, session.bytes_downstream)
+        self._check_drained()
+
+    def _update_listener(self, address, options):
+        """
+        Applies socket options to listening socket. Connections accepted
+        later inherit them. Listen queue length is changed by listen(2) call.
+        Options of listeners served by a wildcard socket are set on each
+        accepted connection instead.
+        """
+        sock = self._sockets.get(self._fds.get(address))
+        if sock is not None:
+            set_socket_options(sock, options)
+            if 'backlog' in options:
+                sock.listen(options['backlog'])
+
+    def _update_rate_limiter(self, address, options):
+        rate = options.get('rate')
+        limiter = self._rate_limiters.get(address)
+        if not rate:
+            self._rate_limiters.pop(address, None)
+        elif limiter is None or limiter.rate != rate:
+            self._rate_limiters[address] = TokenBucket(rate, clock=self.io_loop.time)
+
+    def _update_bandwidth_limiters(self, address, options):
+        """
+        Sets up limiters shared by connections of forwarding listening on
+        ``address``. Changed limits apply to relayed connections at once.
+        """
+        old = self._bandwidth_limiters.pop(address, {})
+        limiters = {}
+        for name in ('bandwidth_up', 'bandwidth_down'):
+            rate = options.get(name)
+            if not rate:
+                continue
+            limiters[name] = old.get(name)
+            if limiters[name] is None:
+                limiters[name] = TokenBucket(rate, clock=self.io_loop.time)
+            elif limiters[name].rate != rate:
+                limiters[name].set_rate(rate)
+        if limiters:
+            self._bandwidth_limiters[address] = limiters
+
+    def get_bandwidth_limiters(self, address):
+        """
+        Returns dict of `TokenBucket` shared by connections of forwarding
+        listening on ``address`` by their option names.
+        """
+        return self._bandwidth_limiters.get(address, {})
+
+    def _get_pool_args(self, forwarding):
+        options = get_options(forwarding)
+        return (get_backends(forwarding),
+                options.get('balance', BALANCE_ROUNDROBIN),
+                options.get('max_fails', DEFAULT_MAX_FAILS),
+                options.get('check_interval', DEFAULT_CHECK_INTERVAL))
+
+    def _update_pool(self, address, forwarding):
+        options = get_options(forwarding)
+        if address in self._pools:
+            self._pools[address].update(*self._get_pool_args(forwarding))
+        warm_size = options.get('warm', 0)
+        warm_idle = options.get('warm_idle', DEFAULT_WARM_IDLE)
+        if not warm_size:
+            warm_pool = self._warm_pools.pop(address, None)
+            if warm_pool:
+                warm_pool.stop()
+        elif address in self._warm_pools:
+            self._warm_pools[address].update(warm_size, warm_idle, options)
+        else:
+            self._warm_pools[address] = WarmPool(self.get_pool(address), warm_size, warm_idle, options,
+                                                 io_loop=self.io_loop)
+
+    def get_forwarding(self, address):
+        """
+        Returns forwarding listening on ``address`` or None. Forwardings
+        of port range ports are resolved on first use.
+        """
+        forwarding = self.conf.get(address)
+        if forwarding is None:
+            forwarding = self._resolved.get(address)
+        if forwarding is None:
+            found = self._ranges.lookup(address)
+            if found:
+                listener, forwarding = found
+                forwarding = self._resolved[address] = expand_forwarding(forwarding, listener, address[1])
+        return forwarding
+
+    def get_options(self, address):
+        """
+        Returns options dict of forwarding listening on ``address``.
+        """
+        return get_options(self.get_forwarding(address) or ())
+
+    def get_read_chunk_size(self, address):
+        """
+        Returns bytes read at once by connections of forwarding listening on ``address``.
+        """
+        return self.get_options(address).get('read_chunk_size', self.read_chunk_size)
+
+    def get_pool(self, address):
+        """
+        Returns `BackendPool` of forwarding listening on ``address``. Pools
+        are created on first use, so large port ranges are bound fast.
+        """
+        pool = self._pools.get(address)
+        if pool is None:
+            pool = self._pools[address] = BackendPool(*self._get_pool_args(self.get_forwarding(address)),
+                                                      io_loop=self.io_loop, resolver=self.resolver)
+        return pool
+
+    def count_connections(self, address):
+        """
+        Returns number of connections or UDP sessions of forwarding listening on ``address``.
+        """
+        udp = self._udp.get(address)
+        return len(udp.sessions) if udp else self._connections.count(address)
+
+    def get_warm_connection(self, address):
+        """
+        Returns tuple (socket, backend address) of established idle connection
+        to a backend of forwarding listening on ``address`` or None.
+        """
+        warm_pool = self._warm_pools.get(address)
+        return warm_pool.take() if warm_pool else None
+
+    def stop(self):
+        super(ForwardServer, self).stop()
+        self.stop_config_reload()
+        self._timers.stop()
+        self._handshaker.stop()
+        for address in list(self._udp):
+            self._unbind_udp(address)
+        for pools in (self._warm_pools, self._pools):
+            for pool in pools.values():
+                pool.stop()
+
+    def listen(self, port, address=""):
+        if self._is_shared(address):
+            shared = self._shared.setdefault(port, set())
+            if not shared:
+                self._bind_wildcard(port)
+            shared.add((address, port))
+            return
+        sock = self._inherited.pop((address, port), None)
+        if sock is None and is_ipv4_address(address):
+            sock = bind_ipv4_socket(port, address, reuse_port=self.reuse_port)
+        if sock is not None:
+            self.add_sockets([sock])
+            return
+        sockets = bind_sockets(port, address=address, reuse_port=self.reuse_port)
+        self.add_sockets(sockets)
+
+    def _bind_wildcard(self, port):
+        sock = self._inherited.pop((WILDCARD_ADDRESS, port), None)
+        if sock is None:
+            try:
+                sock = bind_ipv4_socket(port, WILDCARD_ADDRESS, reuse_port=self.reuse_port)
+            except Exception:
+                del self._shared[port]
+                raise
+        self.add_sockets([sock])
+
+    def inherit_sockets(self, sockets):
+        """
+        Makes `listen` use listening sockets from ``sockets`` dict, which maps
+        (addr, port) to socket, instead of binding new ones. Used to take
+        listeners of another process over, see `forwarder.handoff`.
+        """
+        self._inherited.update(sockets)
+
+    def close_inherited_sockets(self):
+        """
+        Closes inherited sockets which are not used by configuration.
+        """
+        for sock in self._inherited.values():
+            sock.close()
+        self._inherited.clear()
+
+    def get_listeners(self):
+        """
+        Returns dict mapping (addr, port) to listening socket.
+        """
+        listeners = dict((address, self._sockets[fd]) for address, fd in self._fds.items())
+        listeners.update((address, udp.socket) for address, udp in self._udp.items())
+        return listeners
+
+    def drain(self, callback, timeout=None):
+        """
+        Stops accepting on all listeners and calls ``callback`` once all
+        connections are closed. Connections left after ``timeout`` seconds
+        are closed.
+        """
+        self.stop_config_reload()
+        for addr, port in list(self._fds):
+            self.unbind(port, addr)
+        self._shared.clear()
+        for udp in self._udp.values():
+            udp.stop_receiving()
+        for warm_pool in self._warm_pools.values():
+            warm_pool.stop()
+        self._warm_pools.clear()
+        self._drain_callback = callback
+        if timeout is not None:
+            self._drain_timeout = self.io_loop.call_later(timeout, self._close_drained)
+        self._check_drained()
+
+    def _close_drained(self):
+        self._drain_timeout = None
+        if self._connections:
+            logging.info('Drain timeout expired, closing %s connections', len(self._connections))
+        for connection in self._connections:
+            connection.close()
+        for udp in self._udp.values():
+            udp.close_sessions()
+        self._handshaker.cancel()
+        self._check_drained()
+
+    def _check_drained(self):
+        if self._drain_callback is None or self._connections or self._handshaker.count():
+            return
+        if any(udp.sessions for udp in self._udp.values()):
+            return
+        if self._drain_timeout is not None:
+            self.io_loop.remove_timeout(self._drain_timeout)
+            self._drain_timeout = None
+        callback, self._drain_callback = self._drain_callback, None
+        callback()
 
     def add_sockets(self, sockets):
-        super(ForwardServer, self).add_sockets(sockets)
+        # Connections are accepted by own handler instead of
+        # `tornado.netutil.add_accept_handler`, so accepting may be paused.
         for sock in sockets:
-            self._fds[sock.getsockname()] = sock.fileno()
+            fd = sock.fileno()
+            self._sockets[fd] = sock
+            self._fds[sock.getsockname()] = fd
+            self.io_loop.add_handler(fd, self._handle_accept, IOLoop.READ)
+            if hasattr(self, '_handlers'):
+                # tornado>=5.0 removes handlers with these callables on stop
+                self._handlers[fd] = functools.partial(self.io_loop.remove_handler, fd)
 
     def unbind(self, port, address):
-        fd = self._fds[address, port]
+        shared = self._shared.get(port)
+        if shared and (address, port) in shared:
+            # Wildcard socket is closed with the last listener it serves.
+            shared.remove((address, port))
+            self._paused.pop((address, port), None)
+            if shared:
+                return
+            del self._shared[port]
+            address = WILDCARD_ADDRESS
+        fd = self._fds.pop((address, port), None)
+        if fd is None:
+            # Listener failed to bind
+            return
         socket = self._sockets[fd]
-        socket.close()
         self.io_loop.remove_handler(fd)
+        socket.close()
         del self._sockets[fd]
+        getattr(self, '_handlers', {}).pop(fd, None)
+        self._paused.pop((address, port), None)
+
+    def _handle_accept(self, fd, events):
+        sock = self._sockets.get(fd)
+        if sock is None:
+            return
+        address = sock.getsockname()
+        shared = self._shared.get(address[1]) if address[0] == WILDCARD_ADDRESS else None
+        for i in range(ACCEPT_BATCH):
+            # Per forwarding limits of a wildcard socket are checked once
+            # local address of a connection is known.
+            limit = self.check_admission(None if shared is not None else address)
+            if limit:
+                # Listener is readable, so a connection surely waits only
+                # before the first accept. Otherwise next event tells it.
+                if i == 0:
+                    self._pause_accept(address, limit)
+                return
+            try:
+                connection, client_address = sock.accept()
+            except socket.error as e:
+                if errno_from_exception(e) in _ERRNO_WOULDBLOCK:
+                    return
+                # Connection was closed while still in the accept queue
+                if errno_from_exception(e) == errno.ECONNABORTED:
+                    continue
+                raise
+            local_address = address
+            if shared is not None:
+                local_address = self._dispatch(connection, shared)
+                if local_address is None:
+                    continue
+            limiter = self._rate_limiters.get(local_address)
+            if limiter:
+                limiter.consume()
+            set_close_exec(connection.fileno())
+            self._accept_connection(connection, client_address, local_address)
+
+    def _accept_connection(self, connection, client_address, address):
+        """
+        Starts relaying ``connection`` accepted on ``address`` listener.
+        Connections of forwardings with TLS or bandwidth limits are relayed
+        by tornado engine.
+        """
+        options = self.get_options(address)
+        if options.get('tls_upstream') and self._tls.get_client_context(options) is None:
+            connection.close()
+            return
+        if 'tls_cert' not in options:
+            limited = any(name in options for name in BANDWIDTH_OPTIONS)
+            if self.connection_class is ForwardConnection or not (limited or options.get('tls_upstream')):
+                self._handle_connection(connection, client_address)
+                return
+            stream = IOStream(connection, max_buffer_size=self.max_buffer_size, read_chunk_size=self.read_chunk_size)
+            self.open_connection(stream, client_address, ForwardConnection)
+            return
+        context = self._tls.get_server_context(options)
+        if context is None:
+            connection.close()
+            return
+        connection.setblocking(False)
+        try:
+            sock = context.wrap_socket(connection, server_side=True, do_handshake_on_connect=False)
+        except (IOError, OSError):
+            # Client disconnected already
+            connection.close()
+            return
+        self._handshaker.handshake(sock, functools.partial(self._on_handshake, address, client_address), address)
+
+    def _on_handshake(self, address, client_address, sock, error):
+        if error is not None:
+            logging.debug('TLS handshake with %s:%s failed: %s', client_address[0], client_address[1], error)
+            self.metrics.tls_handshake_failed(address)
+            self._check_drained()
+            return
+        self.metrics.tls_handshake(address, sock.session_reused)
+        if self.get_forwarding(address) is None:
+            # Forwarding was removed meanwhile
+            sock.close()
+            self._check_drained()
+            return
+        stream = SSLIOStream(sock, max_buffer_size=self.max_buffer_size, read_chunk_size=self.read_chunk_size)
+        self.open_connection(stream, client_address, ForwardConnection)
+
+    def get_upstream_context(self, address):
+        """
+        Returns SSL context of connections to backends of forwarding
+        listening on ``address`` or None if they are not encrypted.
+        """
+        return self._tls.get_client_context(self.get_options(address))
+
+    def _dispatch(self, connection, shared):
+        """
+        Admits ``connection`` accepted by a wildcard socket, if its local
+        address is one of ``shared`` listeners. Otherwise connection is
+        closed at once. Returns local address of admitted connection or None.
+        """
+        try:
+            address = connection.getsockname()[:2]
+        except socket.error:
+            address = None
+        if address not in shared:
+            connection.close()
+            return None
+        limit = self.check_admission(address)
+        if limit:
+            # Accepting can't be paused for one address of a shared
+            # socket, so connections over the limit are refused.
+            connection.close()
+            self.metrics.accept_throttled(address, limit)
+            return None
+        set_socket_options(connection, self.get_options(address))
+        return address
+
+    def check_admission(self, address):
+        """
+        Returns limit, which doesn't allow to accept a new connection on
+        ``address`` listener now, or None. Only global limit is checked
+        if ``address`` is None. Connections in TLS handshake are counted.
+        """
+        if self.max_connections and len(self._connections) + self._handshaker.count() >= self.max_connections:
+            return LIMIT_GLOBAL
+        if address is None:
+            return None
+        max_conns = self.get_options(address).get('max_conns')
+        if max_conns and self._connections.count(address) + self._handshaker.count(address) >= max_conns:
+            return LIMIT_MAX_CONNS
+        limiter = self._rate_limiters.get(address)
+        if limiter and limiter.delay():
+            return LIMIT_RATE
+        return None
+
+    def _pause_accept(self, address, limit):
+        """
+        Stops accepting on ``address`` listener. Waiting connections stay in
+        listen queue until the limit allows to accept them.
+        """
+        if address in self._paused:
+            return
+        logging.info('Accepting on %s:%s is paused, %s limit is reached', address[0], address[1], limit)
+        self._paused[address] = limit
+        self.io_loop.update_handler(self._fds[address], 0)
+        self.metrics.accept_throttled(address, limit)
+        if limit == LIMIT_RATE:
+            self.io_loop.call_later(self._rate_limiters[address].delay(), self._resume_accept, address)
 
-    def open_connection(self, stream, address):
-        connection = ForwardConnection(self, stream, address)
-        self._connections.append(connection)
+    def _resume_accept(self, address):
+        if self._paused.pop(address, None) is None:
+            return
+        fd = self._fds.get(address)
+        if fd in self._sockets:
+            self.io_loop.update_handler(fd, IOLoop.READ)
+
+    def get_connection_class(self, engine):
+        """
+        Returns connection class which relays data with specified engine.
+        Falls back to tornado engine if the requested one can't be used.
+        """
+        if engine not in ENGINES:
+            raise ValueError('Unknown relay engine: {0}'.format(engine))
+        if engine == ENGINE_SPLICE:
+            if not SPLICE_AVAILABLE:
+                logging.warning('splice(2) is not available, falling back to %s engine', ENGINE_TORNADO)
+            elif self.ssl_options:
+                logging.warning('splice(2) can not relay TLS, falling back to %s engine', ENGINE_TORNADO)
+            else:
+                return SpliceConnection
+        if engine == ENGINE_ASYNCIO:
+            if not ASYNCIO_AVAILABLE or not hasattr(self.io_loop, 'asyncio_loop'):
+                logging.warning('asyncio engine requires python>=3.7 and tornado>=5.0, falling back to %s engine',
+                                ENGINE_TORNADO)
+            elif self.ssl_options:
+                logging.warning('asyncio engine does not relay TLS, falling back to %s engine', ENGINE_TORNADO)
+            else:
+                return AsyncioConnection
+        return ForwardConnection
+
+    def open_connection(self, stream, address, connection_class=None):
+        connection = (connection_class or self.connection_class)(self, stream, address)
+        self._connections.add(connection)
+        self.metrics.connection_opened(connection.address)
         connection.set_close_callback(self.on_connection_closed)
-        logging.info("Total connections: %s", len(self._connections))
+        self._watch_timeouts(connection)
 
     def on_connection_closed(self, connection):
         self._connections.remove(connection)
+        self.metrics.connection_closed(connection)
+        if self.access_log:
+            self.access_log.connection_closed(connection, self.io_loop.time())
+        state = self._timeouts.pop(connection, None)
+        if state:
+            self._timers.cancel(state.timer)
+        drained = self._draining.pop(connection, None)
+        if drained is not None:
+            drained.discard(connection)
+            if self.get_forwarding(connection.address) is None and not self._connections.count(connection.address):
+                # The last connection of removed forwarding
+                self.metrics.forget(connection.address)
+        for address, limit in list(self._paused.items()):
+            if limit != LIMIT_RATE and self.check_admission(address) is None:
+                self._resume_accept(address)
+        self._check_drained()
         del connection
 
-    def close_connections(self, address):
-        for c in self._connections:
-            if c.address == address:
+    def _watch_timeouts(self, connection):
+        """
+        Starts timeouts tracking of ``connection`` if its forwarding has timeouts.
+        """
+        self._timeouts[connection] = TimeoutsState(self.io_loop.time(), self.get_options(connection.address))
+        self._check_timeouts(connection)
+
+    def _check_timeouts(self, connection):
+        """
+        Closes ``connection`` if it stays in current state for too long,
+        otherwise checks it again when timeout of the state may expire.
+        Relayed data is noticed only on checks, so idle connection is
+        closed after one or two idle timeouts.
+        """
+        state = self._timeouts.get(connection)
+        if state is None:
+            return
+        forwarding = self.get_forwarding(connection.address)
+        if forwarding is not None and get_proto(forwarding) != PROTO_UDP:
+            state.options = get_options(forwarding)
+        # Drained connections of a removed forwarding keep its timeouts
+        options = state.options
+        now = self.io_loop.time()
+        transferred = sum(pump.transferred for pump in connection.pumps)
+        if transferred != state.transferred:
+            state.transferred = transferred
+            state.active = now
+        if not connection.pumps:
+            name, since = CONNECT_TIMEOUT, state.opened
+        elif connection.half_closed_at is not None:
+            name, since = HALF_CLOSE_TIMEOUT, connection.half_closed_at
+        else:
+            name, since = IDLE_TIMEOUT, state.active
+        timeout = options.get(name)
+        if timeout and now - since >= timeout:
+            del self._timeouts[connection]
+            self._on_timeout(connection, name)
+            return
+        if timeout:
+            delay = since + timeout - now
+        else:
+            # Current state has no timeout, check when it may be changed.
+            delay = min([options[t] for t in TIMEOUTS if options.get(t)] or [None])
+            if delay is None:
+                del self._timeouts[connection]
+                return
+        state.timer = self._timers.call_later(delay, self._check_timeouts, connection)
+
+    def get_drain_timeout(self, forwarding):
+        """
+        Returns seconds after which connections of ``forwarding`` are closed
+        once it is changed or removed, or None if they are never closed.
+        """
+        return get_options(forwarding).get('drain_timeout', self.drain_timeout)
+
+    def drain_connections(self, address, backends=None, timeout=None):
+        """
+        Lets connections accepted on ``address`` listener finish, closing
+        the ones left after ``timeout`` seconds. New connections go to the
+        current configuration. If ``backends`` is set, only connections to
+        these backends are drained. UDP sessions are closed at once.
+        """
+        if address in self._udp or timeout == 0:
+            self.close_connections(address, backends)
+            return
+        # Connections drained already keep the earlier deadline.
+        connections = set(c for c in self._connections.get(address)
+                          if c not in self._draining and (backends is None or c.remote_address in backends))
+        if not connections:
+            return
+        logging.info('Draining %s connections on %s:%s', len(connections), address[0], address[1])
+        for connection in connections:
+            self._draining[connection] = connections
+        if timeout is not None:
+            self.io_loop.call_later(timeout, self._expire_drain, connections)
+
+    def _expire_drain(self, connections):
+        if connections:
+            logging.info('Drain timeout expired, closing %s connections', len(connections))
+        for connection in list(connections):
+            connection.close()
+
+    def _on_timeout(self, connection, name):
+        logging.info('Closing connection from %s on %s:%s, %s expired',
+                     connection.reverse_address[0], connection.address[0], connection.address[1], name)
+        self.metrics.timeout(connection.address, name)
+        if name == CONNECT_TIMEOUT and connection.remote_address:
+            connection.pool.report_failure(connection.remote_address)
+            self.metrics.connect_failed(connection.address)
+        connection.close()
+
+    def close_connections(self, address, backends=None):
+        """
+        Closes connections accepted on ``address`` listener. If ``backends``
+        is set, only connections to these backends are closed.
+        """
+        if address in self._udp:
+            self._udp[address].close_sessions(backends)
+            return
+        for c in self._connections.get(address):
+            if backends is None or c.remote_address in backends:
                 c.close()
 
     def handle_stream(self, stream, address):
@@ -172,51 +1402,252 @@ class ForwardServer(TCPServer):
         self.open_connection(stream, address)
 
 
+class Pump(object):
+    """
+    Relays data from ``source`` stream to ``destination`` stream.
+
+    Reading from ``source`` is paused when more than ``high_water_mark``
+    bytes wait in ``destination`` write buffer and is resumed when buffer
+    drains below ``low_water_mark``, so memory used by slow peer
+    is bounded. ``eof_callback`` is called when ``source`` is closed.
+
+    Relayed bytes are taken from `TokenBucket` ``limiters``. While any of
+    them is in debt, reading is paused until it is paid off, so pumps
+    sharing a limiter read in turns.
+    """
+    def __init__(self, source, destination, eof_callback=None,
+                 read_chunk_size=DEFAULT_READ_CHUNK_SIZE,
+                 high_water_mark=DEFAULT_HIGH_WATER_MARK,
+                 low_water_mark=DEFAULT_LOW_WATER_MARK,
+                 limiters=()):
+        if low_water_mark > high_water_mark:
+            raise ValueError('Low water mark must not exceed high water mark')
+        self.source = source
+        self.destination = destination
+        self.eof_callback = eof_callback
+        self.read_chunk_size = read_chunk_size
+        self.high_water_mark = high_water_mark
+        self.low_water_mark = low_water_mark
+        self.io_loop = source.io_loop
+        self.limiters = list(limiters)
+        self.pending = 0  # Bytes written to destination, but not flushed yet.
+        self.paused = False
+        self.throttled = False  # Waits for limiters
+        self.transferred = 0
+
+    def start(self):
+        self._read()
+
+    def _read(self):
+        self.throttled = False
+        delay = max([limiter.delay(0) for limiter in self.limiters] or [0])
+        if delay > 0:
+            self.throttled = True
+            self.io_loop.call_later(delay, self._read)
+            return
+        try:
+            future = self.source.read_bytes(self.read_chunk_size, partial=True)
+        except StreamClosedError:
+            self._on_eof()
+        else:
+            self.io_loop.add_future(future, self._on_read)
+
+    def _on_read(self, future):
+        try:
+            data = future.result()
+        except StreamClosedError:
+            self._on_eof()
+            return
+        if self.destination.closed():
+            return
+        size = len(data)
+        self.transferred += size
+        self.pending += size
+        for limiter in self.limiters:
+            limiter.consume(size)
+        self.io_loop.add_future(self.destination.write(data),
+                                functools.partial(self._on_written, size))
+        if self.pending > self.high_water_mark:
+            self.paused = True
+        else:
+            self._read()
+
+    def _on_written(self, size, future):
+        self.pending -= size
+        # Retrieved always, so failed writes are not logged as unhandled
+        failed = future.exception() is not None
+        if self.paused and self.pending <= self.low_water_mark and not failed:
+            self.paused = False
+            self._read()
+
+    def _on_eof(self):
+        if self.eof_callback:
+            self.eof_callback()
+
+
 class ForwardConnection(object):
     def __init__(self, server, stream, address):
         self._close_callback = None
+        self._closed = False
         self.server = server
         self.stream = stream
         self.reverse_address = address
+        self.opened_at = server.io_loop.time()
         self.address = stream.socket.getsockname()
-        self.remote_address = server.conf[self.address]
-        sock = socket.socket()
-        self.remote_stream = IOStream(sock)
-        self.remote_stream.connect(self.remote_address, self._on_remote_connected)
+        self.pool = server.get_pool(self.address)
+        self.options = server.get_options(self.address)
+        self.read_chunk_size = server.get_read_chunk_size(self.address)
+        self.stream.read_chunk_size = self.read_chunk_size
+        self.remote_address = None
+        self.remote_stream = None
+        self.pumps = []
+        self._tried_backends = []
+        self._addresses = []  # Resolved addresses of the backend left to try
+        self._upstream_context = server.get_upstream_context(self.address)
+        self._limiters = {}  # `TokenBucket` of connection bandwidth limits by option names
+        self._closing = False
+        self._connect_started = None
+        self.half_closed_at = None  # Time when one of peers closed connection
+        self.stream.set_close_callback(self._on_stream_closed)
+        warm = server.get_warm_connection(self.address)
+        if warm:
+            sock, backend = warm
+            self._set_remote_stream(sock, backend)
+            self._on_remote_connected()
+        else:
+            self._connect(self.pool.select())
+
+    def _set_remote_stream(self, sock, backend):
+        self.remote_address = backend
+        self._tried_backends.append(backend)
+        self.pool.connection_opened(backend)
+        self._open_remote_stream(sock)
+
+    def _open_remote_stream(self, sock):
+        if self._upstream_context is not None:
+            # Socket is wrapped and handshake is done once it is connected
+            self.remote_stream = SSLIOStream(sock, ssl_options=self._upstream_context,
+                                             max_buffer_size=self.server.max_buffer_size,
+                                             read_chunk_size=self.read_chunk_size)
+        else:
+            self.remote_stream = IOStream(sock, max_buffer_size=self.server.max_buffer_size,
+                                          read_chunk_size=self.read_chunk_size)
+        self.remote_stream.set_close_callback(self._on_stream_closed)
+
+    def _connect(self, backend):
+        self._connect_started = self.server.io_loop.time()
+        self._set_remote_stream(create_socket(self.options), backend)
+        self.pool.resolver.resolve(backend[0], backend[1], functools.partial(self._on_resolved, self.remote_stream))
+
+    def _on_resolved(self, stream, addresses):
+        if stream is not self.remote_stream or stream.closed():
+            # Connection was closed while the name was resolved
+            return
+        if not addresses:
+            logging.warning('Failed to resolve %s', self.remote_address[0])
+            stream.close()
+            return
+        self._addresses = addresses
+        self._connect_next()
+
+    def _connect_next(self):
+        self.remote_stream.connect(self._addresses.pop(0), self._on_remote_connected,
+                                   server_hostname=self.remote_address[0])
 
     def close(self):
+        self._closing = True
         self.remote_stream.close()
+        self.stream.close()
 
     def set_close_callback(self, callback):
         self._close_callback = callback
 
     def _on_remote_connected(self):
-        ip_from = self.reverse_address[0]
-        fwd_str = get_forwarding_str(self.address[0], self.address[1],
-                                      self.remote_address[0], self.remote_address[1])
-        logging.info('Connected ip: %s, forward %s', ip_from, fwd_str)
-        self.remote_stream.read_until_close(self._on_remote_read_close, self.stream.write)
-        self.stream.read_until_close(self._on_read_close, self.remote_stream.write)
-
-    def _on_remote_read_close(self, data):
-        if self.stream.writing():
-            self.stream.write(data, self.stream.close)
-        else:
-            if self.stream.closed():
-                self._on_closed()
-            else:
-                self.stream.close()
+        self.pool.report_success(self.remote_address)
+        if self._connect_started is not None:
+            # Connections taken from warm pool were connected in advance
+            self.server.metrics.connect_finished(self.address, self.server.io_loop.time() - self._connect_started)
+        server = self.server
+        self.pumps = [
+            Pump(self.remote_stream, self.stream, self._on_remote_read_close,
+                 self.read_chunk_size, server.high_water_mark, server.low_water_mark),
+            Pump(self.stream, self.remote_stream, self._on_read_close,
+                 self.read_chunk_size, server.high_water_mark, server.low_water_mark),
+        ]
+        self.update_limiters()
+        for pump in self.pumps:
+            pump.start()
 
-    def _on_read_close(self, data):
-        if self.remote_stream.writing():
-            self.remote_stream.write(data, self.remote_stream.close)
+    def update_limiters(self):
+        """
+        Applies bandwidth limits of the forwarding to relayed data.
+        """
+        if not self.pumps:
+            return
+        options = self.server.get_options(self.address)
+        shared = self.server.get_bandwidth_limiters(self.address)
+        for pump, direction in zip(self.pumps, ('down', 'up')):
+            pump.limiters = []
+            name = 'conn_bandwidth_' + direction
+            rate = options.get(name)
+            limiter = self._limiters.get(name)
+            if not rate:
+                self._limiters.pop(name, None)
+            elif limiter is None:
+                limiter = self._limiters[name] = TokenBucket(rate, clock=self.server.io_loop.time)
+            elif limiter.rate != rate:
+                limiter.set_rate(rate)
+            if rate:
+                pump.limiters.append(limiter)
+            if 'bandwidth_' + direction in shared:
+                pump.limiters.append(shared['bandwidth_' + direction])
+
+    def _on_remote_read_close(self):
+        self._close_after_flush(self.stream)
+
+    def _on_read_close(self):
+        self._close_after_flush(self.remote_stream)
+
+    def _close_after_flush(self, stream):
+        if stream.closed():
+            return
+        if self.half_closed_at is None:
+            self.half_closed_at = self.server.io_loop.time()
+        if stream.writing():
+            stream.io_loop.add_future(stream.write(b''), lambda future: stream.close())
         else:
-            if self.remote_stream.closed():
-                self._on_closed()
-            else:
-                self.remote_stream.close()
+            stream.close()
+
+    def _on_stream_closed(self):
+        if not self.pumps:
+            # Remote connection is not established yet or failed, so
+            # there is no data to flush.
+            if self.remote_stream.closed() and not self.stream.closed() and not self._closing:
+                if self._addresses:
+                    # Try other addresses of the backend name first
+                    logging.warning('Failed to connect to %s:%s, trying its address %s',
+                                    self.remote_address[0], self.remote_address[1], self._addresses[0][0])
+                    self._open_remote_stream(create_socket(self.options))
+                    self._connect_next()
+                    return
+                self.pool.report_failure(self.remote_address)
+                self.server.metrics.connect_failed(self.address)
+                backend = self.pool.select(exclude=self._tried_backends)
+                if backend is not None:
+                    logging.warning('Failed to connect to %s:%s, trying %s:%s',
+                                    self.remote_address[0], self.remote_address[1], backend[0], backend[1])
+                    self.pool.connection_closed(self.remote_address)
+                    self._connect(backend)
+                    return
+            self.stream.close()
+            self.remote_stream.close()
+        if self.stream.closed() and self.remote_stream.closed():
+            self._on_closed()
 
     def _on_closed(self):
-        logging.info('Disconnected ip: %s', self.reverse_address[0])
+        if self._closed:
+            return
+        self._closed = True
+        self.pool.connection_closed(self.remote_address)
         if self._close_callback:
             self._close_callback(self)
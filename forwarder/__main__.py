@@ -4,8 +4,15 @@ import logging
 
 from tornado.ioloop import IOLoop
 from tornado.options import options
+from tornado.process import fork_processes
 
-from forwarder import ForwardServer
+from forwarder import ForwardServer, DEFAULT_HIGH_WATER_MARK, DEFAULT_LOW_WATER_MARK, ENGINES, ENGINE_TORNADO
+from forwarder import handoff
+from forwarder.accesslog import AccessLog
+from forwarder.control import get_default_save_path, start_control_server
+from forwarder.metrics import start_metrics_server
+from forwarder.resolver import CachedResolver, DEFAULT_DNS_TTL, DEFAULT_RESOLVER_THREADS
+from forwarder.tls import DEFAULT_HANDSHAKE_TIMEOUT
 
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - - %(asctime)s %(message)s', datefmt='[%d/%b/%Y %H:%M:%S]')
@@ -14,6 +21,46 @@ logging.basicConfig(level=logging.INFO, format='%(levelname)s - - %(asctime)s %(
 def main():
     options.define('certfile', help="Path to SSL certificate to enable TSL")
     options.define('keyfile', help="Path to SSL key to enable TSL")
+    options.define('high_water_mark', type=int, default=DEFAULT_HIGH_WATER_MARK,
+                   help="Pause reading from a peer when this number of bytes waits to be sent to the other one")
+    options.define('low_water_mark', type=int, default=DEFAULT_LOW_WATER_MARK,
+                   help="Resume reading when pending bytes drop to this number")
+    options.define('engine', default=ENGINE_TORNADO,
+                   help="Relay engine, one of: {0}".format(', '.join(ENGINES)))
+    options.define('max_connections', type=int,
+                   help="Pause accepting on all listeners while a worker has this number of connections")
+    options.define('wildcard_listeners', type=bool, default=False,
+                   help="Listen on a single wildcard socket per port for all IPv4 addresses of the port")
+    options.define('dns_ttl', type=float, default=DEFAULT_DNS_TTL,
+                   help="Seconds resolved backend host names are cached")
+    options.define('dns_threads', type=int, default=DEFAULT_RESOLVER_THREADS,
+                   help="Number of threads resolving backend host names")
+    options.define('tls_threads', type=int, default=0,
+                   help="Number of threads performing TLS handshakes of forwardings with tls_cert, "
+                        "0 performs them in the main thread")
+    options.define('tls_handshake_timeout', type=float, default=DEFAULT_HANDSHAKE_TIMEOUT,
+                   help="Seconds a client may take to complete TLS handshake")
+    options.define('access_log', help="Write access log records to this file, `-` writes them to the main log")
+    options.define('access_log_sample', type=float, default=1.0,
+                   help="Share of connections written to access log, 0 writes only summaries")
+    options.define('access_log_summary', type=float,
+                   help="Write summary of closed connections of each forwarding every this number of seconds")
+    options.define('workers', type=int, default=1,
+                   help="Number of worker processes sharing listeners with SO_REUSEPORT, 0 means CPU count")
+    options.define('handoff_socket',
+                   help="Unix socket to take listeners of running forwarder over on start "
+                        "and to hand them to a new process on restart")
+    options.define('drain_timeout', type=float,
+                   help="Seconds to wait for connections of changed or removed forwardings and of handed off "
+                        "listeners to close, unlimited by default")
+    options.define('metrics_port', type=int,
+                   help="Expose Prometheus metrics on this port at /metrics, workers use successive ports")
+    options.define('metrics_address', default='127.0.0.1', help="Address of metrics HTTP server")
+    options.define('metrics_socket', help="Expose Prometheus metrics on this unix socket, workers add .N suffix")
+    options.define('control_socket', help="Serve control API changing forwardings at runtime on this unix socket")
+    options.define('control_save_file',
+                   help="File to save forwardings added with control API to, by default the configuration file "
+                        "or control.conf in the configuration directory")
     unparsed = options.parse_command_line()
     if len(unparsed) == 1:
         config_file = options.parse_command_line()[0]
@@ -26,9 +73,67 @@ def main():
         }
     else:
         ssl_options = None
-    server = ForwardServer(ssl_options=ssl_options)
+    reuse_port = options.workers != 1
+    if options.handoff_socket and reuse_port:
+        raise ValueError("Listeners handoff works with a single worker only")
+    if options.control_socket and reuse_port:
+        raise ValueError("Control API works with a single worker only")
+    task_id = None
+    if reuse_port:
+        # Supervisor process restarts crashed workers, each worker binds
+        # and reloads configuration by itself.
+        task_id = fork_processes(options.workers)
+    access_log = None
+    if options.access_log:
+        access_log = AccessLog(path=None if options.access_log == '-' else options.access_log,
+                               sample=options.access_log_sample,
+                               summary_interval=options.access_log_summary)
+    server = ForwardServer(ssl_options=ssl_options,
+                           engine=options.engine,
+                           reuse_port=reuse_port,
+                           max_connections=options.max_connections,
+                           drain_timeout=options.drain_timeout,
+                           wildcard=options.wildcard_listeners,
+                           resolver=CachedResolver(ttl=options.dns_ttl, threads=options.dns_threads),
+                           tls_threads=options.tls_threads,
+                           handshake_timeout=options.tls_handshake_timeout,
+                           access_log=access_log,
+                           high_water_mark=options.high_water_mark,
+                           low_water_mark=options.low_water_mark)
+    handoff_connection = None
+    if options.handoff_socket:
+        handoff_connection = handoff.connect(options.handoff_socket)
+        if handoff_connection:
+            server.inherit_sockets(handoff.receive_listeners(handoff_connection))
     server.bind_from_config_file(config_file)
+    if handoff_connection:
+        server.close_inherited_sockets()
+        # Returns when the old process doesn't accept anymore and
+        # released metrics port.
+        handoff.confirm(handoff_connection)
+    metrics_server = None
+    if options.metrics_socket:
+        suffix = '' if task_id is None else '.{0}'.format(task_id)
+        metrics_server = start_metrics_server(server.metrics, unix_socket=options.metrics_socket + suffix)
+    elif options.metrics_port:
+        metrics_server = start_metrics_server(server.metrics, port=options.metrics_port + (task_id or 0),
+                                              address=options.metrics_address)
+    control_server = None
+    if options.control_socket:
+        control_server = start_control_server(server, options.control_socket,
+                                              options.control_save_file or get_default_save_path(config_file))
+    if options.handoff_socket:
+        def on_handoff():
+            if metrics_server:
+                metrics_server.stop()
+            if control_server:
+                control_server.stop()
+            server.drain(IOLoop.instance().stop, timeout=options.drain_timeout)
+
+        handoff.HandoffServer(server, options.handoff_socket, on_handoff).start()
     IOLoop.instance().start()
+    if access_log:
+        access_log.stop()
 
 
 if __name__ == '__main__':
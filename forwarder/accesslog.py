@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Structured access log. One JSON record is written per closed connection.
+
+Records are only collected on IOLoop thread, formatting and writing is
+done by a background thread, so slow disk doesn't stall relaying. Records
+are dropped when the writer falls behind for more than ``queue_size``
+records. At very high connection rates records may be sampled or replaced
+with periodic per forwarding summaries.
+"""
+import json
+import logging
+import random
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue
+
+from tornado.ioloop import PeriodicCallback
+
+from forwarder.metrics import get_transferred
+
+
+DEFAULT_QUEUE_SIZE = 10000
+
+_STOP = object()  # Tells writer thread to exit
+
+
+def format_address(address):
+    if address is None:
+        return None
+    return '{0}:{1}'.format(address[0], address[1])
+
+
+class Summary(object):
+    __slots__ = ('connections', 'bytes_upstream', 'bytes_downstream', 'duration')
+
+    def __init__(self):
+        self.connections = 0
+        self.bytes_upstream = 0
+        self.bytes_downstream = 0
+        self.duration = 0.0
+
+
+class AccessLog(object):
+    """
+    Writes connection records to ``path`` file, or to ``forwarder.access``
+    logger if path is not set.
+
+    Only ``sample`` share of connections is written, 0 disables connection
+    records. If ``summary_interval`` is set, a summary of all connections
+    closed on every forwarding is written each ``summary_interval`` seconds.
+    """
+    def __init__(self, path=None, sample=1.0, summary_interval=None, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.sample = sample
+        self.summary_interval = summary_interval
+        self.dropped = 0  # Records not written, because queue was full
+        self._queue = queue.Queue(queue_size)
+        self._summaries = {}  # Listener (addr, port) => `Summary`
+        self._summary_callback = None
+        if summary_interval:
+            self._summary_callback = PeriodicCallback(self.flush_summary, summary_interval * 1000)
+            self._summary_callback.start()
+        self._thread = threading.Thread(target=self._run, name='forwarder-access-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def connection_closed(self, connection, now):
+        """
+        Logs ``connection`` closed at ``now`` IOLoop time.
+        """
+        upstream, downstream = get_transferred(connection)
+        duration = now - connection.opened_at
+        if self.summary_interval:
+            summary = self._summaries.get(connection.address)
+            if summary is None:
+                summary = self._summaries[connection.address] = Summary()
+            summary.connections += 1
+            summary.bytes_upstream += upstream
+            summary.bytes_downstream += downstream
+            summary.duration += duration
+        if self.sample >= 1 or random.random() < self.sample:
+            # Addresses are formatted by writer thread.
+            self._put({
+                'time': time.time(),
+                'client': connection.reverse_address,
+                'listener': connection.address,
+                'backend': connection.remote_address,
+                'duration': duration,
+                'bytes_upstream': upstream,
+                'bytes_downstream': downstream,
+            })
+
+    def flush_summary(self):
+        """
+        Writes summary of connections closed since previous call.
+        """
+        summaries, self._summaries = self._summaries, {}
+        now = time.time()
+        for address, summary in summaries.items():
+            self._put({
+                'time': now,
+                'summary': True,
+                'listener': address,
+                'connections': summary.connections,
+                'bytes_upstream': summary.bytes_upstream,
+                'bytes_downstream': summary.bytes_downstream,
+                'duration': summary.duration / summary.connections,
+            })
+
+    def stop(self):
+        """
+        Writes remaining summaries and records and waits for writer thread to exit.
+        """
+        if self._summary_callback:
+            self._summary_callback.stop()
+            self.flush_summary()
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            logging.warning('Access log writer fell behind, %s records were dropped', self.dropped)
+            self.dropped = 0
+
+    def _run(self):
+        if self.path:
+            f = open(self.path, 'a')
+            write = f.write
+        else:
+            f = None
+            logger = logging.getLogger('forwarder.access')
+            write = lambda line: logger.info(line.rstrip('\n'))
+        try:
+            while True:
+                record = self._queue.get()
+                if record is _STOP:
+                    break
+                try:
+                    write(self.format(record))
+                    if f is not None and self._queue.empty():
+                        f.flush()
+                except (IOError, OSError) as e:
+                    logging.warning('Failed to write access log: %s', e)
+        finally:
+            if f is not None:
+                f.close()
+
+    def format(self, record):
+        for key in ('client', 'listener', 'backend'):
+            if key in record:
+                record[key] = format_address(record[key])
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record['time'])) + \
+            '.{0:03d}'.format(int(record['time'] * 1000) % 1000)
+        record['duration'] = round(record['duration'], 6)
+        return json.dumps(record, sort_keys=True) + '\n'
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Relay engine built on asyncio transports. Data is read with
+`asyncio.BufferedProtocol` into a preallocated buffer and flow control
+uses transports ``pause_reading``/``resume_reading``.
+Requires python>=3.7 and tornado>=5.0 running on asyncio event loop.
+"""
+import functools
+import logging
+
+try:
+    import asyncio
+except ImportError:
+    # python<3.4
+    asyncio = None
+
+from forwarder.utils import create_socket
+
+
+ASYNCIO_AVAILABLE = hasattr(asyncio, 'BufferedProtocol')
+
+_read_buffers = {}  # Size => buffer
+
+
+def get_read_buffer(size):
+    """
+    Returns read buffer of ``size`` bytes shared by all protocols. Data is
+    copied out of it right in `RelayProtocol.buffer_updated`, before the
+    event loop reads into it again, so one buffer is enough for a loop.
+    """
+    buf = _read_buffers.get(size)
+    if buf is None:
+        buf = _read_buffers[size] = memoryview(bytearray(size))
+    return buf
+
+
+class RelayProtocol(getattr(asyncio, 'BufferedProtocol', object)):
+    """
+    One side of `AsyncioConnection`. Data read from its transport is written
+    to ``peer`` transport. Reading is paused while more than high water mark
+    bytes wait in ``peer`` transport write buffer.
+    """
+    def __init__(self, connection, read_chunk_size):
+        self.connection = connection
+        self.peer = None
+        self.transport = None
+        self.lost = False
+        self.paused = False
+        self.transferred = 0
+        self._buffer = get_read_buffer(read_chunk_size)
+        self._backlog = []  # Data read before relaying started
+
+    @property
+    def pending(self):
+        """
+        Bytes read from this side, but not sent to peer yet.
+        """
+        return self.peer.transport.get_write_buffer_size() if self.peer.transport else 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        server = self.connection.server
+        transport.set_write_buffer_limits(server.high_water_mark, server.low_water_mark)
+        # Nothing is relayed until both sides are connected.
+        transport.pause_reading()
+
+    def start(self):
+        for data in self._backlog:
+            self.peer.transport.write(data)
+        self._backlog = []
+        self.transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        self.transferred += nbytes
+        # Transport may keep a reference to unsent data, so the buffer
+        # can't be passed as is.
+        data = self._buffer[:nbytes].tobytes()
+        if not self.connection.pumps:
+            # Some python versions start reading despite pause_reading()
+            # call in connection_made().
+            self._backlog.append(data)
+            self.transport.pause_reading()
+        elif not self.peer.transport.is_closing():
+            self.peer.transport.write(data)
+
+    def eof_received(self):
+        # Transport is closed after return, peer is closed once its
+        # buffered data is flushed.
+        self.connection.close_gracefully()
+
+    def pause_writing(self):
+        self.peer.paused = True
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.paused = False
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.lost = True
+        if exc is not None:
+            logging.debug('Relay error: %s', exc)
+        self.connection.close_gracefully()
+
+
+class AsyncioConnection(object):
+    """
+    Same as `forwarder.ForwardConnection`, but relays data with asyncio
+    transports and `RelayProtocol`. Works only for plain TCP streams.
+    """
+    def __init__(self, server, stream, address):
+        # Use client socket directly, IOStream is never started.
+        self._close_callback = None
+        self._closed = False
+        self._closing = False
+        self.server = server
+        self.loop = server.io_loop.asyncio_loop
+        self.reverse_address = address
+        self.opened_at = server.io_loop.time()
+        self.socket = stream.socket
+        self.address = self.socket.getsockname()
+        self.pool = server.get_pool(self.address)
+        self.options = server.get_options(self.address)
+        self.remote_address = None
+        self.pumps = []
+        read_chunk_size = server.get_read_chunk_size(self.address)
+        self.client = RelayProtocol(self, read_chunk_size)
+        self.remote = RelayProtocol(self, read_chunk_size)
+        self.client.peer, self.remote.peer = self.remote, self.client
+        self._pending = set()  # Transports creation futures
+        self._tried_backends = []
+        self._addresses = []  # Resolved addresses of the backend left to try
+        self._connect_started = None
+        self.half_closed_at = None  # Time when one of peers closed connection
+        self._wait(self.loop.connect_accepted_socket(lambda: self.client, sock=self.socket),
+                   self._on_client_made)
+        warm = server.get_warm_connection(self.address)
+        if warm:
+            sock, backend = warm
+            self._set_remote_address(backend)
+            self._wait(self.loop.create_connection(lambda: self.remote, sock=sock), self._on_remote_made)
+        else:
+            self._connect(self.pool.select())
+
+    def _wait(self, coroutine, callback):
+        future = self.loop.create_task(coroutine)
+        self._pending.add(future)
+        future.add_done_callback(callback)
+
+    def _set_remote_address(self, backend):
+        self.remote_address = backend
+        self._tried_backends.append(backend)
+        self.pool.connection_opened(backend)
+
+    def _connect(self, backend):
+        self._connect_started = self.server.io_loop.time()
+        self._set_remote_address(backend)
+        self.pool.resolver.resolve(backend[0], backend[1], functools.partial(self._on_resolved, backend))
+
+    def _on_resolved(self, backend, addresses):
+        if self._closing or backend != self.remote_address:
+            return
+        if not addresses:
+            self._on_connect_error('name is not resolved')
+            return
+        self._addresses = addresses
+        self._connect_next()
+
+    def _connect_next(self):
+        # Socket is created here, so options are set before connect.
+        sock = create_socket(self.options)
+        self._wait(self.loop.sock_connect(sock, self._addresses.pop(0)),
+                   functools.partial(self._on_remote_connected, sock))
+
+    def _on_remote_connected(self, sock, future):
+        if future.cancelled() or future.exception() is not None:
+            sock.close()
+            self._on_remote_made(future)
+            return
+        self._pending.discard(future)
+        if self._closing:
+            sock.close()
+            self._check_closed()
+        else:
+            self._wait(self.loop.create_connection(lambda: self.remote, sock=sock), self._on_remote_made)
+
+    def close(self):
+        """
+        Closes both sides at once, discarding data which isn't sent yet.
+        """
+        self._closing = True
+        for future in list(self._pending):
+            future.cancel()
+        for protocol in (self.client, self.remote):
+            if protocol.transport:
+                protocol.transport.abort()
+        self._check_closed()
+
+    def close_gracefully(self):
+        """
+        Closes both sides after buffered data is flushed.
+        """
+        if self.half_closed_at is None:
+            self.half_closed_at = self.server.io_loop.time()
+        self._closing = True
+        for protocol in (self.client, self.remote):
+            if protocol.transport:
+                protocol.transport.close()
+        self._check_closed()
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def _on_client_made(self, future):
+        self._pending.discard(future)
+        if future.cancelled() or future.exception() is not None:
+            self.socket.close()
+            self.close()
+            return
+        if self._closing:
+            future.result()[0].abort()
+        else:
+            self._start()
+        self._check_closed()
+
+    def _on_remote_made(self, future):
+        self._pending.discard(future)
+        if future.cancelled():
+            self.close()
+            return
+        if future.exception() is not None:
+            if self._closing:
+                self._check_closed()
+                return
+            self._on_connect_error(future.exception())
+            return
+        if self._closing:
+            future.result()[0].abort()
+            self._check_closed()
+            return
+        self.pool.report_success(self.remote_address)
+        if self._connect_started is not None:
+            # Connections taken from warm pool were connected in advance
+            self.server.metrics.connect_finished(self.address, self.server.io_loop.time() - self._connect_started)
+        self._start()
+
+    def _on_connect_error(self, reason):
+        """
+        Tries other addresses of the backend, then other backends.
+        Closes connection if there is nothing left to try.
+        """
+        logging.warning('Failed to connect to %s:%s: %s', self.remote_address[0], self.remote_address[1], reason)
+        if self._addresses:
+            self._connect_next()
+            return
+        self.pool.report_failure(self.remote_address)
+        self.server.metrics.connect_failed(self.address)
+        backend = self.pool.select(exclude=self._tried_backends)
+        if backend is None:
+            self.close_gracefully()
+        else:
+            self.pool.connection_closed(self.remote_address)
+            self._connect(backend)
+
+    def _start(self):
+        if self.pumps or not (self.client.transport and self.remote.transport):
+            return
+        self.pumps = [self.remote, self.client]
+        for protocol in self.pumps:
+            protocol.start()
+
+    def _check_closed(self):
+        if self._closed or not self._closing or self._pending:
+            return
+        if all(p.transport is None or p.lost for p in (self.client, self.remote)):
+            self._closed = True
+            self.pool.connection_closed(self.remote_address)
+            if self._close_callback:
+                self._close_callback(self)
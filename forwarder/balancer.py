@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Backends pools of forwardings with several backends.
+"""
+import itertools
+import logging
+import socket
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream
+
+from forwarder.resolver import get_default_resolver
+
+
+BALANCE_ROUNDROBIN = 'roundrobin'
+BALANCE_LEASTCONN = 'leastconn'
+BALANCE_METHODS = (BALANCE_ROUNDROBIN, BALANCE_LEASTCONN)
+
+DEFAULT_MAX_FAILS = 1
+DEFAULT_CHECK_INTERVAL = 5.0
+
+
+class Backend(object):
+    def __init__(self, address):
+        self.address = address
+        self.connections = 0
+        self.failures = 0
+        self.down = False
+
+    def __repr__(self):
+        return '<Backend {0}:{1}{2}>'.format(self.address[0], self.address[1], ' down' if self.down else '')
+
+
+class BackendPool(object):
+    """
+    Selects backend for new connections of one forwarding.
+
+    Backend is ejected from the pool after ``max_fails`` connect failures in
+    a row. Ejected backends are probed with TCP connect every ``check_interval``
+    seconds and return to the pool once probe succeeds. If every backend is
+    ejected, all of them are used anyway.
+
+    Backend host names are resolved with ``resolver``, connections of the
+    pool use it as well.
+    """
+    def __init__(self, backends, balance=BALANCE_ROUNDROBIN, max_fails=DEFAULT_MAX_FAILS,
+                 check_interval=DEFAULT_CHECK_INTERVAL, io_loop=None, resolver=None):
+        self.io_loop = io_loop or IOLoop.current()
+        self.resolver = resolver or get_default_resolver()
+        self.backends = []
+        self._backends = {}
+        self._counter = itertools.count()
+        self._checker = None
+        self._probes = {}
+        self.update(backends, balance, max_fails, check_interval)
+
+    def update(self, backends, balance=BALANCE_ROUNDROBIN, max_fails=DEFAULT_MAX_FAILS,
+               check_interval=DEFAULT_CHECK_INTERVAL):
+        """
+        Sets new backends list. State of backends which remain in the pool
+        (connections count, ejection) is kept.
+        """
+        if balance not in BALANCE_METHODS:
+            raise ValueError('Unknown balance method: {0}'.format(balance))
+        self.balance = balance
+        self.max_fails = max_fails
+        self.backends = [self._backends.get(address) or Backend(address) for address in backends]
+        self._backends = dict((backend.address, backend) for backend in self.backends)
+        if self._checker and self.check_interval != check_interval:
+            self._checker.stop()
+            self._checker = None
+        self.check_interval = check_interval
+        self._update_checker()
+
+    def stop(self):
+        if self._checker:
+            self._checker.stop()
+            self._checker = None
+        for stream in list(self._probes.values()):
+            stream.close()
+
+    def select(self, exclude=()):
+        """
+        Returns address of backend for a new connection. Backends listed in
+        ``exclude`` are skipped, None is returned if there is no other backend.
+        """
+        candidates = [b for b in self.backends if b.address not in exclude]
+        if not candidates:
+            return None
+        candidates = [b for b in candidates if not b.down] or candidates
+        if self.balance == BALANCE_LEASTCONN:
+            # Rotate start position, so equally loaded backends share connections.
+            offset = next(self._counter) % len(candidates)
+            candidates = candidates[offset:] + candidates[:offset]
+            backend = min(candidates, key=lambda b: b.connections)
+        else:
+            backend = candidates[next(self._counter) % len(candidates)]
+        return backend.address
+
+    def connection_opened(self, address):
+        backend = self._backends.get(address)
+        if backend:
+            backend.connections += 1
+
+    def connection_closed(self, address):
+        backend = self._backends.get(address)
+        if backend and backend.connections:
+            backend.connections -= 1
+
+    def report_success(self, address):
+        backend = self._backends.get(address)
+        if backend:
+            backend.failures = 0
+
+    def report_failure(self, address):
+        backend = self._backends.get(address)
+        if not backend:
+            return
+        backend.failures += 1
+        if not backend.down and backend.failures >= self.max_fails and len(self.backends) > 1:
+            logging.warning('Backend %s:%s is down, ejecting it from pool', *address)
+            backend.down = True
+            self._update_checker()
+
+    def _update_checker(self):
+        need_checks = any(b.down for b in self.backends)
+        if need_checks and not self._checker:
+            self._checker = PeriodicCallback(self._check, self.check_interval * 1000)
+            self._checker.start()
+        elif not need_checks and self._checker:
+            self._checker.stop()
+            self._checker = None
+
+    def _check(self):
+        for backend in self.backends:
+            if backend.down and backend.address not in self._probes:
+                self._probe(backend)
+
+    def _probe(self, backend):
+        stream = IOStream(socket.socket())
+        self._probes[backend.address] = stream
+        timeout = self.io_loop.call_later(self.check_interval, stream.close)
+
+        def on_connected(future):
+            self.io_loop.remove_timeout(timeout)
+            del self._probes[backend.address]
+            stream.close()
+            if future.exception() is None and backend is self._backends.get(backend.address):
+                logging.info('Backend %s:%s is up, returning it to pool', *backend.address)
+                backend.down = False
+                backend.failures = 0
+                self._update_checker()
+
+        def on_resolved(addresses):
+            if addresses and not stream.closed():
+                self.io_loop.add_future(stream.connect(addresses[0]), on_connected)
+            else:
+                self.io_loop.remove_timeout(timeout)
+                self._probes.pop(backend.address, None)
+                stream.close()
+
+        self.resolver.resolve(backend.address[0], backend.address[1], on_resolved)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Control API, which changes forwardings at runtime without rewriting
+configuration files.
+
+HTTP server on a local unix socket serves JSON at /forwardings:
+
+    GET   returns configured forwardings with numbers of their connections
+    POST  applies a batch of changes with a single `ForwardServer.bind_conf`
+          call and returns the result:
+
+          {"add": ["127.0.0.1:8000 => 10.0.0.1:8080 max_conns=100"],
+           "change": ["127.0.0.1:8001 => 10.0.0.2:8080"],
+           "remove": ["127.0.0.1:8002", "127.0.0.1:9000-9099"],
+           "save": true}
+
+The whole batch is checked first, nothing is changed if any operation is
+invalid. If a listener fails to bind, previous forwardings are restored.
+Changes are kept over configuration files, so reloads of other files don't
+revert them. With ``"save": true`` they are written to the files defining
+changed forwardings, added forwardings go to the save file.
+"""
+import json
+import logging
+import os
+import socket
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_unix_socket
+from tornado.web import Application, RequestHandler
+
+from forwarder import ParseError
+from forwarder.ranges import parse_port
+
+
+CONTROL_SAVE_FILE = 'control.conf'  # Save file of configuration directory
+
+
+def get_default_save_path(config_file):
+    """
+    Returns file to save added forwardings to: ``config_file`` itself or
+    `CONTROL_SAVE_FILE` in configuration directory. Returns None if
+    ``config_file`` is a glob pattern, the file is not known then.
+    """
+    if os.path.isdir(config_file):
+        return os.path.join(config_file, CONTROL_SAVE_FILE)
+    if any(c in config_file for c in '*?['):
+        return None
+    return config_file
+
+
+def parse_listener(value):
+    """
+    Converts ``addr:port`` or ``addr:first-last`` string to configuration key.
+    """
+    addr, _, port = value.strip().rpartition(':')
+    if not addr:
+        raise ValueError('Expected addr:port listener: {0}'.format(value))
+    return addr, parse_port(port)
+
+
+def parse_lines(server, lines):
+    """
+    Returns configuration dict of forwardings of ``lines`` list.
+    """
+    conf = {}
+    for line in lines:
+        parsed = server.parse_config(data=line)
+        if len(parsed) != 1:
+            raise ValueError('Expected a single forwarding: {0}'.format(line))
+        conf.update(parsed)
+    return conf
+
+
+class ControlHandler(RequestHandler):
+    def initialize(self, server, save_path):
+        self.server = server
+        self.save_path = save_path
+
+    def get(self):
+        self.write({'forwardings': self.server.get_forwardings()})
+
+    def post(self):
+        try:
+            batch = json.loads(self.request.body.decode())
+            if not isinstance(batch, dict):
+                raise ValueError('Expected JSON object')
+            added = parse_lines(self.server, batch.get('add', []))
+            changed = parse_lines(self.server, batch.get('change', []))
+            removed = [parse_listener(value) for value in batch.get('remove', [])]
+            if batch.get('save') and not self.save_path:
+                raise ValueError('Save file is not set')
+            self.server.apply_changes(added, changed, removed)
+        except (ParseError, ValueError, TypeError, AttributeError) as e:
+            self.send_error_message(400, e)
+            return
+        except (IOError, OSError, socket.error) as e:
+            # Listener failed to bind, like on configuration reload
+            logging.warning('Failed to apply control changes: %s', e)
+            self.send_error_message(500, e)
+            return
+        logging.info('Control changes applied: %s added, %s changed, %s removed',
+                     len(added), len(changed), len(removed))
+        saved = []
+        if batch.get('save'):
+            try:
+                saved = self.server.save_changes(self.save_path)
+            except (IOError, OSError) as e:
+                logging.warning('Failed to save control changes: %s', e)
+                self.send_error_message(500, 'Changes are applied, but not saved: {0}'.format(e))
+                return
+        self.write({
+            'added': sorted('{0}:{1}'.format(*key) for key in added),
+            'changed': sorted('{0}:{1}'.format(*key) for key in changed),
+            'removed': sorted('{0}:{1}'.format(*key) for key in removed),
+            'saved': saved,
+        })
+
+    def send_error_message(self, status, error):
+        self.set_status(status)
+        self.write({'error': str(error)})
+
+
+def start_control_server(server, unix_socket, save_path=None):
+    """
+    Starts HTTP server, which controls forwardings of ``server`` at
+    /forwardings URL on ``unix_socket`` path. Changes are saved to
+    configuration files and ``save_path`` on request. Returns started
+    `HTTPServer`.
+    """
+    app = Application([(r'/forwardings', ControlHandler, {'server': server, 'save_path': save_path})])
+    http_server = HTTPServer(app)
+    http_server.add_socket(bind_unix_socket(unix_socket))
+    return http_server
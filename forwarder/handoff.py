@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Hands listening sockets over to a new forwarder process, so restarts
+don't refuse connections.
+
+Running process serves handoff on a unix socket. New process connects to
+it and receives listening sockets with SCM_RIGHTS, binds its configuration
+using them and confirms. Then the old process stops accepting, lets the new
+one serve handoff on the same path and drains its connections. Both processes
+accept on the shared sockets meanwhile, so no connection is refused.
+
+Messages are sent over SOCK_SEQPACKET socket, so boundaries of messages
+carrying descriptors are kept:
+
+    old -> new  JSON list of [addr, port] with a descriptor of each, repeated
+    old -> new  empty JSON list, when all listeners are sent
+    new -> old  "ok", when configuration is bound
+    old -> new  connection is closed, when the old process stopped accepting
+"""
+import array
+import errno
+import json
+import logging
+import os
+import socket
+
+from tornado.ioloop import IOLoop
+from tornado.netutil import add_accept_handler
+from tornado.platform.auto import set_close_exec
+
+
+HANDOFF_AVAILABLE = hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg')
+MAX_FDS = 200  # Descriptors per message, Linux allows up to 253
+MAX_MESSAGE = 64 * 1024
+HANDOFF_TIMEOUT = 60.0
+CONFIRM = b'ok'
+
+
+def send_listeners(sock, sockets):
+    """
+    Sends ``sockets`` dict mapping (addr, port) to listening socket.
+    """
+    items = list(sockets.items())
+    for start in range(0, len(items), MAX_FDS):
+        chunk = items[start:start + MAX_FDS]
+        data = json.dumps([list(address) for address, _ in chunk]).encode()
+        fds = array.array('i', [s.fileno() for _, s in chunk])
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    sock.sendall(b'[]')
+
+
+def receive_listeners(sock):
+    """
+    Returns dict mapping (addr, port) to listening socket received from ``sock``.
+    """
+    sockets = {}
+    fd_size = array.array('i').itemsize
+    while True:
+        data, ancdata, flags, _ = sock.recvmsg(MAX_MESSAGE, socket.CMSG_SPACE(MAX_FDS * fd_size),
+                                               getattr(socket, 'MSG_CMSG_CLOEXEC', 0))
+        fds = array.array('i')
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fd_size])
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            raise IOError('Handoff connection closed unexpectedly')
+        addresses = json.loads(data.decode())
+        for address, fd in zip(addresses, fds):
+            listener = sockets[tuple(address)] = socket.socket(fileno=fd)
+            listener.setblocking(False)
+        if not addresses:
+            return sockets
+
+
+def connect(path, timeout=HANDOFF_TIMEOUT):
+    """
+    Connects to a process serving handoff on unix socket ``path``.
+    Returns connected socket or None if there is no such process.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return sock
+
+
+def confirm(sock):
+    """
+    Tells the old process that listeners are served and waits until it
+    stops accepting.
+    """
+    try:
+        sock.sendall(CONFIRM)
+        while sock.recv(MAX_MESSAGE):
+            pass
+    finally:
+        sock.close()
+
+
+class HandoffServer(object):
+    """
+    Serves listening sockets of `forwarder.ForwardServer` on unix socket
+    ``path``. ``callback`` is called once a new process confirmed that it
+    serves the listeners, server should stop accepting then.
+    """
+    def __init__(self, server, path, callback, io_loop=None):
+        self.server = server
+        self.path = path
+        self.callback = callback
+        self.io_loop = io_loop or IOLoop.current()
+        self._socket = None
+        self._connection = None
+        self._remove_accept_handler = None
+
+    def start(self):
+        """
+        Starts serving handoff, socket file of previous process is replaced.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        set_close_exec(sock.fileno())
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        sock.bind(self.path)
+        sock.listen(1)
+        sock.setblocking(False)
+        self._socket = sock
+        self._remove_accept_handler = add_accept_handler(sock, self._handle_connection)
+
+    def stop(self):
+        """
+        Stops serving handoff. Socket file is left, it belongs to the new process.
+        """
+        if self._socket:
+            if self._remove_accept_handler:
+                self._remove_accept_handler()
+                self._remove_accept_handler = None
+            else:
+                # tornado<5.0 doesn't return the remove function
+                self.io_loop.remove_handler(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+        self._close_connection()
+
+    def _handle_connection(self, connection, address):
+        if self._connection is not None:
+            logging.warning('Handoff is in progress already, rejecting another one')
+            connection.close()
+            return
+        logging.info('Handing off listening sockets to a new process')
+        self._connection = connection
+        try:
+            # The new process reads descriptors right away, so blocking
+            # is short even for a lot of listeners.
+            connection.settimeout(HANDOFF_TIMEOUT)
+            send_listeners(connection, self.server.get_listeners())
+            connection.setblocking(False)
+        except (IOError, OSError) as e:
+            logging.warning('Failed to hand off listening sockets: %s', e)
+            self._close_connection()
+            return
+        self.io_loop.add_handler(connection.fileno(), self._handle_confirm, IOLoop.READ)
+
+    def _handle_confirm(self, fd, events):
+        try:
+            data = self._connection.recv(MAX_MESSAGE)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if data != CONFIRM:
+            logging.warning('New process failed to take over listening sockets')
+            self._close_connection()
+            return
+        logging.info('New process serves listening sockets, stop accepting')
+        # Connection is closed last, it tells the new process that this
+        # one doesn't accept anymore.
+        self.callback()
+        self.stop()
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self.io_loop.remove_handler(self._connection.fileno())
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Forwardings statistics in Prometheus text format.
+
+Relay path is not instrumented per chunk: pumps already count transferred
+bytes for their connection, these counters are summed only when metrics
+are collected, and added to forwarding totals once connection is closed.
+"""
+import bisect
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_unix_socket
+from tornado.web import Application, RequestHandler
+
+from forwarder.ranges import PortRange
+
+
+CONNECT_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                            0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=CONNECT_DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Returns list of (upper bound, cumulative count) pairs, the last one is '+Inf'.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class ForwardingStats(object):
+    __slots__ = ('accepted', 'connect_failures', 'bytes_upstream', 'bytes_downstream', 'connect_duration',
+                 'throttled', 'timeouts', 'tls_handshakes', 'tls_resumed', 'tls_failures')
+
+    def __init__(self):
+        self.accepted = 0
+        self.throttled = {}  # Admission limit => number of times accepting was paused
+        self.timeouts = {}  # Timeout option name => number of connections closed by it
+        self.connect_failures = 0
+        self.bytes_upstream = 0  # From clients to backends
+        self.bytes_downstream = 0  # From backends to clients
+        self.connect_duration = Histogram()
+        self.tls_handshakes = 0  # Finished client handshakes, including resumed ones
+        self.tls_resumed = 0  # Handshakes which resumed a session
+        self.tls_failures = 0
+
+
+def get_transferred(connection):
+    """
+    Returns tuple of bytes sent by connection (upstream, downstream).
+    """
+    if not connection.pumps:
+        return 0, 0
+    downstream, upstream = connection.pumps
+    return upstream.transferred, downstream.transferred
+
+
+class Metrics(object):
+    """
+    Collects statistics of `forwarder.ForwardServer` forwardings.
+    """
+    def __init__(self, server):
+        self.server = server
+        self._stats = {}
+
+    def get(self, address):
+        stats = self._stats.get(address)
+        if stats is None:
+            stats = self._stats[address] = ForwardingStats()
+        return stats
+
+    def forget(self, address):
+        self._stats.pop(address, None)
+
+    def connection_opened(self, address):
+        self.get(address).accepted += 1
+
+    def connection_closed(self, connection):
+        upstream, downstream = get_transferred(connection)
+        self.add_transferred(connection.address, upstream, downstream)
+
+    def add_transferred(self, address, upstream, downstream):
+        stats = self.get(address)
+        stats.bytes_upstream += upstream
+        stats.bytes_downstream += downstream
+
+    def connect_finished(self, address, duration):
+        self.get(address).connect_duration.observe(duration)
+
+    def connect_failed(self, address):
+        self.get(address).connect_failures += 1
+
+    def timeout(self, address, name):
+        timeouts = self.get(address).timeouts
+        timeouts[name] = timeouts.get(name, 0) + 1
+
+    def tls_handshake(self, address, resumed):
+        stats = self.get(address)
+        stats.tls_handshakes += 1
+        if resumed:
+            stats.tls_resumed += 1
+
+    def tls_handshake_failed(self, address):
+        self.get(address).tls_failures += 1
+
+    def accept_throttled(self, address, limit):
+        throttled = self.get(address).throttled
+        throttled[limit] = throttled.get(limit, 0) + 1
+
+    def render(self):
+        """
+        Returns metrics in Prometheus text exposition format.
+        """
+        connections = self.server._connections
+        live = {}
+        for connection in connections:
+            upstream, downstream = get_transferred(connection)
+            totals = live.setdefault(connection.address, [0, 0])
+            totals[0] += upstream
+            totals[1] += downstream
+        # Ports of ranges are listed once they have statistics, so a wide
+        # range doesn't produce series for each of its ports.
+        addresses = set(key for key in self.server.conf if not isinstance(key[1], PortRange))
+        addresses.update(a for a in set(self._stats) | set(live) if self.server._ranges.lookup(a))
+        addresses = sorted(addresses)
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in values:
+                lines.append('{0}{{{1}}} {2}'.format(
+                    name, ','.join('{0}="{1}"'.format(k, v) for k, v in labels), value))
+
+        def label(address):
+            return ('listener', '{0}:{1}'.format(*address)),
+
+        metric('forwarder_connections_active', 'gauge', 'Active connections or UDP sessions.',
+               [(label(a), self.server.count_connections(a)) for a in addresses])
+        metric('forwarder_connections_total', 'counter', 'Accepted connections or opened UDP sessions.',
+               [(label(a), self.get(a).accepted) for a in addresses])
+        metric('forwarder_connect_failures_total', 'counter', 'Failed connects to backends.',
+               [(label(a), self.get(a).connect_failures) for a in addresses])
+        values = []
+        for a in addresses:
+            stats = self.get(a)
+            upstream, downstream = live.get(a, (0, 0))
+            values.append((label(a) + (('direction', 'upstream'),), stats.bytes_upstream + upstream))
+            values.append((label(a) + (('direction', 'downstream'),), stats.bytes_downstream + downstream))
+        metric('forwarder_bytes_total', 'counter', 'Relayed bytes.', values)
+        metric('forwarder_accept_throttled_total', 'counter',
+               'Times accepting was paused or a connection was refused, because admission limit was reached.',
+               [(label(a) + (('limit', limit),), count)
+                for a in addresses for limit, count in sorted(self.get(a).throttled.items())])
+        metric('forwarder_timeouts_total', 'counter', 'Connections closed by timeouts.',
+               [(label(a) + (('timeout', name),), count)
+                for a in addresses for name, count in sorted(self.get(a).timeouts.items())])
+        tls = [a for a in addresses if self.get(a).tls_handshakes or self.get(a).tls_failures]
+        values = []
+        for a in tls:
+            stats = self.get(a)
+            values.append((label(a) + (('session', 'new'),), stats.tls_handshakes - stats.tls_resumed))
+            values.append((label(a) + (('session', 'resumed'),), stats.tls_resumed))
+        metric('forwarder_tls_handshakes_total', 'counter', 'Finished TLS handshakes with clients.', values)
+        metric('forwarder_tls_handshake_failures_total', 'counter', 'Failed or timed out TLS handshakes with clients.',
+               [(label(a), self.get(a).tls_failures) for a in tls])
+
+        name = 'forwarder_connect_duration_seconds'
+        lines.append('# HELP {0} Backend connect duration.'.format(name))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for a in addresses:
+            histogram = self.get(a).connect_duration
+            listener = '{0}:{1}'.format(*a)
+            for bound, count in histogram.cumulative():
+                lines.append('{0}_bucket{{listener="{1}",le="{2}"}} {3}'.format(name, listener, bound, count))
+            lines.append('{0}_sum{{listener="{1}"}} {2}'.format(name, listener, histogram.sum))
+            lines.append('{0}_count{{listener="{1}"}} {2}'.format(name, listener, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(RequestHandler):
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.metrics.render())
+
+
+def start_metrics_server(metrics, port=None, address='127.0.0.1', unix_socket=None):
+    """
+    Starts HTTP server, which exposes ``metrics`` on TCP ``port`` or
+    ``unix_socket`` path at /metrics URL. Returns started `HTTPServer`.
+    """
+    app = Application([(r'/metrics', MetricsHandler, {'metrics': metrics})])
+    http_server = HTTPServer(app)
+    if unix_socket:
+        http_server.add_socket(bind_unix_socket(unix_socket))
+    else:
+        http_server.listen(port, address)
+    return http_server
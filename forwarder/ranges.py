@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Port range forwardings, such as ``10.0.0.1:8000-8999 => 10.0.0.2:9000-9999``.
+
+A range is kept in configuration as a single entry keyed by (addr, `PortRange`),
+listeners of its ports are found with a binary search in `RangeIndex`.
+"""
+import bisect
+
+
+class PortRange(object):
+    """
+    Inclusive range of ports from ``first`` to ``last``.
+    """
+    __slots__ = ('first', 'last')
+
+    def __init__(self, first, last):
+        if not 0 < first <= last < 65536:
+            raise ValueError('Bad port range: {0}-{1}'.format(first, last))
+        self.first = first
+        self.last = last
+
+    def __eq__(self, other):
+        if not isinstance(other, PortRange):
+            return NotImplemented
+        return self.first == other.first and self.last == other.last
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        return hash((self.first, self.last))
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    def __iter__(self):
+        return iter(range(self.first, self.last + 1))
+
+    def __contains__(self, port):
+        return self.first <= port <= self.last
+
+    def __repr__(self):
+        return 'PortRange({0}, {1})'.format(self.first, self.last)
+
+    def __str__(self):
+        return '{0}-{1}'.format(self.first, self.last)
+
+
+def parse_port(value):
+    """
+    Converts port or ``first-last`` string to int or `PortRange`.
+    """
+    if '-' in value:
+        first, last = value.split('-', 1)
+        return PortRange(int(first), int(last))
+    return int(value)
+
+
+def resolve_port(port, listener, listen_port):
+    """
+    Returns backend port for ``listen_port`` of ``listener`` range. Backend
+    range ports follow listener ports in order, a single port is shared by all.
+    """
+    if isinstance(port, PortRange):
+        return port.first + listen_port - listener.first
+    return port
+
+
+def iter_listeners(conf):
+    """
+    Yields (addr, port) of every listener of ``conf`` with ranges expanded.
+    """
+    for addr, port in conf:
+        if isinstance(port, PortRange):
+            for p in port:
+                yield addr, p
+        else:
+            yield addr, port
+
+
+def find_overlap(conf):
+    """
+    Returns pair of keys of ``conf`` listening on the same port of the same
+    address, a range and a single port or two ranges, or None.
+    """
+    ports = {}
+    for addr, port in conf:
+        first, last = (port.first, port.last) if isinstance(port, PortRange) else (port, port)
+        ports.setdefault(addr, []).append((first, last, (addr, port)))
+    for items in ports.values():
+        items.sort(key=lambda item: item[:2])
+        widest = None  # Item reaching the highest port so far
+        for item in items:
+            if widest is not None and item[0] <= widest[1]:
+                return widest[2], item[2]
+            if widest is None or item[1] > widest[1]:
+                widest = item
+    return None
+
+
+class RangeIndex(object):
+    """
+    Finds port range forwarding of a listener address in O(log n) time.
+    Ranges of an address must not overlap, see `find_overlap`.
+    """
+    def __init__(self, conf):
+        ranges = {}
+        for (addr, port), forwarding in conf.items():
+            if isinstance(port, PortRange):
+                ranges.setdefault(addr, []).append((port.first, port, forwarding))
+        self._index = {}  # addr => (sorted first ports, ranges, forwardings)
+        for addr, items in ranges.items():
+            items.sort(key=lambda item: item[0])
+            self._index[addr] = tuple(list(column) for column in zip(*items))
+
+    def __len__(self):
+        return sum(len(index[0]) for index in self._index.values())
+
+    def lookup(self, address):
+        """
+        Returns tuple (`PortRange`, forwarding) of range containing
+        ``address`` port or None.
+        """
+        index = self._index.get(address[0])
+        if index is None:
+            return None
+        firsts, ranges, forwardings = index
+        i = bisect.bisect_right(firsts, address[1]) - 1
+        if i >= 0 and address[1] in ranges[i]:
+            return ranges[i], forwardings[i]
+        return None
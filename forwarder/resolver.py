@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Resolution of backend host names off the IOLoop thread.
+
+Names are resolved with ``getaddrinfo`` in a thread pool and cached for
+``ttl`` seconds. A name used after most of its TTL passed is resolved again
+in background, so names in use are served from cache without waiting. Only
+one lookup of a name runs at a time, connections waiting for it share the
+result. Numeric addresses are returned at once.
+"""
+import functools
+import logging
+import socket
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+from forwarder.utils import is_ipv4_address
+
+
+DEFAULT_DNS_TTL = 60.0
+DEFAULT_RESOLVER_THREADS = 4
+REFRESH_SHARE = 0.75  # Share of TTL after which a used name is resolved again in background
+FAILURE_TTL = 1.0  # Seconds failed resolution is cached, so lookups don't pile up
+
+_default_resolver = None
+
+
+def get_default_resolver():
+    """
+    Returns resolver shared by pools created without one.
+    """
+    global _default_resolver
+    if _default_resolver is None:
+        _default_resolver = CachedResolver()
+    return _default_resolver
+
+
+def getaddrinfo(host):
+    """
+    Returns list of IPv4 addresses of ``host`` in order of ``getaddrinfo`` preference.
+    """
+    addresses = []
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses
+
+
+class CacheEntry(object):
+    __slots__ = ('addresses', 'resolved', 'expires')
+
+    def __init__(self, addresses, resolved, expires):
+        self.addresses = addresses
+        self.resolved = resolved
+        self.expires = expires
+
+
+class CachedResolver(object):
+    """
+    Resolves host names in ``threads`` threads and caches them for ``ttl`` seconds.
+    """
+    def __init__(self, ttl=DEFAULT_DNS_TTL, threads=DEFAULT_RESOLVER_THREADS):
+        self.ttl = ttl
+        self.threads = threads
+        self._executor = None  # Started on first lookup, most configurations don't need it
+        self._cache = {}  # Host name => `CacheEntry`
+        self._pending = {}  # Host name => list of callbacks waiting for lookup
+
+    def get_cached(self, host, port):
+        """
+        Returns list of (addr, port) addresses of ``host`` if it is known
+        already, otherwise starts resolving it and returns None. An empty
+        list is returned if the name failed to resolve recently.
+        """
+        if is_ipv4_address(host):
+            return [(host, port)]
+        entry = self._cache.get(host)
+        now = IOLoop.current().time()
+        if entry is None or now >= entry.expires:
+            self._lookup(host)
+            return None
+        if entry.addresses and now - entry.resolved >= self.ttl * REFRESH_SHARE:
+            self._lookup(host)
+        return [(addr, port) for addr in entry.addresses]
+
+    def resolve(self, host, port, callback):
+        """
+        Calls ``callback`` with list of (addr, port) addresses of ``host``,
+        the list is empty if the name can't be resolved. Callback is called
+        at once if the address is known already.
+        """
+        addresses = self.get_cached(host, port)
+        if addresses is None:
+            self._pending[host].append(lambda found: callback([(addr, port) for addr in found]))
+        else:
+            callback(addresses)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _lookup(self, host):
+        if host in self._pending:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads)
+        self._pending[host] = []
+        io_loop = IOLoop.current()
+        io_loop.add_future(self._executor.submit(getaddrinfo, host),
+                           functools.partial(self._on_resolved, io_loop, host))
+
+    def _on_resolved(self, io_loop, host, future):
+        callbacks = self._pending.pop(host, [])
+        now = io_loop.time()
+        entry = self._cache.get(host)
+        try:
+            addresses = future.result()
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, 'No IPv4 address')
+        except (socket.error, UnicodeError) as e:
+            logging.warning('Failed to resolve %s: %s', host, e)
+            if entry is None or now >= entry.expires:
+                # Stale addresses are kept until they expire.
+                entry = self._cache[host] = CacheEntry([], now, now + FAILURE_TTL)
+        else:
+            entry = self._cache[host] = CacheEntry(addresses, now, now + self.ttl)
+        for callback in callbacks:
+            callback(entry.addresses)
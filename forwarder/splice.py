@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Zero-copy relay engine. Data is moved between client and backend sockets
+with splice(2) through a pipe, so it never gets into python objects.
+Requires Linux and python>=3.10 (``os.splice``).
+"""
+import errno
+import fcntl
+import functools
+import logging
+import os
+import socket
+
+from tornado.ioloop import IOLoop
+
+from forwarder.utils import create_socket
+
+
+SPLICE_AVAILABLE = hasattr(os, 'splice') and hasattr(os, 'pipe2')
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+# Linux specific fcntl commands, not exported by fcntl module before python 3.10.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+_ERRNO_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+_ERRNO_INPROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK)
+
+
+class SplicePump(object):
+    """
+    Moves data from ``source`` socket to ``destination`` socket through
+    a pipe. Amount of data buffered in the kernel for a slow destination
+    is limited by pipe size, so reading from source stops when the pipe is full.
+    """
+    def __init__(self, source, destination, pipe_size):
+        self.source = source
+        self.destination = destination
+        self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            fcntl.fcntl(self.pipe_w, F_SETPIPE_SZ, pipe_size)
+        except (IOError, OSError):
+            pass  # Not permitted to grow pipe above /proc/sys/fs/pipe-max-size
+        self.pipe_size = fcntl.fcntl(self.pipe_w, F_GETPIPE_SZ)
+        self.pending = 0  # Bytes in the pipe
+        self.eof = False
+        self.transferred = 0
+
+    @property
+    def paused(self):
+        return self.pending >= self.pipe_size
+
+    def want_read(self):
+        return not self.eof and not self.paused
+
+    def want_write(self):
+        return self.pending > 0
+
+    def done(self):
+        return self.eof and not self.pending
+
+    def handle_read(self):
+        """
+        Moves available data from source socket into the pipe and tries
+        to push it further to destination.
+        """
+        try:
+            size = os.splice(self.source.fileno(), self.pipe_w, self.pipe_size - self.pending,
+                             flags=SPLICE_FLAGS)
+        except (IOError, OSError) as e:
+            if e.errno not in _ERRNO_WOULDBLOCK:
+                raise
+        else:
+            if size == 0:
+                self.eof = True
+            self.pending += size
+            self.transferred += size
+        self.handle_write()
+
+    def handle_write(self):
+        """
+        Moves data from the pipe to destination socket.
+        """
+        while self.pending:
+            try:
+                size = os.splice(self.pipe_r, self.destination.fileno(), self.pending,
+                                 flags=SPLICE_FLAGS)
+            except (IOError, OSError) as e:
+                if e.errno in _ERRNO_WOULDBLOCK:
+                    return
+                raise
+            self.pending -= size
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class SpliceConnection(object):
+    """
+    Same as `forwarder.ForwardConnection`, but relays data with `SplicePump`.
+    Works only for plain TCP streams.
+    """
+    def __init__(self, server, stream, address):
+        # Use client socket directly, IOStream is never started.
+        self._close_callback = None
+        self._closed = False
+        self.server = server
+        self.io_loop = getattr(server, 'io_loop', None) or IOLoop.current()
+        self.socket = stream.socket
+        self.reverse_address = address
+        self.opened_at = self.io_loop.time()
+        self.address = self.socket.getsockname()
+        self.pool = server.get_pool(self.address)
+        self.options = server.get_options(self.address)
+        self.remote_address = None
+        self.remote_socket = None
+        self.pumps = []
+        self._handlers = {}
+        self._tried_backends = []
+        self._addresses = []  # Resolved addresses of the backend left to try
+        self._connect_started = None
+        self.half_closed_at = None  # Time when one of peers closed connection
+        self._add_handler(self.socket, self._handle_client_events, IOLoop.READ)
+        warm = server.get_warm_connection(self.address)
+        if warm:
+            self.remote_socket, self.remote_address = warm
+            self._tried_backends.append(self.remote_address)
+            self.pool.connection_opened(self.remote_address)
+            self._add_handler(self.remote_socket, self._handle_events, IOLoop.READ)
+            self._on_remote_connected()
+        elif not self._connect(self.pool.select()):
+            # Let the server set close callback first.
+            self.io_loop.add_callback(self.close)
+
+    def _connect(self, backend):
+        """
+        Starts connecting to ``backend``, on failure tries other backends
+        of the pool. Returns False if there is no backend to connect to.
+        """
+        if backend is None:
+            return False
+        self._connect_started = self.io_loop.time()
+        self.remote_address = backend
+        self._tried_backends.append(backend)
+        self.pool.connection_opened(backend)
+        self.pool.resolver.resolve(backend[0], backend[1], functools.partial(self._on_resolved, backend))
+        return True
+
+    def _on_resolved(self, backend, addresses):
+        if self._closed or backend != self.remote_address:
+            return
+        if not addresses:
+            self._on_connect_error('name is not resolved')
+            return
+        self._addresses = addresses
+        self._connect_next()
+
+    def _connect_next(self):
+        """
+        Starts connecting to the next address of the backend.
+        """
+        self.remote_socket = create_socket(self.options)
+        err = self.remote_socket.connect_ex(self._addresses.pop(0))
+        if not err or err in _ERRNO_INPROGRESS:
+            self._add_handler(self.remote_socket, self._handle_connect, IOLoop.WRITE)
+        else:
+            self._on_connect_error(os.strerror(err))
+
+    def _on_connect_error(self, reason):
+        """
+        Tries other addresses of the backend, then other backends.
+        Closes connection if there is nothing left to try.
+        """
+        logging.warning('Failed to connect to %s:%s: %s', self.remote_address[0], self.remote_address[1], reason)
+        if self.remote_socket:
+            self.remote_socket.close()
+            self.remote_socket = None
+        if self._addresses:
+            self._connect_next()
+            return
+        self.pool.report_failure(self.remote_address)
+        self.server.metrics.connect_failed(self.address)
+        backend = self.pool.select(exclude=self._tried_backends)
+        if backend is None:
+            # Let the server set close callback first, if called from constructor.
+            self.io_loop.add_callback(self.close)
+            return
+        self.pool.connection_closed(self.remote_address)
+        self._connect(backend)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for fd in self._handlers:
+            self.io_loop.remove_handler(fd)
+        self._handlers.clear()
+        for pump in self.pumps:
+            pump.close()
+        self.socket.close()
+        if self.remote_socket:
+            self.remote_socket.close()
+        self.pool.connection_closed(self.remote_address)
+        if self._close_callback:
+            self._close_callback(self)
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def _add_handler(self, sock, handler, events):
+        self._handlers[sock.fileno()] = events
+        self.io_loop.add_handler(sock.fileno(), handler, events)
+
+    def _update_handler(self, sock, events):
+        fd = sock.fileno()
+        if self._handlers.get(fd) != events:
+            self._handlers[fd] = events
+            self.io_loop.update_handler(fd, events)
+
+    def _handle_client_events(self, fd, events):
+        if self.pumps:
+            self._handle_events(fd, events)
+            return
+        # Backend connection is not established yet. Close connection if
+        # client disconnected, data sent by client waits in socket buffer.
+        try:
+            closed = not self.socket.recv(1, socket.MSG_PEEK)
+        except (IOError, OSError) as e:
+            closed = e.errno not in _ERRNO_WOULDBLOCK
+        if closed or events & IOLoop.ERROR:
+            self.close()
+        else:
+            self._update_handler(self.socket, 0)
+
+    def _handle_connect(self, fd, events):
+        err = self.remote_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.io_loop.remove_handler(fd)
+            del self._handlers[fd]
+            self._on_connect_error(os.strerror(err))
+            return
+        self.pool.report_success(self.remote_address)
+        self.server.metrics.connect_finished(self.address, self.io_loop.time() - self._connect_started)
+        self.io_loop.remove_handler(fd)
+        self._add_handler(self.remote_socket, self._handle_events, IOLoop.READ)
+        self._on_remote_connected()
+
+    def _on_remote_connected(self):
+        pipe_size = self.server.high_water_mark
+        self.pumps = [
+            SplicePump(self.remote_socket, self.socket, pipe_size),
+            SplicePump(self.socket, self.remote_socket, pipe_size),
+        ]
+        self._handle_events(self.remote_socket.fileno(), 0)
+
+    def _handle_events(self, fd, events):
+        remote_pump, client_pump = self.pumps
+        try:
+            for sock, pump in ((self.remote_socket, remote_pump), (self.socket, client_pump)):
+                if sock.fileno() == fd:
+                    if events & IOLoop.READ:
+                        pump.handle_read()
+                else:
+                    if events & IOLoop.WRITE:
+                        pump.handle_write()
+        except (IOError, OSError) as e:
+            logging.debug('Splice relay error: %s', e)
+            self.close()
+            return
+        if events & IOLoop.ERROR or remote_pump.done() or client_pump.done():
+            # Same as ForwardConnection, EOF on one side closes whole
+            # connection after data for the other side is flushed.
+            self.close()
+            return
+        if self.half_closed_at is None and (remote_pump.eof or client_pump.eof):
+            self.half_closed_at = self.io_loop.time()
+        for sock, pump, other in ((self.remote_socket, remote_pump, client_pump),
+                                  (self.socket, client_pump, remote_pump)):
+            events = IOLoop.ERROR
+            if pump.want_read():
+                events |= IOLoop.READ
+            if other.want_write():
+                events |= IOLoop.WRITE
+            self._update_handler(sock, events)
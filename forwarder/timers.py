@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Cheap timers for a lot of connections.
+"""
+import math
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+class Timer(object):
+    __slots__ = ('tick', 'callback', 'args')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel(object):
+    """
+    Hashed timing wheel. Timers are put into one of ``slots`` buckets by
+    their deadline tick and a single periodic callback runs due timers every
+    ``resolution`` seconds, so adding and cancelling a timer is O(1) and
+    doesn't touch IOLoop timeouts heap. Timers run up to ``resolution``
+    seconds late.
+    """
+    def __init__(self, resolution=0.1, slots=1024, io_loop=None):
+        self.resolution = resolution
+        self.io_loop = io_loop or IOLoop.current()
+        self._wheel = [set() for _ in range(slots)]
+        self._start = self.io_loop.time()
+        self._tick = 0  # Last processed tick
+        self._count = 0
+        self._ticker = None
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """
+        Runs ``callback(*args)`` after ``delay`` seconds. Returns `Timer`,
+        which may be passed to `cancel`.
+        """
+        elapsed = self.io_loop.time() - self._start
+        tick = max(self._tick + 1, int(math.ceil((elapsed + delay) / self.resolution)))
+        timer = Timer(tick, callback, args)
+        self._wheel[tick % len(self._wheel)].add(timer)
+        self._count += 1
+        if self._ticker is None:
+            self._ticker = PeriodicCallback(self._run, self.resolution * 1000)
+            self._ticker.start()
+        return timer
+
+    def cancel(self, timer):
+        bucket = self._wheel[timer.tick % len(self._wheel)]
+        if timer in bucket:
+            bucket.remove(timer)
+            self._count -= 1
+
+    def stop(self):
+        for bucket in self._wheel:
+            bucket.clear()
+        self._count = 0
+        self._stop_ticker()
+
+    def _stop_ticker(self):
+        if self._ticker is not None:
+            self._ticker.stop()
+            self._ticker = None
+
+    def _run(self):
+        now = int((self.io_loop.time() - self._start) / self.resolution)
+        # Catch up with ticks missed by a busy loop, but don't walk the
+        # whole wheel more than once.
+        first = max(self._tick + 1, now - len(self._wheel) + 1)
+        self._tick = now
+        for tick in range(first, now + 1):
+            bucket = self._wheel[tick % len(self._wheel)]
+            due = [timer for timer in bucket if timer.tick <= now]
+            for timer in due:
+                bucket.remove(timer)
+                self._count -= 1
+            for timer in due:
+                timer.callback(*timer.args)
+        if not self._count:
+            self._stop_ticker()
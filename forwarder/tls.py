@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+TLS termination and origination for forwardings with ``tls_*`` options.
+
+SSL contexts are shared by forwardings with the same settings and kept
+across configuration reloads, so server session cache and session ticket
+keys survive them and returning clients resume sessions. A context is
+created again when its certificate or key file changes.
+
+Server handshakes are performed by `Handshaker`. Its steps, which do the
+expensive public key operations, may run in a thread pool, OpenSSL releases
+GIL meanwhile. Waiting for peer data is done by IOLoop between the steps,
+so slow clients don't hold threads.
+"""
+import functools
+import logging
+import os
+import socket
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+
+TLS_AVAILABLE = hasattr(ssl, 'SSLContext') and hasattr(ssl, 'SSLWantReadError')
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0
+
+
+def file_stamps(*paths):
+    """
+    Returns modification times of existing ``paths``.
+    """
+    stamps = []
+    for path in paths:
+        try:
+            stamps.append(os.stat(path).st_mtime if path else None)
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def get_server_settings(options):
+    """
+    Returns tuple of server context settings of forwarding ``options``
+    or None if forwarding doesn't terminate TLS.
+    """
+    if 'tls_cert' not in options:
+        return None
+    return 'server', options['tls_cert'], options.get('tls_key'), options.get('tls_ciphers')
+
+
+def get_client_settings(options):
+    """
+    Returns tuple of upstream context settings of forwarding ``options``
+    or None if connections to backends are not encrypted.
+    """
+    if not options.get('tls_upstream'):
+        return None
+    return 'client', options.get('tls_upstream_ca'), options.get('tls_upstream_verify', True), None
+
+
+def get_files(settings):
+    """
+    Returns paths of files used by context with ``settings``.
+    """
+    return settings[1:3] if settings[0] == 'server' else settings[1:2]
+
+
+def create_context(settings):
+    kind, path, value, ciphers = settings
+    if kind == 'server':
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        if ciphers:
+            # Before the certificate, security level of cipher list applies to its key
+            context.set_ciphers(ciphers)
+        context.load_cert_chain(path, value)
+    else:
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=path)
+        if not value:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class TLSContexts(object):
+    """
+    SSL contexts of forwardings indexed by their settings.
+    """
+    def __init__(self):
+        self._contexts = {}  # Settings => (files stamps, context or None if it failed to load)
+
+    def get_server_context(self, options):
+        return self._get(get_server_settings(options))
+
+    def get_client_context(self, options):
+        return self._get(get_client_settings(options))
+
+    def _get(self, settings):
+        if settings is None:
+            return None
+        item = self._contexts.get(settings)
+        if item is None:
+            item = self._contexts[settings] = self._load(settings)
+        return item[1]
+
+    def _load(self, settings):
+        stamps = file_stamps(*get_files(settings))
+        try:
+            return stamps, create_context(settings)
+        except (IOError, OSError, ssl.SSLError, ValueError) as e:
+            logging.warning('Failed to load TLS settings %s: %s', ', '.join(p for p in get_files(settings) if p), e)
+            return stamps, None
+
+    def update(self, options):
+        """
+        Keeps contexts of forwardings ``options`` list only. Contexts which
+        files were changed are loaded again.
+        """
+        used = set()
+        for o in options:
+            used.add(get_server_settings(o))
+            used.add(get_client_settings(o))
+        for settings in list(self._contexts):
+            if settings not in used:
+                del self._contexts[settings]
+        for settings in used:
+            if settings is None:
+                continue
+            item = self._contexts.get(settings)
+            if item is None or item[0] != file_stamps(*get_files(settings)):
+                self._contexts[settings] = self._load(settings)
+
+
+def handshake_step(sock):
+    """
+    Continues handshake of non-blocking SSL ``sock``. Returns IOLoop events
+    to wait for before the next step or None when handshake is finished.
+    """
+    try:
+        sock.do_handshake()
+    except ssl.SSLWantReadError:
+        return IOLoop.READ
+    except ssl.SSLWantWriteError:
+        return IOLoop.WRITE
+    return None
+
+
+class Handshake(object):
+    __slots__ = ('socket', 'callback', 'key', 'timeout', 'waiting', 'expired', 'cancelled')
+
+    def __init__(self, sock, callback, key=None):
+        self.socket = sock
+        self.callback = callback
+        self.key = key
+        self.timeout = None
+        self.waiting = False  # Waits for socket events on IOLoop
+        self.expired = False
+        self.cancelled = False
+
+
+class Handshaker(object):
+    """
+    Performs server side handshakes of SSL sockets in ``threads`` threads,
+    or on IOLoop thread if ``threads`` is 0. Handshakes not finished in
+    ``timeout`` seconds fail.
+    """
+    def __init__(self, threads=0, timeout=DEFAULT_HANDSHAKE_TIMEOUT, io_loop=None):
+        self.threads = threads
+        self.timeout = timeout
+        self.io_loop = io_loop or IOLoop.current()
+        self._executor = ThreadPoolExecutor(threads) if threads else None
+        self._pending = {}  # Key => set of handshakes in progress
+
+    def handshake(self, sock, callback, key=None):
+        """
+        Starts handshake of ``sock``. ``callback`` is called with the socket
+        and None on success, or with the socket and error on failure, the
+        socket is closed then. Handshakes in progress are counted and
+        cancelled by ``key``.
+        """
+        handshake = Handshake(sock, callback, key)
+        self._pending.setdefault(key, set()).add(handshake)
+        handshake.timeout = self.io_loop.call_later(self.timeout, self._expire, handshake)
+        self._step(handshake)
+
+    def count(self, key=None):
+        """
+        Returns number of handshakes in progress started with ``key`` or all
+        of them if ``key`` is None.
+        """
+        if key is None:
+            return sum(len(pending) for pending in self._pending.values())
+        return len(self._pending.get(key, ()))
+
+    def cancel(self, key=None):
+        """
+        Closes sockets of handshakes in progress started with ``key`` or all
+        of them if ``key`` is None. Their callbacks are not called.
+        """
+        for k in (list(self._pending) if key is None else [key]):
+            for handshake in self._pending.pop(k, ()):
+                handshake.cancelled = True
+                if handshake.timeout is not None:
+                    self.io_loop.remove_timeout(handshake.timeout)
+                    handshake.timeout = None
+                if handshake.waiting:
+                    handshake.waiting = False
+                    self.io_loop.remove_handler(handshake.socket.fileno())
+                    handshake.socket.close()
+                # Otherwise socket is closed once the step running in a thread returns.
+
+    def stop(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _step(self, handshake):
+        if self._executor is None:
+            try:
+                events = handshake_step(handshake.socket)
+            except (ssl.SSLError, socket.error) as e:
+                self._finish(handshake, e)
+            else:
+                self._continue(handshake, events)
+            return
+        future = self._executor.submit(handshake_step, handshake.socket)
+        self.io_loop.add_future(future, functools.partial(self._on_step, handshake))
+
+    def _on_step(self, handshake, future):
+        if handshake.cancelled:
+            handshake.socket.close()
+            return
+        if handshake.expired:
+            self._finish(handshake, socket.timeout('TLS handshake timed out'))
+            return
+        try:
+            events = future.result()
+        except (ssl.SSLError, socket.error) as e:
+            self._finish(handshake, e)
+        else:
+            self._continue(handshake, events)
+
+    def _continue(self, handshake, events):
+        if events is None:
+            self._finish(handshake, None)
+            return
+        handshake.waiting = True
+        self.io_loop.add_handler(handshake.socket.fileno(),
+                                 lambda fd, events: self._on_events(handshake), events | IOLoop.ERROR)
+
+    def _on_events(self, handshake):
+        handshake.waiting = False
+        self.io_loop.remove_handler(handshake.socket.fileno())
+        self._step(handshake)
+
+    def _expire(self, handshake):
+        handshake.timeout = None
+        handshake.expired = True
+        if handshake.waiting:
+            # Otherwise the step running in a thread finishes handshake.
+            handshake.waiting = False
+            self.io_loop.remove_handler(handshake.socket.fileno())
+            self._finish(handshake, socket.timeout('TLS handshake timed out'))
+
+    def _finish(self, handshake, error):
+        pending = self._pending.get(handshake.key)
+        if pending is not None:
+            pending.discard(handshake)
+            if not pending:
+                del self._pending[handshake.key]
+        if handshake.timeout is not None:
+            self.io_loop.remove_timeout(handshake.timeout)
+            handshake.timeout = None
+        if error is not None:
+            handshake.socket.close()
+        handshake.callback(handshake.socket, error)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+UDP forwardings. Datagrams of each client address are relayed through its
+own upstream socket connected to a backend, so replies are routed back
+to the client.
+"""
+import collections
+import errno
+import logging
+import socket
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.platform.auto import set_close_exec
+
+from forwarder.utils import create_socket, set_socket_options
+
+
+DEFAULT_UDP_IDLE_TIMEOUT = 30.0
+DEFAULT_MAX_SESSIONS = 10000
+DATAGRAM_BATCH = 64  # Datagrams received at once, so other sockets are not starved
+MAX_DATAGRAM = 65535
+
+_ERRNO_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# ICMP errors of earlier datagrams, reported once and not blocking the next ones
+_ERRNO_ICMP = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def bind_udp_socket(port, address, reuse_port=False):
+    """
+    Returns non-blocking UDP socket bound to ``address`` and ``port``.
+    """
+    family, kind, proto, _, sockaddr = socket.getaddrinfo(address, port, socket.AF_UNSPEC, socket.SOCK_DGRAM,
+                                                          0, socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, kind, proto)
+    try:
+        set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind(sockaddr)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def _touch(sessions, client):
+    """
+    Moves session of ``client`` to the end of ``sessions`` ordered dict.
+    """
+    if hasattr(sessions, 'move_to_end'):
+        sessions.move_to_end(client)
+    else:
+        # python2
+        sessions[client] = sessions.pop(client)
+
+
+class UDPSession(object):
+    """
+    Datagrams flow of one client.
+    """
+    __slots__ = ('client', 'backend', 'socket', 'active', 'bytes_upstream', 'bytes_downstream')
+
+    def __init__(self, client, backend, sock, now):
+        self.client = client
+        self.backend = backend
+        self.socket = sock
+        self.active = now  # Time of the last datagram from client
+        self.bytes_upstream = 0
+        self.bytes_downstream = 0
+
+
+class UDPForwarding(object):
+    """
+    Relays datagrams received on listening ``sock`` to backends of
+    `forwarder.balancer.BackendPool`.
+
+    Sessions are kept in order of client activity, so idle ones are found
+    without scanning the whole table. Sessions idle for ``idle_timeout``
+    seconds are closed, and the least active session is closed to open a
+    new one when there are ``max_sessions`` of them. Datagrams are read
+    until socket buffer is empty, up to `DATAGRAM_BATCH` per event, and
+    are dropped if a socket can't send them at once.
+    """
+    def __init__(self, server, sock, pool, options=None):
+        self.server = server
+        self.io_loop = getattr(server, 'io_loop', None) or IOLoop.current()
+        self.socket = sock
+        self.address = sock.getsockname()[:2]
+        self.pool = pool
+        self.sessions = collections.OrderedDict()  # Client address => `UDPSession`, least active first
+        self.receiving = False
+        self.dropped = 0  # Datagrams which couldn't be sent
+        self._buffer = memoryview(bytearray(MAX_DATAGRAM))
+        self._sweeper = None
+        self.update(options)
+        self.start()
+
+    def update(self, options=None):
+        self.options = options or {}
+        self.max_sessions = self.options.get('max_sessions', DEFAULT_MAX_SESSIONS)
+        idle_timeout = self.options.get('idle_timeout', DEFAULT_UDP_IDLE_TIMEOUT)
+        if self._sweeper and self.idle_timeout != idle_timeout:
+            self._sweeper.stop()
+            self._sweeper = None
+        self.idle_timeout = idle_timeout
+        if not self._sweeper:
+            self._sweeper = PeriodicCallback(self._sweep, max(idle_timeout / 2.0, 0.1) * 1000)
+            self._sweeper.start()
+        set_socket_options(self.socket, self.options)
+        while len(self.sessions) > self.max_sessions:
+            self._close_session(next(iter(self.sessions.values())))
+
+    def start(self):
+        if not self.receiving:
+            self.receiving = True
+            self.io_loop.add_handler(self.socket.fileno(), self._handle_datagrams, IOLoop.READ)
+
+    def stop_receiving(self):
+        """
+        Stops receiving datagrams from clients, replies are still relayed.
+        """
+        if self.receiving:
+            self.receiving = False
+            self.io_loop.remove_handler(self.socket.fileno())
+
+    def stop(self):
+        self.stop_receiving()
+        if self._sweeper:
+            self._sweeper.stop()
+            self._sweeper = None
+        self.close_sessions()
+
+    def close_sessions(self, backends=None):
+        """
+        Closes sessions. If ``backends`` is set, only sessions relayed to
+        these backends are closed.
+        """
+        for session in list(self.sessions.values()):
+            if backends is None or session.backend in backends:
+                self._close_session(session)
+
+    def _open_session(self, client, now):
+        backend = self.pool.select()
+        # Datagrams are dropped until backend name is resolved, clients resend them.
+        addresses = self.pool.resolver.get_cached(backend[0], backend[1])
+        if not addresses:
+            return None
+        if len(self.sessions) >= self.max_sessions:
+            self._close_session(next(iter(self.sessions.values())))
+        sock = create_socket(self.options, socket.SOCK_DGRAM)
+        try:
+            sock.connect(addresses[0])
+        except socket.error as e:
+            logging.warning('Failed to connect to %s:%s: %s', backend[0], backend[1], e)
+            sock.close()
+            return None
+        session = self.sessions[client] = UDPSession(client, backend, sock, now)
+        self.pool.connection_opened(backend)
+        self.server.metrics.connection_opened(self.address)
+        self.io_loop.add_handler(sock.fileno(), lambda fd, events: self._handle_replies(session), IOLoop.READ)
+        return session
+
+    def _close_session(self, session):
+        if self.sessions.pop(session.client, None) is None:
+            return
+        self.io_loop.remove_handler(session.socket.fileno())
+        session.socket.close()
+        self.pool.connection_closed(session.backend)
+        self.server.on_session_closed(self, session)
+
+    def _handle_datagrams(self, fd, events):
+        now = self.io_loop.time()
+        buf = self._buffer
+        for _ in range(DATAGRAM_BATCH):
+            try:
+                size, client = self.socket.recvfrom_into(buf)
+            except socket.error as e:
+                if e.errno in _ERRNO_WOULDBLOCK:
+                    return
+                logging.debug('UDP receive error on %s:%s: %s', self.address[0], self.address[1], e)
+                if e.errno in _ERRNO_ICMP:
+                    # ICMP errors of sent replies are reported on next calls
+                    continue
+                return
+            session = self.sessions.get(client)
+            if session is None:
+                session = self._open_session(client, now)
+                if session is None:
+                    continue
+            elif session.active != now:
+                session.active = now
+                _touch(self.sessions, client)
+            try:
+                session.socket.send(buf[:size])
+            except socket.error as e:
+                self.dropped += 1
+                if e.errno not in _ERRNO_WOULDBLOCK:
+                    logging.debug('UDP send error to %s:%s: %s', session.backend[0], session.backend[1], e)
+            else:
+                session.bytes_upstream += size
+
+    def _handle_replies(self, session):
+        buf = self._buffer
+        for _ in range(DATAGRAM_BATCH):
+            try:
+                size = session.socket.recv_into(buf)
+            except socket.error as e:
+                if e.errno in _ERRNO_WOULDBLOCK:
+                    return
+                logging.debug('UDP receive error from %s:%s: %s', session.backend[0], session.backend[1], e)
+                if e.errno in _ERRNO_ICMP:
+                    # Backend port is closed, the next datagram may be delivered
+                    continue
+                return
+            try:
+                self.socket.sendto(buf[:size], session.client)
+            except socket.error as e:
+                self.dropped += 1
+                if e.errno not in _ERRNO_WOULDBLOCK:
+                    logging.debug('UDP send error to %s:%s: %s', session.client[0], session.client[1], e)
+            else:
+                session.bytes_downstream += size
+
+    def _sweep(self):
+        deadline = self.io_loop.time() - self.idle_timeout
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.active > deadline:
+                break
+            self._close_session(session)
@@ -1,4 +1,119 @@
 # -*- coding: utf-8 -*-
+import socket
+import time
+
+from tornado.platform.auto import set_close_exec
+
+
+# Forwarding options, which are set on listening and upstream sockets.
+# Each option name is mapped to (level, option name).
+SOCKET_OPTIONS = {
+    'nodelay': (socket.IPPROTO_TCP, socket.TCP_NODELAY),
+    'keepalive': (socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+    'rcvbuf': (socket.SOL_SOCKET, socket.SO_RCVBUF),
+    'sndbuf': (socket.SOL_SOCKET, socket.SO_SNDBUF),
+}
+
+
+def set_socket_options(sock, options):
+    """
+    Sets socket options from forwarding ``options`` dict on ``sock``.
+    Buffer sizes must be set before connect or listen to affect TCP window.
+    """
+    for name, (level, optname) in SOCKET_OPTIONS.items():
+        if name in options:
+            sock.setsockopt(level, optname, int(options[name]))
+
+
+def create_socket(options=None, kind=socket.SOCK_STREAM):
+    """
+    Returns a new non-blocking TCP or ``kind`` socket with forwarding ``options`` set.
+    """
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.setblocking(False)
+    set_socket_options(sock, options or {})
+    return sock
+
+
+def is_ipv4_address(address):
+    try:
+        socket.inet_pton(socket.AF_INET, address)
+    except (socket.error, ValueError):
+        return False
+    return True
+
+
+def bind_ipv4_socket(port, address, reuse_port=False, backlog=128):
+    """
+    Returns non-blocking TCP socket listening on numeric IPv4 ``address``.
+    Unlike `tornado.netutil.bind_sockets` doesn't resolve the address,
+    which takes most of the time when a lot of listeners are bound.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind((address, port))
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` events per second on average and bursts of up to
+    ``burst`` events (one second worth of events by default).
+    """
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, amount=1):
+        self._refill()
+        self.tokens -= amount
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes ``rate`` and ``burst`` keeping tokens consumed already.
+        """
+        self._refill()
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens = min(self.tokens, self.burst)
+
+    def delay(self, amount=1):
+        """
+        Returns seconds to wait until ``amount`` tokens are available.
+        """
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+def get_forwarding_str(addr_from, port_from, addr_to, port_to):
+    """
+    Returns log string for connection forwarding.
+    """
+    return "{addr_from}:{port_from} => {addr_to}:{port_to}".format(
+        addr_from=addr_from,
+        port_from=port_from,
+        addr_to=addr_to,
+        port_to=port_to
+    )
+
+
 class cached_property(object):
     """
     Decorator that caches method value.
@@ -39,3 +154,53 @@ class DictDiff(object):
         return set(o for o in self.intersect if self.new[o] == self.old[o])
 
 
+class ConnectionRegistry(object):
+    """
+    Set of active connections indexed by listener address. Each connection
+    must have ``address`` attribute - tuple (addr, port) of the listener
+    which accepted it. Adding and removing a connection takes O(1) time.
+    """
+    def __init__(self):
+        self._index = {}
+        self._count = 0
+
+    def add(self, connection):
+        connections = self._index.setdefault(connection.address, set())
+        if connection not in connections:
+            connections.add(connection)
+            self._count += 1
+
+    def remove(self, connection):
+        connections = self._index.get(connection.address)
+        if connections is None or connection not in connections:
+            raise KeyError(connection)
+        connections.remove(connection)
+        self._count -= 1
+        if not connections:
+            del self._index[connection.address]
+
+    def get(self, address):
+        """
+        Returns list of connections accepted on ``address`` listener.
+        """
+        return list(self._index.get(address, ()))
+
+    def count(self, address):
+        """
+        Returns number of connections accepted on ``address`` listener.
+        """
+        return len(self._index.get(address, ()))
+
+    def addresses(self):
+        return list(self._index)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for connections in list(self._index.values()):
+            for connection in list(connections):
+                yield connection
+
+    def __contains__(self, connection):
+        return connection in self._index.get(connection.address, ())
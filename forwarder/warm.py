@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Pools of already established upstream connections.
+"""
+import collections
+import errno
+import functools
+import logging
+import select
+import socket
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from forwarder.utils import create_socket
+
+
+DEFAULT_WARM_IDLE = 60.0
+REFILL_DELAY = 1.0  # Seconds to wait before reconnecting after a failure
+
+_ERRNO_INPROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK)
+_ERRNO_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+_POLL_CLOSED = getattr(select, 'POLLRDHUP', 0) | getattr(select, 'POLLHUP', 0) | getattr(select, 'POLLERR', 0)
+
+
+def peer_closed(sock):
+    """
+    Returns True if peer closed or reset connection of ``sock``. Where
+    POLLRDHUP is available, close is noticed even after unread data.
+    """
+    if hasattr(select, 'POLLRDHUP'):
+        poller = select.poll()
+        poller.register(sock.fileno(), _POLL_CLOSED)
+        return bool(poller.poll(0))
+    try:
+        return not sock.recv(1, socket.MSG_PEEK)
+    except (IOError, OSError) as e:
+        return e.errno not in _ERRNO_WOULDBLOCK
+
+
+class WarmPool(object):
+    """
+    Keeps ``size`` idle connections to backends of `forwarder.balancer.BackendPool`,
+    so a new client doesn't wait for a TCP handshake with the backend.
+
+    Connections idle longer than ``max_idle`` seconds are closed and
+    replaced. Connections closed by backend while idle are dropped at once.
+    Socket options from forwarding ``options`` dict are set on new sockets.
+    """
+    def __init__(self, pool, size, max_idle=DEFAULT_WARM_IDLE, options=None, io_loop=None):
+        self.pool = pool
+        self.io_loop = io_loop or IOLoop.current()
+        self._idle = collections.deque()  # (socket, backend, connected time)
+        self._connecting = {}  # fd => (socket, backend)
+        self._resolving = 0  # Connections waiting for backend name resolution
+        self._refill_timeout = None
+        self._sweeper = None
+        self._stopped = False
+        self.update(size, max_idle, options)
+
+    def update(self, size, max_idle=DEFAULT_WARM_IDLE, options=None):
+        self.size = size
+        self.options = options or {}
+        if self._sweeper and self.max_idle != max_idle:
+            self._sweeper.stop()
+            self._sweeper = None
+        self.max_idle = max_idle
+        if not self._sweeper:
+            self._sweeper = PeriodicCallback(self._sweep, max(max_idle / 2.0, 0.1) * 1000)
+            self._sweeper.start()
+        backends = set(b.address for b in self.pool.backends)
+        self._discard(lambda sock, backend, connected: backend not in backends)
+        while len(self._idle) > size:
+            self._close(*self._idle.pop())
+        self._refill()
+
+    def stop(self):
+        self._stopped = True
+        if self._sweeper:
+            self._sweeper.stop()
+        if self._refill_timeout:
+            self.io_loop.remove_timeout(self._refill_timeout)
+        for sock, backend in list(self._connecting.values()):
+            self.io_loop.remove_handler(sock.fileno())
+            sock.close()
+        self._connecting.clear()
+        while self._idle:
+            self._close(*self._idle.pop())
+
+    def take(self):
+        """
+        Returns tuple (socket, backend address) of an established connection
+        or None if there is no idle connection.
+        """
+        result = None
+        while self._idle:
+            sock, backend, connected = self._idle.popleft()
+            # Backend which sent data first isn't watched for close anymore
+            if self.io_loop.time() - connected < self.max_idle and not peer_closed(sock):
+                self.io_loop.remove_handler(sock.fileno())
+                result = sock, backend
+                break
+            self._close(sock, backend, connected)
+        self._schedule_refill(0)
+        return result
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _close(self, sock, backend, connected):
+        self.io_loop.remove_handler(sock.fileno())
+        sock.close()
+
+    def _discard(self, predicate):
+        for item in [item for item in self._idle if predicate(*item)]:
+            self._idle.remove(item)
+            self._close(*item)
+
+    def _sweep(self):
+        now = self.io_loop.time()
+        self._discard(lambda sock, backend, connected: now - connected >= self.max_idle)
+        self._refill()
+
+    def _schedule_refill(self, delay):
+        if self._refill_timeout is None and not self._stopped:
+            self._refill_timeout = self.io_loop.call_later(delay, self._refill)
+
+    def _refill(self):
+        if self._refill_timeout is not None:
+            self.io_loop.remove_timeout(self._refill_timeout)
+            self._refill_timeout = None
+        # Refill timeout is set if a connect failed right away.
+        while not self._stopped and self._refill_timeout is None and \
+                len(self._idle) + len(self._connecting) + self._resolving < self.size:
+            backend = self.pool.select(exclude=[b.address for b in self.pool.backends if b.down])
+            if backend is None:
+                # All backends are down, wait for health checks.
+                self._schedule_refill(REFILL_DELAY)
+                return
+            self._resolving += 1
+            self.pool.resolver.resolve(backend[0], backend[1], functools.partial(self._connect, backend))
+
+    def _connect(self, backend, addresses):
+        self._resolving -= 1
+        if self._stopped:
+            return
+        if not addresses:
+            self._on_connect_failed(None, backend)
+            return
+        sock = create_socket(self.options)
+        err = sock.connect_ex(addresses[0])
+        if err and err not in _ERRNO_INPROGRESS:
+            self._on_connect_failed(sock, backend)
+            return
+        self._connecting[sock.fileno()] = sock, backend
+        self.io_loop.add_handler(sock.fileno(), self._handle_connect, IOLoop.WRITE)
+
+    def _on_connect_failed(self, sock, backend):
+        logging.warning('Failed to establish warm connection to %s:%s', *backend)
+        if sock is not None:
+            sock.close()
+        self.pool.report_failure(backend)
+        self._schedule_refill(REFILL_DELAY)
+
+    def _handle_connect(self, fd, events):
+        sock, backend = self._connecting.pop(fd)
+        self.io_loop.remove_handler(fd)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self._on_connect_failed(sock, backend)
+            return
+        self.pool.report_success(backend)
+        self._idle.append((sock, backend, self.io_loop.time()))
+        # Watch idle connection to notice when backend closes it.
+        self.io_loop.add_handler(fd, self._handle_idle_events, IOLoop.READ)
+
+    def _handle_idle_events(self, fd, events):
+        for item in self._idle:
+            if item[0].fileno() == fd:
+                break
+        else:
+            return
+        sock = item[0]
+        try:
+            closed = not sock.recv(1, socket.MSG_PEEK)
+        except (IOError, OSError) as e:
+            closed = e.errno not in _ERRNO_WOULDBLOCK
+        if closed or events & IOLoop.ERROR:
+            self._idle.remove(item)
+            self._close(*item)
+            self._schedule_refill(0)
+        else:
+            # Backend sent something first (e.g. a greeting). Keep data
+            # for the client and watch for errors only, close after
+            # the data is noticed when connection is taken.
+            self.io_loop.update_handler(fd, IOLoop.ERROR)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration files change detection.
+"""
+import ctypes
+import ctypes.util
+import errno
+import glob
+import logging
+import os
+import struct
+
+from tornado.ioloop import IOLoop
+
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+def inotify_available():
+    return _libc is not None
+
+
+def file_stamp(path):
+    """
+    Returns value which changes when file is modified or replaced.
+    Unlike mtime alone, it catches edits made within one mtime tick.
+    """
+    st = os.stat(path)
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size, st.st_ino
+
+
+def watch_paths(pattern):
+    """
+    Returns set of paths to watch for changes of files matching ``pattern``:
+    directories which may contain matching files and matched symlinks, whose
+    targets changes are not reported by directory watch.
+    """
+    if os.path.isdir(pattern):
+        return set([pattern])
+    paths = set(d for d in glob.iglob(os.path.dirname(pattern) or '.') if os.path.isdir(d))
+    paths.update(p for p in glob.iglob(pattern) if os.path.islink(p))
+    return paths
+
+
+class InotifyWatcher(object):
+    """
+    Watches paths with inotify(7) registered on the IOLoop and runs
+    ``callback`` once after a burst of changes settles for ``debounce`` seconds.
+    """
+    def __init__(self, callback, debounce=0.1, io_loop=None):
+        self.callback = callback
+        self.debounce = debounce
+        self.io_loop = io_loop or IOLoop.current()
+        self._fd = None
+        self._watches = {}  # path => watch descriptor
+        self._timeout = None
+
+    def start(self):
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        self.io_loop.add_handler(fd, self._handle_events, IOLoop.READ)
+
+    def stop(self):
+        if self._fd is None:
+            return
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self.io_loop.remove_handler(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self._watches = {}
+
+    def watch(self, paths):
+        """
+        Updates set of watched paths.
+        """
+        paths = set(paths)
+        for path in set(self._watches) - paths:
+            _libc.inotify_rm_watch(self._fd, self._watches.pop(path))
+        for path in paths - set(self._watches):
+            wd = _libc.inotify_add_watch(self._fd, path.encode('utf-8'), WATCH_MASK)
+            if wd < 0:
+                logging.warning('Failed to watch %s for changes: %s', path, os.strerror(ctypes.get_errno()))
+            else:
+                self._watches[path] = wd
+
+    def _handle_events(self, fd, events):
+        ignored = set()
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+                pos += _EVENT_HEADER.size + length
+                if mask & IN_IGNORED:
+                    ignored.add(wd)
+        if ignored:
+            # Watched path was removed, it will be watched again when callback
+            # updates paths list.
+            self._watches = dict((p, wd) for p, wd in self._watches.items() if wd not in ignored)
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+        self._timeout = self.io_loop.call_later(self.debounce, self._run_callback)
+
+    def _run_callback(self):
+        self._timeout = None
+        self.callback()
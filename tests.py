@@ -1,20 +1,61 @@
 # -*- coding: utf-8 -*-
+import errno
 import functools
+import json
 import mock
 import os
+import socket
+import ssl
 import tempfile
-import time
 
 from contextlib import closing
 from textwrap import dedent
+import tornado
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
 from tornado.tcpclient import TCPClient
 from tornado.tcpserver import TCPServer
 from tornado.testing import AsyncTestCase, bind_unused_port, unittest, gen_test
 
 from forwarder import ForwardServer, get_forwarding_str, ParseError
-from forwarder.utils import DictDiff
+from forwarder.accesslog import AccessLog, queue
+from forwarder.aio import ASYNCIO_AVAILABLE
+from forwarder.balancer import BackendPool
+from forwarder.control import get_default_save_path, start_control_server
+from forwarder.handoff import HANDOFF_AVAILABLE, HandoffServer, confirm, connect, receive_listeners
+from forwarder.metrics import Histogram, start_metrics_server
+from forwarder.ranges import PortRange, RangeIndex
+from forwarder.resolver import CachedResolver
+from forwarder.splice import SPLICE_AVAILABLE
+from forwarder.timers import TimerWheel
+from forwarder.tls import TLS_AVAILABLE, Handshaker
+from forwarder.udp import bind_udp_socket
+from forwarder.warm import WarmPool
+from forwarder.utils import ConnectionRegistry, DictDiff, TokenBucket
+from forwarder.watcher import file_stamp, inotify_available
 
 TEST_FILE_SUFFIX = '_fwdtest'
+# Self-signed certificate shipped with tornado tests, its key is too short
+# for the default security level of recent OpenSSL versions.
+TEST_CERT = os.path.join(os.path.dirname(tornado.__file__), 'test', 'test.crt')
+TEST_KEY = os.path.join(os.path.dirname(tornado.__file__), 'test', 'test.key')
+TEST_CIPHERS = 'DEFAULT@SECLEVEL=0'
+
+
+def make_test_ssl_context(purpose):
+    """
+    Returns SSL context for tests which doesn't verify peers.
+    """
+    context = ssl.create_default_context(purpose)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.set_ciphers(TEST_CIPHERS)
+    if purpose == ssl.Purpose.CLIENT_AUTH:
+        context.load_cert_chain(TEST_CERT, TEST_KEY)
+    return context
 
 
 def make_config_file(config, config_file=None):
@@ -69,6 +110,40 @@ class DictDiffTest(unittest.TestCase):
         self.assertEqual(self.diff.unchanged, set(['c', 'd']))
 
 
+class ConnectionRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = ConnectionRegistry()
+        self.connections = [
+            mock.Mock(address=('127.0.0.1', 5000)),
+            mock.Mock(address=('127.0.0.1', 5000)),
+            mock.Mock(address=('127.0.0.1', 5002)),
+        ]
+        for connection in self.connections:
+            self.registry.add(connection)
+
+    def test_count(self):
+        self.assertEqual(len(self.registry), 3)
+        self.assertEqual(self.registry.count(('127.0.0.1', 5000)), 2)
+        self.assertEqual(self.registry.count(('127.0.0.1', 5002)), 1)
+        self.assertEqual(self.registry.count(('127.0.0.1', 5004)), 0)
+
+    def test_get(self):
+        self.assertEqual(set(self.registry.get(('127.0.0.1', 5000))), set(self.connections[:2]))
+        self.assertEqual(self.registry.get(('127.0.0.1', 5004)), [])
+
+    def test_remove(self):
+        self.registry.remove(self.connections[2])
+        self.assertEqual(len(self.registry), 2)
+        self.assertNotIn(self.connections[2], self.registry)
+        self.assertEqual(self.registry.addresses(), [('127.0.0.1', 5000)])
+        self.assertRaises(KeyError, self.registry.remove, self.connections[2])
+
+    def test_iter_while_removing(self):
+        for connection in self.registry:
+            self.registry.remove(connection)
+        self.assertEqual(len(self.registry), 0)
+
+
 class ForwarderConfigTest(unittest.TestCase):
     def setUp(self):
         self.forwarder_server = ForwardServer()
@@ -146,6 +221,79 @@ class ForwarderConfigTest(unittest.TestCase):
         self.assertEqual(bind_conf.call_count, 2)
         self.assertEqual(bind_conf.call_args, mock.call(conf))
 
+    @mock.patch('forwarder.ForwardServer.bind_conf')
+    def test_handle_config_reload_incremental(self, bind_conf):
+        d = tempfile.mkdtemp(TEST_FILE_SUFFIX)
+        make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 5001)}, os.path.join(d, '0.conf'))
+        make_config_file({('127.0.0.1', 5002): ('127.0.0.1', 5003)}, os.path.join(d, '1.conf'))
+        self.forwarder_server._config_file = d
+        self.forwarder_server._handle_config_reload()
+
+        make_config_file({('127.0.0.1', 5002): ('127.0.0.1', 5005)}, os.path.join(d, '1.conf'))
+        os.remove(os.path.join(d, '0.conf'))
+        with mock.patch.object(self.forwarder_server, 'parse_config',
+                               wraps=self.forwarder_server.parse_config) as parse_config:
+            self.forwarder_server._handle_config_reload()
+        self.assertEqual(parse_config.call_args_list, [mock.call(filename=os.path.join(d, '1.conf'))])
+        self.assertEqual(bind_conf.call_args, mock.call({('127.0.0.1', 5002): ('127.0.0.1', 5005)}))
+
+    @mock.patch('forwarder.ForwardServer.bind_conf')
+    def test_handle_config_reload_conflict(self, bind_conf):
+        d = tempfile.mkdtemp(TEST_FILE_SUFFIX)
+        make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 5001)}, os.path.join(d, '1.conf'))
+        make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 5003)}, os.path.join(d, '0.conf'))
+        self.forwarder_server._config_file = d
+        with mock.patch('logging.warning') as warning:
+            self.forwarder_server._handle_config_reload()
+        self.assertEqual(warning.call_count, 1)
+        self.assertEqual(bind_conf.call_args, mock.call({('127.0.0.1', 5000): ('127.0.0.1', 5003)}))
+
+        os.remove(os.path.join(d, '0.conf'))
+        self.forwarder_server._handle_config_reload()
+        self.assertEqual(bind_conf.call_args, mock.call({('127.0.0.1', 5000): ('127.0.0.1', 5001)}))
+
+    @mock.patch('forwarder.ForwardServer.bind_conf')
+    def test_handle_config_reload_parse_error(self, bind_conf):
+        config_file = make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 5001)})
+        self.forwarder_server._config_file = config_file
+        self.forwarder_server._handle_config_reload()
+        make_config_file('bad config', config_file)
+        self.assertRaises(ParseError, self.forwarder_server._handle_config_reload)
+        make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 5002)}, config_file)
+        self.forwarder_server._handle_config_reload()
+        self.assertEqual(bind_conf.call_count, 2)
+        self.assertEqual(bind_conf.call_args, mock.call({('127.0.0.1', 5000): ('127.0.0.1', 5002)}))
+
+    @mock.patch('forwarder.ForwardServer.bind_conf')
+    def test_handle_config_reload_overlap(self, bind_conf):
+        d = tempfile.mkdtemp(TEST_FILE_SUFFIX)
+        make_config_file('127.0.0.1:5000-5010 => 127.0.0.1:6000', os.path.join(d, '0.conf'))
+        self.forwarder_server._config_file = d
+        self.forwarder_server._handle_config_reload()
+        make_config_file({('127.0.0.1', 5005): ('127.0.0.1', 6001)}, os.path.join(d, '1.conf'))
+        self.assertRaises(ParseError, self.forwarder_server._handle_config_reload)
+        self.assertEqual(bind_conf.call_count, 1)
+        make_config_file({('127.0.0.1', 5011): ('127.0.0.1', 6001)}, os.path.join(d, '1.conf'))
+        self.forwarder_server._handle_config_reload()
+        self.assertEqual(bind_conf.call_count, 2)
+        self.assertEqual(len(bind_conf.call_args[0][0]), 2)
+
+    @mock.patch('forwarder.ForwardServer.bind_conf')
+    def test_handle_config_reload_fast_changes(self, bind_conf):
+        config_file = make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 5001)})
+        self.forwarder_server._config_file = config_file
+        self.forwarder_server._handle_config_reload()
+        make_config_file({('127.0.0.1', 5000): ('127.0.0.1', 50001)}, config_file)
+        self.forwarder_server._handle_config_reload()
+        self.assertEqual(bind_conf.call_count, 2)
+        self.assertEqual(bind_conf.call_args, mock.call({('127.0.0.1', 5000): ('127.0.0.1', 50001)}))
+
+    def test_file_stamp(self):
+        config_file = make_config_file('127.0.0.1:5000 => 127.0.0.1:5001')
+        stamp = file_stamp(config_file)
+        os.rename(make_config_file('127.0.0.1:5000 => 127.0.0.1:5002'), config_file)
+        self.assertNotEqual(file_stamp(config_file), stamp)
+
     @mock.patch('forwarder.ForwardServer.bind_conf')
     def test_handle_config_reload_dir(self, bind_conf):
         d = tempfile.mkdtemp(TEST_FILE_SUFFIX)
@@ -163,21 +311,21 @@ class ForwarderConfigTest(unittest.TestCase):
 
     @mock.patch('forwarder.ForwardServer.unbind')
     @mock.patch('forwarder.ForwardServer.listen')
-    @mock.patch('forwarder.ForwardServer.close_connections')
-    def test_bind_conf(self, close_connections, listen, unbind):
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_bind_conf(self, drain_connections, listen, unbind):
         first_conf = {
             ('127.0.0.1', 5000): ('127.0.0.1', 5001),
             ('127.0.0.1', 5002): ('127.0.0.1', 5003),
         }
         self.forwarder_server.bind_conf(first_conf)
         self.assertEqual(self.forwarder_server.conf, first_conf)
-        self.assertEqual(close_connections.call_count, 0)
+        self.assertEqual(drain_connections.call_count, 0)
         self.assertEqual(listen.call_count, 2)
         self.assertIn(mock.call(5000, '127.0.0.1'), listen.call_args_list)
         self.assertIn(mock.call(5002, '127.0.0.1'), listen.call_args_list)
         self.assertEqual(unbind.call_count, 0)
 
-        close_connections.reset_mock()
+        drain_connections.reset_mock()
         listen.reset_mock()
         unbind.reset_mock()
         second_conf = {
@@ -187,14 +335,659 @@ class ForwarderConfigTest(unittest.TestCase):
         }
         self.forwarder_server.bind_conf(second_conf)
         self.assertEqual(self.forwarder_server.conf, second_conf)
-        self.assertEqual(close_connections.call_count, 2)
-        self.assertIn(mock.call(('127.0.0.1', 5000)), close_connections.call_args_list)
-        self.assertIn(mock.call(('127.0.0.1', 5002)), close_connections.call_args_list)
+        self.assertEqual(drain_connections.call_count, 2)
+        self.assertIn(mock.call(('127.0.0.1', 5000), timeout=None), drain_connections.call_args_list)
+        self.assertIn(mock.call(('127.0.0.1', 5002), timeout=None), drain_connections.call_args_list)
         self.assertEqual(listen.call_count, 1)
         self.assertEqual(mock.call(5006, '127.0.0.1'), listen.call_args)
         self.assertEqual(unbind.call_count, 1)
         self.assertEqual(mock.call(5000, '127.0.0.1'), unbind.call_args)
 
+    @mock.patch('forwarder.ForwardServer.unbind')
+    @mock.patch('forwarder.ForwardServer.listen')
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_bind_conf_pool(self, drain_connections, listen, unbind):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 127.0.0.1:5002'))
+        pool = self.forwarder_server.get_pool(('127.0.0.1', 5000))
+        pool.connection_opened(('127.0.0.1', 5001))
+
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 127.0.0.1:5003 balance=leastconn'))
+        self.assertEqual(drain_connections.call_args_list,
+                         [mock.call(('127.0.0.1', 5000), set([('127.0.0.1', 5002)]), None)])
+        self.assertIs(self.forwarder_server.get_pool(('127.0.0.1', 5000)), pool)
+        self.assertEqual(pool.balance, 'leastconn')
+        self.assertEqual([b.connections for b in pool.backends], [1, 0])
+
+        drain_connections.reset_mock()
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 127.0.0.1:5003'))
+        self.assertEqual(drain_connections.call_count, 0)
+
+    @mock.patch('forwarder.ForwardServer.unbind')
+    @mock.patch('forwarder.ForwardServer.listen')
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_bind_conf_range(self, drain_connections, listen, unbind):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5000-5003 => 127.0.0.1:6000-6003'))
+        self.assertEqual(sorted(listen.call_args_list), [mock.call(port, '127.0.0.1') for port in range(5000, 5004)])
+        self.assertEqual(self.forwarder_server.get_forwarding(('127.0.0.1', 5002)).backends, (('127.0.0.1', 6002),))
+        self.assertIsNone(self.forwarder_server.get_forwarding(('127.0.0.1', 5004)))
+
+        listen.reset_mock()
+        # Ports forwarded to the same backends are not touched
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5002-5005 => 127.0.0.1:6002-6005'))
+        self.assertEqual(sorted(listen.call_args_list), [mock.call(5004, '127.0.0.1'), mock.call(5005, '127.0.0.1')])
+        self.assertEqual(sorted(unbind.call_args_list), [mock.call(5000, '127.0.0.1'), mock.call(5001, '127.0.0.1')])
+        self.assertEqual(sorted(drain_connections.call_args_list),
+                         [mock.call(('127.0.0.1', 5000), timeout=None), mock.call(('127.0.0.1', 5001), timeout=None)])
+        self.assertIsNone(self.forwarder_server.get_forwarding(('127.0.0.1', 5000)))
+        self.assertEqual(self.forwarder_server.get_pool(('127.0.0.1', 5005)).backends[0].address, ('127.0.0.1', 6005))
+
+    @mock.patch('forwarder.ForwardServer.unbind')
+    @mock.patch('forwarder.ForwardServer.listen')
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_bind_conf_failed(self, drain_connections, listen, unbind):
+        first_conf = {('127.0.0.1', 5000): ('127.0.0.1', 5001)}
+        self.forwarder_server.bind_conf(first_conf)
+        listen.reset_mock()
+
+        def fail_port(port, address):
+            if port == 5004:
+                raise socket.error(errno.EADDRINUSE, 'Address already in use')
+        listen.side_effect = fail_port
+        # Configuration is kept if a new listener fails to bind
+        with self.assertRaises(socket.error):
+            self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                data='127.0.0.1:5002 => 127.0.0.1:5003\n127.0.0.1:5004 => 127.0.0.1:5005'))
+        self.assertEqual(self.forwarder_server.conf, first_conf)
+        self.assertIsNone(self.forwarder_server.get_forwarding(('127.0.0.1', 5002)))
+        self.assertEqual(drain_connections.call_count, 0)
+        self.assertEqual(listen.call_args_list, [mock.call(5002, '127.0.0.1'), mock.call(5004, '127.0.0.1')])
+        self.assertEqual(unbind.call_args_list, [mock.call(5002, '127.0.0.1')])
+
+        # Failed listener is bound again on next attempt
+        listen.reset_mock()
+        listen.side_effect = None
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5004 => 127.0.0.1:5005'))
+        self.assertEqual(listen.call_args_list, [mock.call(5004, '127.0.0.1')])
+        self.assertEqual(list(self.forwarder_server.conf), [('127.0.0.1', 5004)])
+
+    @mock.patch('forwarder.ForwardServer.unbind')
+    @mock.patch('forwarder.ForwardServer.listen')
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_bind_conf_failed_rebind(self, drain_connections, listen, unbind):
+        sock, port = bind_unused_port()
+        sock.close()
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:5001 proto=udp'.format(port)))
+        self.assertIn(('127.0.0.1', port), self.forwarder_server._udp)
+        conf = self.forwarder_server.conf
+        listen.side_effect = socket.error(errno.EADDRINUSE, 'Address already in use')
+        # Listener of a changed forwarding is closed first, so port is bound
+        # after it. On failure the previous forwarding is bound again.
+        with self.assertRaises(socket.error):
+            self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                data='127.0.0.1:{0} => 127.0.0.1:5001'.format(port)))
+        self.assertEqual(self.forwarder_server.conf, conf)
+        self.assertEqual(list(self.forwarder_server._udp), [('127.0.0.1', port)])
+        self.assertEqual(listen.call_args_list, [mock.call(port, '127.0.0.1')])
+
+    @mock.patch('forwarder.ForwardServer.unbind')
+    @mock.patch('forwarder.ForwardServer.listen')
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_bind_conf_failed_other_address(self, drain_connections, listen, unbind):
+        first_conf = {('127.0.0.1', 5000): ('127.0.0.1', 5001)}
+        self.forwarder_server.bind_conf(first_conf)
+        listen.reset_mock()
+        listen.side_effect = socket.error(errno.EADDRINUSE, 'Address already in use')
+        # Listener of another address doesn't wait for the removed one
+        with self.assertRaises(socket.error):
+            self.forwarder_server.bind_conf({('127.0.0.2', 5000): ('127.0.0.1', 5001)})
+        self.assertEqual(self.forwarder_server.conf, first_conf)
+        self.assertEqual(listen.call_args_list, [mock.call(5000, '127.0.0.2')])
+        self.assertEqual(drain_connections.call_count, 0)
+        self.assertEqual(unbind.call_count, 0)
+
+        # Wildcard listener takes the port of every address
+        listen.reset_mock()
+
+        def fail_wildcard(port, address):
+            if address == '0.0.0.0':
+                raise socket.error(errno.EADDRINUSE, 'Address already in use')
+        listen.side_effect = fail_wildcard
+        with self.assertRaises(socket.error):
+            self.forwarder_server.bind_conf({('0.0.0.0', 5000): ('127.0.0.1', 5001)})
+        self.assertEqual(self.forwarder_server.conf, first_conf)
+        self.assertEqual(unbind.call_args_list, [mock.call(5000, '127.0.0.1'), mock.call(5000, '0.0.0.0')])
+        self.assertEqual(listen.call_args_list, [mock.call(5000, '0.0.0.0'), mock.call(5000, '127.0.0.1')])
+
+    @mock.patch('forwarder.ForwardServer.unbind')
+    @mock.patch('forwarder.ForwardServer.listen')
+    @mock.patch('forwarder.ForwardServer.drain_connections')
+    def test_metrics_range(self, drain_connections, listen, unbind):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:5000-5999 => 127.0.0.1:6000-6999\n127.0.0.1:7000 => 127.0.0.1:7001'))
+        metrics = self.forwarder_server.metrics
+        metrics.connection_opened(('127.0.0.1', 5002))
+        lines = metrics.render().splitlines()
+        self.assertIn('forwarder_connections_total{listener="127.0.0.1:5002"} 1', lines)
+        self.assertIn('forwarder_connections_total{listener="127.0.0.1:7000"} 0', lines)
+        # Other ports of the range have no series
+        self.assertEqual(len([line for line in lines if line.startswith('forwarder_connections_total{')]), 2)
+        self.assertEqual(len(metrics._stats), 2)
+
+    def test_parse_config_range(self):
+        conf = self.forwarder_server.parse_config(data=dedent('''
+            127.0.0.1:5000-5999 => 127.0.0.1:6000-6999 127.0.0.1:7000 balance=leastconn
+            127.0.0.1:8000 => 127.0.0.1:8001
+        '''))
+        self.assertEqual(len(conf), 2)
+        forwarding = conf['127.0.0.1', PortRange(5000, 5999)]
+        self.assertEqual(forwarding.backends, (('127.0.0.1', PortRange(6000, 6999)), ('127.0.0.1', 7000)))
+        for line in ('127.0.0.1:5000-5999 => 127.0.0.1:6000-6001',
+                     '127.0.0.1:5000 => 127.0.0.1:6000-6001',
+                     '127.0.0.1:5999-5000 => 127.0.0.1:6000'):
+            self.assertRaises(ParseError, self.forwarder_server.parse_config, data=line)
+
+    def test_parse_config_range_overlap(self):
+        for data in ('127.0.0.1:5000-5010 => 127.0.0.1:6000\n127.0.0.1:5005 => 127.0.0.1:6001',
+                     '127.0.0.1:5005 => 127.0.0.1:6001\n127.0.0.1:5000-5010 => 127.0.0.1:6000',
+                     '127.0.0.1:5000-5010 => 127.0.0.1:6000\n127.0.0.1:5010-5020 => 127.0.0.1:6001',
+                     '127.0.0.1:5000-5010 => 127.0.0.1:6000\n127.0.0.1:5002-5003 => 127.0.0.1:6001'):
+            with self.assertRaises(ParseError) as context:
+                self.forwarder_server.parse_config(data=data)
+            self.assertEqual(context.exception.lineno, 2)
+        conf = self.forwarder_server.parse_config(data=dedent('''
+            127.0.0.1:5000-5010 => 127.0.0.1:6000
+            127.0.0.1:5011 => 127.0.0.1:6001
+            127.0.0.2:5005 => 127.0.0.1:6002
+        '''))
+        self.assertEqual(len(conf), 3)
+
+    def test_parse_config_pool(self):
+        data = dedent('''
+            127.0.0.1:5000 => 127.0.0.1:5001 127.0.0.1:5002, 127.0.0.1:5003 balance=leastconn max_fails=3
+            127.0.0.1:5004=>127.0.0.1:5005 check_interval=0.5
+        ''')
+        conf = self.forwarder_server.parse_config(data=data)
+        forwarding = conf['127.0.0.1', 5000]
+        self.assertEqual(tuple(forwarding), ('127.0.0.1', 5001))
+        self.assertEqual(forwarding.backends, (('127.0.0.1', 5001), ('127.0.0.1', 5002), ('127.0.0.1', 5003)))
+        self.assertEqual(forwarding.options, {'balance': 'leastconn', 'max_fails': 3})
+        self.assertEqual(conf['127.0.0.1', 5004].options, {'check_interval': 0.5})
+        self.assertNotEqual(conf['127.0.0.1', 5004], ('127.0.0.1', 5005))
+
+    def test_parse_config_bad_options(self):
+        for line in ('127.0.0.1:5000 => 127.0.0.1:5001 balance=random',
+                     '127.0.0.1:5000 => 127.0.0.1:5001 unknown=1',
+                     '127.0.0.1:5000 => 127.0.0.1:5001 127.0.0.1'):
+            self.assertRaises(ParseError, self.forwarder_server.parse_config, data=line)
+
+    def test_parse_config_socket_options(self):
+        conf = self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 nodelay=on keepalive=no rcvbuf=4m sndbuf=65536 '
+                 'backlog=1024 read_chunk_size=256k')
+        self.assertEqual(conf['127.0.0.1', 5000].options, {
+            'nodelay': True, 'keepalive': False, 'rcvbuf': 4 * 1024 * 1024, 'sndbuf': 65536,
+            'backlog': 1024, 'read_chunk_size': 256 * 1024,
+        })
+        for line in ('127.0.0.1:5000 => 127.0.0.1:5001 nodelay=maybe',
+                     '127.0.0.1:5000 => 127.0.0.1:5001 rcvbuf=4g'):
+            self.assertRaises(ParseError, self.forwarder_server.parse_config, data=line)
+
+    def test_parse_config_udp(self):
+        conf = self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 proto=udp idle_timeout=10 max_sessions=100')
+        self.assertEqual(conf['127.0.0.1', 5000].options, {'proto': 'udp', 'idle_timeout': 10, 'max_sessions': 100})
+        for line in ('127.0.0.1:5000 => 127.0.0.1:5001 proto=sctp',
+                     '127.0.0.1:5000 => 127.0.0.1:5001 proto=udp nodelay=on'):
+            self.assertRaises(ParseError, self.forwarder_server.parse_config, data=line)
+
+    def test_parse_config_bandwidth(self):
+        conf = self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 bandwidth_up=1m bandwidth_down=10m conn_bandwidth_down=512k')
+        self.assertEqual(conf['127.0.0.1', 5000].options, {
+            'bandwidth_up': 1024 * 1024, 'bandwidth_down': 10 * 1024 * 1024, 'conn_bandwidth_down': 512 * 1024,
+        })
+        self.assertRaises(ParseError, self.forwarder_server.parse_config,
+                          data='127.0.0.1:5000 => 127.0.0.1:5001 proto=udp bandwidth_up=1m')
+
+    @unittest.skipUnless(TLS_AVAILABLE, 'TLS is not supported')
+    def test_parse_config_tls(self):
+        conf = self.forwarder_server.parse_config(
+            data='127.0.0.1:5000 => 127.0.0.1:5001 tls_cert=/tmp/cert.pem tls_key=/tmp/key.pem '
+                 'tls_upstream=on tls_upstream_verify=off')
+        self.assertEqual(conf['127.0.0.1', 5000].options, {
+            'tls_cert': '/tmp/cert.pem', 'tls_key': '/tmp/key.pem',
+            'tls_upstream': True, 'tls_upstream_verify': False,
+        })
+        for line in ('127.0.0.1:5000 => 127.0.0.1:5001 tls_key=/tmp/key.pem',
+                     '127.0.0.1:5000 => 127.0.0.1:5001 tls_upstream=on warm=2',
+                     '127.0.0.1:5000 => 127.0.0.1:5001 proto=udp tls_cert=/tmp/cert.pem'):
+            self.assertRaises(ParseError, self.forwarder_server.parse_config, data=line)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT is not supported')
+    def test_listen_reuse_port(self):
+        servers = [ForwardServer(reuse_port=True), ForwardServer(reuse_port=True)]
+        sock, port = bind_unused_port()
+        sock.close()
+        try:
+            for server in servers:
+                server.listen(port, '127.0.0.1')
+                self.assertIn(('127.0.0.1', port), server._fds)
+        finally:
+            for server in servers:
+                server.stop()
+
+
+class BackendPoolTest(unittest.TestCase):
+    backends = [('127.0.0.1', 5001), ('127.0.0.1', 5002), ('127.0.0.1', 5003)]
+
+    def test_roundrobin(self):
+        pool = BackendPool(self.backends)
+        self.assertEqual([pool.select() for _ in range(6)], self.backends * 2)
+
+    def test_leastconn(self):
+        pool = BackendPool(self.backends, balance='leastconn')
+        pool.connection_opened(self.backends[0])
+        pool.connection_opened(self.backends[1])
+        self.assertEqual(pool.select(), self.backends[2])
+        pool.connection_opened(self.backends[2])
+        pool.connection_closed(self.backends[1])
+        self.assertEqual(pool.select(), self.backends[1])
+
+    def test_select_exclude(self):
+        pool = BackendPool(self.backends)
+        self.assertEqual(pool.select(exclude=self.backends[:2]), self.backends[2])
+        self.assertIsNone(pool.select(exclude=self.backends))
+
+    def test_eject(self):
+        pool = BackendPool(self.backends, max_fails=2)
+        self.addCleanup(pool.stop)
+        pool.report_failure(self.backends[0])
+        self.assertFalse(pool.backends[0].down)
+        pool.report_failure(self.backends[0])
+        self.assertTrue(pool.backends[0].down)
+        self.assertNotIn(self.backends[0], [pool.select() for _ in range(6)])
+
+    def test_eject_all(self):
+        pool = BackendPool(self.backends[:2])
+        self.addCleanup(pool.stop)
+        pool.report_failure(self.backends[0])
+        pool.report_failure(self.backends[1])
+        self.assertIn(pool.select(), self.backends[:2])
+
+    def test_update(self):
+        pool = BackendPool(self.backends)
+        self.addCleanup(pool.stop)
+        pool.connection_opened(self.backends[1])
+        pool.report_failure(self.backends[1])
+        pool.update([self.backends[1], ('127.0.0.1', 5004)])
+        self.assertEqual([b.address for b in pool.backends], [self.backends[1], ('127.0.0.1', 5004)])
+        self.assertEqual(pool.backends[0].connections, 1)
+        self.assertTrue(pool.backends[0].down)
+
+
+class HistogramTest(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1.0, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+
+class RangeIndexTest(unittest.TestCase):
+    def test_lookup(self):
+        index = RangeIndex({
+            ('127.0.0.1', PortRange(5000, 5009)): 'a',
+            ('127.0.0.1', PortRange(6000, 6000)): 'b',
+            ('127.0.0.1', 7000): 'c',
+            ('127.0.0.2', PortRange(5010, 5019)): 'd',
+        })
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.lookup(('127.0.0.1', 5000)), (PortRange(5000, 5009), 'a'))
+        self.assertEqual(index.lookup(('127.0.0.1', 5009)), (PortRange(5000, 5009), 'a'))
+        self.assertEqual(index.lookup(('127.0.0.1', 6000)), (PortRange(6000, 6000), 'b'))
+        self.assertEqual(index.lookup(('127.0.0.2', 5015)), (PortRange(5010, 5019), 'd'))
+        for address in (('127.0.0.1', 4999), ('127.0.0.1', 5010), ('127.0.0.1', 7000), ('127.0.0.3', 5000)):
+            self.assertIsNone(index.lookup(address))
+
+
+class CachedResolverTest(AsyncTestCase):
+    def setUp(self):
+        super(CachedResolverTest, self).setUp()
+        self.resolver = CachedResolver(ttl=0.2)
+        patcher = mock.patch('forwarder.resolver.getaddrinfo', return_value=['10.0.0.1', '10.0.0.2'])
+        self.getaddrinfo = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.resolver.stop()
+        super(CachedResolverTest, self).tearDown()
+
+    @gen.coroutine
+    def resolve(self, host):
+        future = Future()
+        self.resolver.resolve(host, 80, future.set_result)
+        result = yield future
+        raise gen.Return(result)
+
+    @gen_test
+    def test_resolve(self):
+        addresses = [('10.0.0.1', 80), ('10.0.0.2', 80)]
+        self.assertEqual(self.resolver.get_cached('127.0.0.1', 80), [('127.0.0.1', 80)])
+        # Concurrent lookups of a name share one getaddrinfo call
+        self.assertIsNone(self.resolver.get_cached('backend', 80))
+        result = yield [self.resolve('backend'), self.resolve('backend')]
+        self.assertEqual(result, [addresses, addresses])
+        self.assertEqual(self.getaddrinfo.call_count, 1)
+        self.assertEqual(self.resolver.get_cached('backend', 80), addresses)
+        self.assertEqual(self.getaddrinfo.call_count, 1)
+
+        # Names in use are refreshed before they expire
+        self.getaddrinfo.return_value = ['10.0.0.3']
+        yield gen.sleep(0.16)
+        self.assertEqual(self.resolver.get_cached('backend', 80), addresses)
+        yield gen.sleep(0.05)
+        self.assertEqual(self.resolver.get_cached('backend', 80), [('10.0.0.3', 80)])
+        self.assertEqual(self.getaddrinfo.call_count, 2)
+
+    @gen_test
+    def test_failure(self):
+        self.getaddrinfo.side_effect = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        result = yield self.resolve('backend')
+        self.assertEqual(result, [])
+        self.assertEqual(self.resolver.get_cached('backend', 80), [])
+        self.getaddrinfo.side_effect = None
+        yield gen.sleep(1.0)
+        result = yield self.resolve('backend')
+        self.assertEqual(result, [('10.0.0.1', 80), ('10.0.0.2', 80)])
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_rate(self):
+        now = [0.0]
+        bucket = TokenBucket(10, clock=lambda: now[0])
+        self.assertEqual(bucket.burst, 10)
+        bucket.consume(10)
+        self.assertAlmostEqual(bucket.delay(), 0.1)
+        now[0] = 0.5
+        self.assertEqual(bucket.delay(5), 0)
+        now[0] = 10
+        self.assertEqual(bucket.tokens, 5)
+        bucket.delay()
+        self.assertEqual(bucket.tokens, 10)
+
+    def test_set_rate(self):
+        now = [0.0]
+        bucket = TokenBucket(10, clock=lambda: now[0])
+        bucket.consume(15)
+        bucket.set_rate(100)
+        self.assertEqual(bucket.burst, 100)
+        self.assertAlmostEqual(bucket.delay(), 0.06)
+        now[0] = 10
+        bucket.set_rate(20)
+        self.assertEqual(bucket.tokens, 20)
+
+
+class TimerWheelTest(AsyncTestCase):
+    @gen_test
+    def test_call_later(self):
+        wheel = TimerWheel(resolution=0.01, slots=8)
+        calls = []
+        for delay in (0.25, 0.02, 0.05):
+            wheel.call_later(delay, calls.append, delay)
+        timer = wheel.call_later(0.03, calls.append, 0.03)
+        wheel.cancel(timer)
+        self.assertEqual(len(wheel), 3)
+        yield gen.sleep(0.1)
+        self.assertEqual(calls, [0.02, 0.05])
+        yield gen.sleep(0.2)
+        self.assertEqual(calls, [0.02, 0.05, 0.25])
+        self.assertEqual(len(wheel), 0)
+        self.assertIsNone(wheel._ticker)
+
+
+class AccessLogTest(AsyncTestCase):
+    def setUp(self):
+        super(AccessLogTest, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(AccessLogTest, self).tearDown()
+
+    def make_connection(self, port, transferred=(0, 0)):
+        return mock.Mock(address=('127.0.0.1', port), reverse_address=('127.0.0.2', 5000),
+                         remote_address=('127.0.0.3', 80), opened_at=10.0,
+                         pumps=[mock.Mock(transferred=n) for n in transferred])
+
+    def read_records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records(self):
+        access_log = AccessLog(path=self.path)
+        access_log.connection_closed(self.make_connection(8000, (20, 10)), 11.5)
+        access_log.connection_closed(self.make_connection(8001), 12.0)
+        access_log.stop()
+        records = self.read_records()
+        self.assertEqual(len(records), 2)
+        record = records[0]
+        self.assertEqual(record['client'], '127.0.0.2:5000')
+        self.assertEqual(record['listener'], '127.0.0.1:8000')
+        self.assertEqual(record['backend'], '127.0.0.3:80')
+        self.assertEqual(record['duration'], 1.5)
+        self.assertEqual((record['bytes_upstream'], record['bytes_downstream']), (10, 20))
+
+    def test_summary(self):
+        access_log = AccessLog(path=self.path, sample=0, summary_interval=60)
+        for port, transferred in ((8000, (20, 10)), (8000, (2, 1)), (8001, (0, 0))):
+            access_log.connection_closed(self.make_connection(port, transferred), 11.0)
+        access_log.stop()
+        records = dict((r['listener'], r) for r in self.read_records())
+        self.assertEqual(sorted(records), ['127.0.0.1:8000', '127.0.0.1:8001'])
+        record = records['127.0.0.1:8000']
+        self.assertTrue(record['summary'])
+        self.assertEqual(record['connections'], 2)
+        self.assertEqual((record['bytes_upstream'], record['bytes_downstream']), (11, 22))
+        self.assertEqual(record['duration'], 1.0)
+
+    def test_queue_full(self):
+        access_log = AccessLog(path=self.path, queue_size=1)
+        with mock.patch.object(access_log._queue, 'put_nowait', side_effect=queue.Full):
+            access_log.connection_closed(self.make_connection(8000), 11.0)
+        self.assertEqual(access_log.dropped, 1)
+        with mock.patch('logging.warning') as warning:
+            access_log.connection_closed(self.make_connection(8000), 11.0)
+            self.assertEqual(warning.call_count, 1)
+        self.assertEqual(access_log.dropped, 0)
+        access_log.stop()
+        self.assertEqual(len(self.read_records()), 1)
+
+
+class ControlTest(AsyncTestCase):
+    def setUp(self):
+        super(ControlTest, self).setUp()
+        self.config_dir = tempfile.mkdtemp()
+        self.ports = []
+        for i in range(3):
+            sock, port = bind_unused_port()
+            sock.close()
+            self.ports.append(port)
+        self.main_file = os.path.join(self.config_dir, 'main.conf')
+        with open(self.main_file, 'w') as f:
+            f.write(dedent('''
+                # Main forwardings
+                127.0.0.1:{0} => 127.0.0.1:7000
+                127.0.0.1:{1} => 127.0.0.1:7001
+            '''.format(*self.ports)))
+        self.server = ForwardServer()
+        self.server.bind_from_config_file(self.config_dir, autoreload=False)
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_dir, 'control.sock')
+        self.control_server = start_control_server(self.server, self.socket_path,
+                                                   get_default_save_path(self.config_dir))
+
+    def tearDown(self):
+        self.control_server.stop()
+        self.server.stop()
+        for name in os.listdir(self.config_dir):
+            os.remove(os.path.join(self.config_dir, name))
+        os.rmdir(self.config_dir)
+        os.remove(self.socket_path)
+        os.rmdir(self.socket_dir)
+        super(ControlTest, self).tearDown()
+
+    @gen.coroutine
+    def request(self, method, body=None):
+        """
+        Returns status code and JSON response of control API.
+        """
+        data = json.dumps(body).encode() if body is not None else b''
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        with closing(stream):
+            yield stream.connect(self.socket_path)
+            stream.write('{0} /forwardings HTTP/1.0\r\nContent-Length: {1}\r\n\r\n'.format(
+                method, len(data)).encode() + data)
+            response = yield stream.read_until_close()
+        head, body = response.split(b'\r\n\r\n', 1)
+        raise gen.Return((int(head.split()[1]), json.loads(body.decode())))
+
+    @gen_test
+    def test_bind_failed(self):
+        port1, port2, port3 = self.ports
+        occupied, occupied_port = bind_unused_port()
+        conf = dict(self.server.conf)
+        batch = {'add': ['127.0.0.1:{0} => 127.0.0.1:7002'.format(port3),
+                         '127.0.0.1:{0} => 127.0.0.1:7003'.format(occupied_port)]}
+        status, result = yield self.request('POST', batch)
+        self.assertEqual(status, 500)
+        self.assertIn('error', result)
+        # Nothing is changed, so the batch may be retried
+        self.assertEqual(self.server.conf, conf)
+        self.assertEqual(set(self.server._fds), set([('127.0.0.1', port1), ('127.0.0.1', port2)]))
+        self.assertEqual(self.server._overrides, {})
+        occupied.close()
+        status, _ = yield self.request('POST', batch)
+        self.assertEqual(status, 200)
+        self.assertEqual(set(self.server._fds), set([('127.0.0.1', port1), ('127.0.0.1', port2),
+                                                     ('127.0.0.1', port3), ('127.0.0.1', occupied_port)]))
+
+    @gen_test
+    def test_bind_failed_late(self):
+        port1, port2, port3 = self.ports
+        occupied = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(occupied.close)
+        occupied.bind(('127.0.0.3', port1))
+        occupied.listen(1)
+        conf = dict(self.server.conf)
+        # Wildcard listener is bound after the removed one of its port is closed
+        status, result = yield self.request('POST', {
+            'add': ['127.0.0.1:{0} => 127.0.0.1:7002'.format(port3),
+                    '0.0.0.0:{0} => 127.0.0.1:7003'.format(port1)],
+            'remove': ['127.0.0.1:{0}'.format(port1)],
+        })
+        self.assertEqual(status, 500)
+        self.assertIn('error', result)
+        self.assertEqual(self.server.conf, conf)
+        self.assertEqual(set(self.server._fds), set([('127.0.0.1', port1), ('127.0.0.1', port2)]))
+        self.assertEqual(self.server._overrides, {})
+
+    @gen_test
+    def test_batch(self):
+        port1, port2, port3 = self.ports
+        status, result = yield self.request('POST', {
+            'add': ['127.0.0.1:{0} => 127.0.0.1:7002 max_conns=10 nodelay=on'.format(port3)],
+            'change': ['127.0.0.1:{0} => 127.0.0.1:7003'.format(port2)],
+            'remove': ['127.0.0.1:{0}'.format(port1)],
+        })
+        self.assertEqual(status, 200)
+        self.assertEqual(result, {
+            'added': ['127.0.0.1:{0}'.format(port3)], 'changed': ['127.0.0.1:{0}'.format(port2)],
+            'removed': ['127.0.0.1:{0}'.format(port1)], 'saved': [],
+        })
+        self.assertEqual(set(self.server._fds), set([('127.0.0.1', port2), ('127.0.0.1', port3)]))
+        # Batch with an invalid operation changes nothing
+        for batch in ({'add': ['127.0.0.1:{0} => 127.0.0.1:7004'.format(port1)],
+                       'remove': ['127.0.0.1:{0}'.format(port2), '127.0.0.1:{0}'.format(port2)]},
+                      {'add': ['127.0.0.1:{0} => 127.0.0.1:7004'.format(port1)],
+                       'change': ['127.0.0.1:{0} => 127.0.0.1'.format(port3)]},
+                      {'remove': ['127.0.0.1:{0}'.format(port1)]}):
+            status, result = yield self.request('POST', batch)
+            self.assertEqual(status, 400)
+            self.assertIn('error', result)
+        self.assertEqual(set(self.server._fds), set([('127.0.0.1', port2), ('127.0.0.1', port3)]))
+
+        # Backend socket accepts connections into its listen queue
+        backend, backend_port = bind_unused_port()
+        self.addCleanup(backend.close)
+        status, _ = yield self.request('POST', {
+            'change': ['127.0.0.1:{0} => 127.0.0.1:{1} max_conns=10 nodelay=on'.format(port3, backend_port)]})
+        self.assertEqual(status, 200)
+        stream = yield TCPClient().connect('127.0.0.1', port3)
+        with closing(stream):
+            yield gen.sleep(0.01)
+            status, result = yield self.request('GET')
+        self.assertEqual(status, 200)
+        forwardings = dict((f['listener'], f) for f in result['forwardings'])
+        self.assertEqual(len(forwardings), 2)
+        self.assertEqual(forwardings['127.0.0.1:{0}'.format(port2)], {
+            'listener': '127.0.0.1:{0}'.format(port2), 'backends': ['127.0.0.1:7003'], 'options': {},
+            'config': '127.0.0.1:{0} => 127.0.0.1:7003'.format(port2), 'connections': 0,
+        })
+        self.assertEqual(forwardings['127.0.0.1:{0}'.format(port3)], {
+            'listener': '127.0.0.1:{0}'.format(port3), 'backends': ['127.0.0.1:{0}'.format(backend_port)],
+            'options': {'max_conns': 10, 'nodelay': True},
+            'config': '127.0.0.1:{0} => 127.0.0.1:{1} max_conns=10 nodelay=on'.format(port3, backend_port),
+            'connections': 1,
+        })
+
+    @gen_test
+    def test_reload_keeps_changes(self):
+        port1, port2, port3 = self.ports
+        status, _ = yield self.request('POST', {'change': ['127.0.0.1:{0} => 127.0.0.1:7003'.format(port2)]})
+        self.assertEqual(status, 200)
+        with open(os.path.join(self.config_dir, 'extra.conf'), 'w') as f:
+            f.write('127.0.0.1:{0} => 127.0.0.1:7002\n'.format(port3))
+        self.server._handle_config_reload()
+        self.assertEqual(self.server.get_forwarding(('127.0.0.1', port2)).backends, (('127.0.0.1', 7003),))
+        self.assertIn(('127.0.0.1', port3), self.server.conf)
+
+    @gen_test
+    def test_save(self):
+        port1, port2, port3 = self.ports
+        status, result = yield self.request('POST', {
+            'add': ['127.0.0.1:{0} => 127.0.0.1:7002 idle_timeout=30'.format(port3)],
+            'change': ['127.0.0.1:{0} => 127.0.0.1:7003'.format(port2)],
+            'remove': ['127.0.0.1:{0}'.format(port1)],
+            'save': True,
+        })
+        self.assertEqual(status, 200)
+        save_file = os.path.join(self.config_dir, 'control.conf')
+        self.assertEqual(result['saved'], sorted([save_file, self.main_file]))
+        with open(self.main_file) as f:
+            self.assertEqual(f.read(), dedent('''
+                # Main forwardings
+                127.0.0.1:{0} => 127.0.0.1:7003
+            '''.format(port2)))
+        with open(save_file) as f:
+            self.assertEqual(f.read(), '127.0.0.1:{0} => 127.0.0.1:7002 idle_timeout=30.0\n'.format(port3))
+        # Files define the same forwardings now
+        self.assertEqual(self.server._overrides, {})
+        conf = self.server.conf
+        self.server.stop()
+        self.server = ForwardServer()
+        self.server.bind_from_config_file(self.config_dir, autoreload=False)
+        self.assertEqual(self.server.conf, conf)
+
 
 class TestEchoServer(TCPServer):
     def __init__(self, *args, **kwargs):
@@ -202,6 +995,7 @@ class TestEchoServer(TCPServer):
         self.port = None
         self.address = ""
         self.recived_data = b""
+        self.streams = []
 
     def listen(self, port, address=""):
         super(TestEchoServer, self).listen(port, address)
@@ -209,6 +1003,7 @@ class TestEchoServer(TCPServer):
         self.address = address
 
     def handle_stream(self, stream, address):
+        self.streams.append(stream)
         callback = lambda _: stream.close()
         streaming_callback = functools.partial(self.handle_data, stream)
         stream.read_until_close(callback, streaming_callback)
@@ -218,11 +1013,27 @@ class TestEchoServer(TCPServer):
         stream.write(data)
 
 
+class TestSourceServer(TCPServer):
+    """
+    Sends ``data`` to every connected client and closes connection.
+    """
+    def __init__(self, data, *args, **kwargs):
+        super(TestSourceServer, self).__init__(*args, **kwargs)
+        self.data = data
+        self.streams = []
+
+    def handle_stream(self, stream, address):
+        self.streams.append(stream)
+        stream.write(self.data, stream.close)
+
+
 class ForwarderIntegrationTest(AsyncTestCase):
     """
     We set up a simple TCP echo server, and test that data
     successfully goes through Forwarder server.
     """
+    engine = 'tornado'
+
     def setUp(self):
         super(ForwarderIntegrationTest, self).setUp()
 
@@ -236,7 +1047,7 @@ class ForwarderIntegrationTest(AsyncTestCase):
             ('127.0.0.1', self.forwarder_port): ('127.0.0.1', self.echo_server.port)
         }
         self.config_file = make_config_file(self.config)
-        self.forwarder_server = ForwardServer()
+        self.forwarder_server = ForwardServer(engine=self.engine)
         self.forwarder_server.bind_from_config_file(self.config_file)
 
     def tearDown(self):
@@ -258,6 +1069,25 @@ class ForwarderIntegrationTest(AsyncTestCase):
         sock.close()
         return port
 
+    def get_unused_ports(self, count):
+        """
+        Returns the first of ``count`` successive unused ports.
+        """
+        while True:
+            first = self.get_unused_port()
+            sockets = []
+            try:
+                for port in range(first, first + count):
+                    sock = socket.socket()
+                    sockets.append(sock)
+                    sock.bind(('127.0.0.1', port))
+                return first
+            except socket.error:
+                pass
+            finally:
+                for sock in sockets:
+                    sock.close()
+
     @gen_test
     def test_connect_and_response(self):
         stream = yield self.client.connect('localhost', self.forwarder_port)
@@ -273,7 +1103,6 @@ class ForwarderIntegrationTest(AsyncTestCase):
         second_echo_server = self.additional_servers[0]
         second_forwarder_port = self.get_unused_port()
         self.config[('127.0.0.1', second_forwarder_port)] = ('127.0.0.1', second_echo_server.port)
-        time.sleep(1)  # workaround for forwarder fast config changes bug
         make_config_file(self.config, self.config_file)
         self.forwarder_server._handle_config_reload()
 
@@ -289,8 +1118,794 @@ class ForwarderIntegrationTest(AsyncTestCase):
                 self.assertEqual(data1, b'One')
                 self.assertEqual(data2, b'Two')
 
+    @gen_test
+    def test_backend_unavailable(self):
+        self.echo_server.stop()
+        stream = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream):
+            data = yield stream.read_until_close()
+            self.assertEqual(data, b'')
+        self.assertEqual(len(self.forwarder_server._connections), 0)
+
+    @gen_test
+    def test_pool_failover(self):
+        second_echo_server = self.start_echo_server()
+        self.additional_servers.append(second_echo_server)
+        down_port = self.get_unused_port()
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} 127.0.0.1:{2} check_interval=0.1'.format(
+                self.forwarder_port, down_port, second_echo_server.port)))
+        pool = self.forwarder_server.get_pool(('127.0.0.1', self.forwarder_port))
+
+        for _ in range(2):
+            stream = yield self.client.connect('localhost', self.forwarder_port)
+            with closing(stream):
+                stream.write(b'Hello')
+                data = yield stream.read_bytes(5)
+                self.assertEqual(data, b'Hello')
+        self.assertTrue(pool.backends[0].down)
+
+        # Backend is back, health check returns it to pool
+        server = TestEchoServer()
+        server.listen(down_port)
+        self.additional_servers.append(server)
+        yield gen.sleep(0.3)
+        self.assertFalse(pool.backends[0].down)
+
+    @gen_test
+    def test_warm_connections(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} warm=2'.format(self.forwarder_port, self.echo_server.port)))
+        yield gen.sleep(0.1)
+        self.assertEqual(len(self.echo_server.streams), 2)
+
+        stream = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream):
+            stream.write(b'Hello')
+            data = yield stream.read_bytes(5)
+            self.assertEqual(data, b'Hello')
+        yield gen.sleep(0.1)
+        # Used connection is replaced with a new one
+        self.assertEqual(len(self.echo_server.streams), 3)
+        # Warm connection wasn't connected by the client, its connect isn't measured
+        stats = self.forwarder_server.metrics.get(('127.0.0.1', self.forwarder_port))
+        self.assertEqual(stats.accepted, 1)
+        self.assertEqual(stats.connect_duration.count, 0)
+
+    @gen_test
+    def test_socket_options(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} keepalive=on read_chunk_size=1k'.format(
+                self.forwarder_port, self.echo_server.port)))
+        address = ('127.0.0.1', self.forwarder_port)
+        listener = self.forwarder_server._sockets[self.forwarder_server._fds[address]]
+        self.assertTrue(listener.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        self.assertEqual(self.forwarder_server.get_read_chunk_size(address), 1024)
+
+        stream = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream):
+            stream.write(b'x' * 4096)
+            data = yield stream.read_bytes(4096)
+            self.assertEqual(data, b'x' * 4096)
+
+    @gen_test
+    def test_max_conns(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} max_conns=1'.format(self.forwarder_port, self.echo_server.port)))
+        yield self.check_connections_limit('max_conns')
+
+    @gen_test
+    def test_max_connections(self):
+        self.forwarder_server.max_connections = 1
+        yield self.check_connections_limit('global')
+
+    @gen.coroutine
+    def check_connections_limit(self, limit):
+        address = ('127.0.0.1', self.forwarder_port)
+        stream1 = yield self.client.connect('localhost', self.forwarder_port)
+        stream1.write(b'One')
+        yield stream1.read_bytes(3)
+        # Second connection waits in listen queue
+        stream2 = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream1), closing(stream2):
+            stream2.write(b'Two')
+            yield gen.sleep(0.05)
+            self.assertEqual(len(self.forwarder_server._connections), 1)
+            self.assertEqual(self.forwarder_server._paused, {address: limit})
+            stream1.close()
+            data = yield stream2.read_bytes(3)
+            self.assertEqual(data, b'Two')
+            self.assertEqual(self.forwarder_server._paused, {})
+        self.assertEqual(self.forwarder_server.metrics.get(address).throttled, {limit: 1})
+
+    @gen_test
+    def test_accept_rate(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} rate=2'.format(self.forwarder_port, self.echo_server.port)))
+        streams = []
+        try:
+            for _ in range(3):
+                stream = yield self.client.connect('localhost', self.forwarder_port)
+                streams.append(stream)
+            yield gen.sleep(0.1)
+            self.assertEqual(len(self.forwarder_server._connections), 2)
+            self.assertEqual(self.forwarder_server._paused, {('127.0.0.1', self.forwarder_port): 'rate'})
+            yield gen.sleep(0.5)
+            self.assertEqual(len(self.forwarder_server._connections), 3)
+            self.assertEqual(self.forwarder_server._paused, {})
+        finally:
+            for stream in streams:
+                stream.close()
+
+    @gen_test
+    def test_idle_timeout(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} idle_timeout=0.3'.format(self.forwarder_port, self.echo_server.port)))
+        stream = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream):
+            for _ in range(3):
+                stream.write(b'Hello')
+                yield stream.read_bytes(5)
+                yield gen.sleep(0.2)
+            data = yield stream.read_until_close()
+            self.assertEqual(data, b'')
+        address = ('127.0.0.1', self.forwarder_port)
+        self.assertEqual(self.forwarder_server.metrics.get(address).timeouts, {'idle_timeout': 1})
+
+    @gen_test
+    def test_idle_timeout_removed(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} idle_timeout=0.3'.format(self.forwarder_port, self.echo_server.port)))
+        stream = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream):
+            stream.write(b'Hello')
+            yield stream.read_bytes(5)
+            # Drained connection of removed forwarding keeps its timeouts
+            self.forwarder_server.bind_conf({})
+            data = yield stream.read_until_close()
+            self.assertEqual(data, b'')
+
+    @gen_test
+    def test_connect_timeout(self):
+        # Listen queue of backend is full, so connects to it hang.
+        backend = socket.socket()
+        backend.bind(('127.0.0.1', 0))
+        backend.listen(0)
+        queued = socket.socket()
+        with closing(backend), closing(queued):
+            queued.connect(backend.getsockname())
+            self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                data='127.0.0.1:{0} => 127.0.0.1:{1} connect_timeout=0.2 idle_timeout=10'.format(
+                    self.forwarder_port, backend.getsockname()[1])))
+            stream = yield self.client.connect('localhost', self.forwarder_port)
+            with closing(stream):
+                data = yield stream.read_until_close()
+                self.assertEqual(data, b'')
+        address = ('127.0.0.1', self.forwarder_port)
+        self.assertEqual(self.forwarder_server.metrics.get(address).timeouts, {'connect_timeout': 1})
+        self.assertEqual(len(self.forwarder_server._connections), 0)
+        self.assertEqual(self.forwarder_server._timeouts, {})
+
+    @gen_test
+    def test_port_range(self):
+        first = self.get_unused_ports(2)
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0}-{1} => 127.0.0.1:{2}'.format(first, first + 1, self.echo_server.port)))
+        stream = yield self.client.connect('127.0.0.1', first + 1)
+        with closing(stream):
+            stream.write(b'Hello')
+            data = yield stream.read_bytes(5)
+            self.assertEqual(data, b'Hello')
+
+    @gen_test
+    def test_drain_connections(self):
+        new_server = self.start_echo_server()
+        self.additional_servers.append(new_server)
+        stream1 = yield self.client.connect('127.0.0.1', self.forwarder_port)
+        with closing(stream1):
+            stream1.write(b'One')
+            yield stream1.read_bytes(3)
+            # Forwarding target is changed, existing connection is drained
+            self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                data='127.0.0.1:{0} => 127.0.0.1:{1} drain_timeout=0.3'.format(self.forwarder_port, new_server.port)))
+            stream2 = yield self.client.connect('127.0.0.1', self.forwarder_port)
+            with closing(stream2):
+                for stream in (stream1, stream2):
+                    stream.write(b'Two')
+                    data = yield stream.read_bytes(3)
+                    self.assertEqual(data, b'Two')
+                self.assertEqual(self.echo_server.recived_data, b'OneTwo')
+                self.assertEqual(new_server.recived_data, b'Two')
+
+                # Removed forwarding doesn't accept, but its connections are drained
+                self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                    data='127.0.0.1:{0} => 127.0.0.1:{1} drain_timeout=5'.format(self.forwarder_port, new_server.port)))
+                self.forwarder_server.bind_conf({})
+                with self.assertRaises(StreamClosedError):
+                    yield self.client.connect('127.0.0.1', self.forwarder_port)
+                stream2.write(b'Three')
+                data = yield stream2.read_bytes(5)
+                self.assertEqual(data, b'Three')
+
+                # Deadline of the first drain is kept
+                with self.assertRaises(StreamClosedError):
+                    yield stream1.read_bytes(1)
+                self.assertFalse(stream2.closed())
+            yield gen.sleep(0.05)
+        self.assertEqual(len(self.forwarder_server._connections), 0)
+        self.assertEqual(self.forwarder_server._draining, {})
+        self.assertIsNone(self.forwarder_server.metrics._stats.get(('127.0.0.1', self.forwarder_port)))
+
+    @gen_test
+    def test_backend_name(self):
+        # The first address of the name refuses connections, the next one is tried
+        self.forwarder_server.resolver = CachedResolver()
+        self.addCleanup(self.forwarder_server.resolver.stop)
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => backend.test:{1}'.format(self.forwarder_port, self.echo_server.port)))
+        with mock.patch('forwarder.resolver.getaddrinfo', return_value=['127.0.0.2', '127.0.0.1']) as getaddrinfo:
+            for i in range(2):
+                stream = yield self.client.connect('127.0.0.1', self.forwarder_port)
+                with closing(stream):
+                    stream.write(b'Hello')
+                    data = yield stream.read_bytes(5)
+                    self.assertEqual(data, b'Hello')
+            getaddrinfo.assert_called_once_with('backend.test')
+
+    def get_transferred_up(self):
+        connections = self.forwarder_server._connections.get(('127.0.0.1', self.forwarder_port))
+        return [connection.pumps[1].transferred for connection in connections if connection.pumps]
+
+    @gen_test
+    def test_connection_bandwidth(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} conn_bandwidth_up=100k read_chunk_size=16k'.format(
+                self.forwarder_port, self.echo_server.port)))
+        stream = yield self.client.connect('127.0.0.1', self.forwarder_port)
+        with closing(stream):
+            started = IOLoop.current().time()
+            stream.write(b'x' * 300 * 1024)
+            yield gen.sleep(1)
+            transferred = self.get_transferred_up()[0]
+            # Burst of one second and a second of the rate, up to a chunk more
+            self.assertGreater(transferred, 150 * 1024)
+            self.assertLessEqual(transferred, 100 * 1024 * (1 + IOLoop.current().time() - started) + 16 * 1024)
+            # Removed limit applies to relayed connection
+            self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                data='127.0.0.1:{0} => 127.0.0.1:{1} read_chunk_size=16k'.format(
+                    self.forwarder_port, self.echo_server.port)))
+            data = yield stream.read_bytes(300 * 1024)
+            self.assertEqual(len(data), 300 * 1024)
+
+    @gen_test
+    def test_forwarding_bandwidth_fairness(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} bandwidth_up=300k read_chunk_size=16k'.format(
+                self.forwarder_port, self.echo_server.port)))
+        streams = []
+        for i in range(3):
+            stream = yield self.client.connect('127.0.0.1', self.forwarder_port)
+            streams.append(stream)
+            self.addCleanup(stream.close)
+        started = IOLoop.current().time()
+        for stream in streams:
+            stream.write(b'x' * 1024 * 1024)
+        yield gen.sleep(1)
+        transferred = self.get_transferred_up()
+        self.assertEqual(len(transferred), 3)
+        # Connections share the limit evenly
+        self.assertLessEqual(sum(transferred),
+                             300 * 1024 * (1 + IOLoop.current().time() - started) + 3 * 16 * 1024)
+        self.assertGreaterEqual(min(transferred), max(transferred) / 2)
+
+    def tls_exchange(self, context, session=None):
+        """
+        Sends data over TLS connection to forwarder in blocking mode.
+        Returns echoed data, session and whether it was resumed.
+        """
+        with closing(socket.create_connection(('127.0.0.1', self.forwarder_port), timeout=5)) as sock:
+            with closing(context.wrap_socket(sock, session=session)) as tls_sock:
+                tls_sock.sendall(b'Hello')
+                data = tls_sock.recv(5)
+                return data, tls_sock.session, tls_sock.session_reused
+
+    @gen.coroutine
+    def check_tls(self):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} tls_cert={2} tls_key={3} tls_ciphers={4}'.format(
+                self.forwarder_port, self.echo_server.port, TEST_CERT, TEST_KEY, TEST_CIPHERS)))
+        context = make_test_ssl_context(ssl.Purpose.SERVER_AUTH)
+        data, session, reused = yield IOLoop.current().run_in_executor(None, self.tls_exchange, context)
+        self.assertEqual(data, b'Hello')
+        self.assertFalse(reused)
+        # Returning client resumes its session, also after configuration reload
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} tls_cert={2} tls_key={3} tls_ciphers={4} nodelay=on'.format(
+                self.forwarder_port, self.echo_server.port, TEST_CERT, TEST_KEY, TEST_CIPHERS)))
+        data, _, reused = yield IOLoop.current().run_in_executor(None, self.tls_exchange, context, session)
+        self.assertEqual(data, b'Hello')
+        self.assertTrue(reused)
+        # Client which doesn't speak TLS fails handshake
+        stream = yield self.client.connect('127.0.0.1', self.forwarder_port)
+        with closing(stream):
+            stream.write(b'Hello\r\n\r\n' * 100)
+            with self.assertRaises(StreamClosedError):
+                yield stream.read_bytes(5)
+        listener = '127.0.0.1:{0}'.format(self.forwarder_port)
+        body = self.forwarder_server.metrics.render()
+        self.assertIn('forwarder_tls_handshakes_total{{listener="{0}",session="new"}} 1\n'.format(listener), body)
+        self.assertIn('forwarder_tls_handshakes_total{{listener="{0}",session="resumed"}} 1\n'.format(listener), body)
+        self.assertIn('forwarder_tls_handshake_failures_total{{listener="{0}"}} 1\n'.format(listener), body)
+
+    @unittest.skipUnless(TLS_AVAILABLE, 'TLS is not supported')
+    @gen_test
+    def test_tls(self):
+        yield self.check_tls()
+
+    @unittest.skipUnless(TLS_AVAILABLE, 'TLS is not supported')
+    @gen_test
+    def test_tls_threads(self):
+        self.forwarder_server._handshaker = Handshaker(2, io_loop=self.io_loop)
+        yield self.check_tls()
+
+    @unittest.skipUnless(TLS_AVAILABLE, 'TLS is not supported')
+    @gen_test
+    def test_tls_pending(self):
+        address = ('127.0.0.1', self.forwarder_port)
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} tls_cert={2} tls_key={3} tls_ciphers={4} max_conns=1'.format(
+                self.forwarder_port, self.echo_server.port, TEST_CERT, TEST_KEY, TEST_CIPHERS)))
+        # Client which doesn't start handshake holds the only connection
+        stream = yield self.client.connect('127.0.0.1', self.forwarder_port)
+        with closing(stream):
+            while not self.forwarder_server._handshaker.count(address):
+                yield gen.sleep(0.01)
+            self.assertEqual(self.forwarder_server.check_admission(address), 'max_conns')
+            # Handshake is cancelled with removed forwarding
+            self.forwarder_server.bind_conf({})
+            self.assertEqual(self.forwarder_server._handshaker.count(), 0)
+            with self.assertRaises(StreamClosedError):
+                yield stream.read_bytes(1)
+
+    @unittest.skipUnless(TLS_AVAILABLE, 'TLS is not supported')
+    @gen_test
+    def test_tls_upstream(self):
+        server = TestEchoServer(ssl_options=make_test_ssl_context(ssl.Purpose.CLIENT_AUTH))
+        server.listen(self.get_unused_port())
+        self.additional_servers.append(server)
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} tls_upstream=on tls_upstream_verify=off'.format(
+                self.forwarder_port, server.port)))
+        stream = yield self.client.connect('127.0.0.1', self.forwarder_port)
+        with closing(stream):
+            stream.write(b'Hello')
+            data = yield stream.read_bytes(5)
+            self.assertEqual(data, b'Hello')
+        self.assertEqual(server.recived_data, b'Hello')
+
+    @gen_test
+    def test_wildcard_listeners(self):
+        port = self.get_unused_port()
+        self.forwarder_server.wildcard = True
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(data=dedent('''
+            127.0.0.1:{0} => 127.0.0.1:{1}
+            127.0.0.2:{0} => 127.0.0.1:{1} max_conns=1
+        '''.format(port, self.echo_server.port))))
+        self.assertEqual(list(self.forwarder_server._fds), [('0.0.0.0', port)])
+        stream1 = yield self.client.connect('127.0.0.1', port)
+        stream2 = yield self.client.connect('127.0.0.2', port)
+        # Connections to addresses without forwarding and over limit are closed
+        stream3 = yield self.client.connect('127.0.0.3', port)
+        stream4 = yield self.client.connect('127.0.0.2', port)
+        with closing(stream1), closing(stream2), closing(stream3), closing(stream4):
+            for stream in (stream1, stream2):
+                stream.write(b'Hello')
+                data = yield stream.read_bytes(5)
+                self.assertEqual(data, b'Hello')
+            for stream in (stream3, stream4):
+                with self.assertRaises(StreamClosedError):
+                    yield stream.read_bytes(1)
+            self.assertEqual(self.forwarder_server._connections.count(('127.0.0.2', port)), 1)
+            self.assertEqual(self.forwarder_server.metrics.get(('127.0.0.2', port)).throttled, {'max_conns': 1})
+
+            # Wildcard socket is kept while it serves a forwarding
+            self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+                data='127.0.0.2:{0} => 127.0.0.1:{1}'.format(port, self.echo_server.port)))
+            self.assertEqual(list(self.forwarder_server._fds), [('0.0.0.0', port)])
+            stream5 = yield self.client.connect('127.0.0.1', port)
+            with closing(stream5), self.assertRaises(StreamClosedError):
+                yield stream5.read_bytes(1)
+            # Connections of the removed forwarding are drained
+            for stream in (stream1, stream2):
+                stream.write(b'Hi')
+                data = yield stream.read_bytes(2)
+                self.assertEqual(data, b'Hi')
+        self.forwarder_server.bind_conf({})
+        self.assertEqual(self.forwarder_server._fds, {})
+        self.assertEqual(self.forwarder_server._shared, {})
+
+    @gen_test
+    def test_access_log(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.forwarder_server.access_log = access_log = AccessLog(path=path)
+        try:
+            stream = yield self.client.connect('localhost', self.forwarder_port)
+            with closing(stream):
+                stream.write(b'Hello')
+                yield stream.read_bytes(5)
+            yield gen.sleep(0.05)
+            access_log.stop()
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['listener'], '127.0.0.1:{0}'.format(self.forwarder_port))
+        self.assertEqual(records[0]['backend'], '127.0.0.1:{0}'.format(self.echo_server.port))
+        self.assertEqual((records[0]['bytes_upstream'], records[0]['bytes_downstream']), (5, 5))
+
+    @gen_test
+    def test_metrics(self):
+        sock, metrics_port = bind_unused_port()
+        sock.close()
+        metrics_server = start_metrics_server(self.forwarder_server.metrics, port=metrics_port)
+        stream = yield self.client.connect('localhost', self.forwarder_port)
+        with closing(stream):
+            stream.write(b'Hello')
+            yield stream.read_bytes(5)
+            listener = '127.0.0.1:{0}'.format(self.forwarder_port)
+            try:
+                response = yield AsyncHTTPClient().fetch('http://127.0.0.1:{0}/metrics'.format(metrics_port))
+            finally:
+                metrics_server.stop()
+            body = response.body.decode()
+            self.assertIn('forwarder_connections_active{{listener="{0}"}} 1\n'.format(listener), body)
+            self.assertIn('forwarder_connections_total{{listener="{0}"}} 1\n'.format(listener), body)
+            self.assertIn('forwarder_bytes_total{{listener="{0}",direction="upstream"}} 5\n'.format(listener), body)
+            self.assertIn('forwarder_connect_duration_seconds_count{{listener="{0}"}} 1\n'.format(listener), body)
+        yield gen.sleep(0.05)
+        body = self.forwarder_server.metrics.render()
+        self.assertIn('forwarder_connections_active{{listener="{0}"}} 0\n'.format(listener), body)
+        self.assertIn('forwarder_bytes_total{{listener="{0}",direction="downstream"}} 5\n'.format(listener), body)
+
     def test_periodic_config_reload_calback(self):
-        with mock.patch.object(self.forwarder_server._config_reload_callback, 'callback') as callback:
+        config_file = make_config_file('')
+        self.addCleanup(os.remove, config_file)
+        server = ForwardServer()
+        with mock.patch('forwarder.inotify_available', return_value=False):
+            server.bind_from_config_file(config_file)
+        self.addCleanup(server.stop)
+        self.assertIsNone(server._config_watcher)
+        with mock.patch.object(server._config_reload_callback, 'callback') as callback:
             self.io_loop.call_later(1, self.stop)
             self.wait()
             self.assertTrue(callback.called)
+
+    @unittest.skipUnless(inotify_available(), 'inotify is not available')
+    @gen_test
+    def test_inotify_config_reload(self):
+        self.assertIsNotNone(self.forwarder_server._config_watcher)
+        self.assertIsNone(self.forwarder_server._config_reload_callback)
+        self.additional_servers.append(self.start_echo_server())
+        second_echo_server = self.additional_servers[0]
+        second_forwarder_port = self.get_unused_port()
+        self.config[('127.0.0.1', second_forwarder_port)] = ('127.0.0.1', second_echo_server.port)
+        make_config_file(self.config, self.config_file)
+        yield gen.sleep(0.3)
+        self.assertEqual(self.forwarder_server.conf, self.config)
+
+
+class WarmPoolTest(AsyncTestCase):
+    def setUp(self):
+        super(WarmPoolTest, self).setUp()
+        self.echo_server = TestEchoServer()
+        sock, port = bind_unused_port()
+        self.echo_server.add_socket(sock)
+        self.pool = BackendPool([('127.0.0.1', port)])
+        self.warm_pool = WarmPool(self.pool, 2, max_idle=0.3)
+
+    def tearDown(self):
+        self.warm_pool.stop()
+        self.echo_server.stop()
+        super(WarmPoolTest, self).tearDown()
+
+    @gen_test
+    def test_take(self):
+        self.assertIsNone(self.warm_pool.take())
+        yield gen.sleep(0.05)
+        self.assertEqual(len(self.warm_pool), 2)
+        sock, backend = self.warm_pool.take()
+        self.addCleanup(sock.close)
+        self.assertEqual(backend, self.pool.backends[0].address)
+        self.assertEqual(sock.getpeername(), backend)
+        yield gen.sleep(0.05)
+        self.assertEqual(len(self.warm_pool), 2)
+
+    @gen_test
+    def test_backend_closes_connection(self):
+        yield gen.sleep(0.05)
+        sockets = [item[0] for item in self.warm_pool._idle]
+        for stream in self.echo_server.streams:
+            stream.close()
+        yield gen.sleep(0.05)
+        self.assertEqual(len(self.warm_pool), 2)
+        for sock in sockets:
+            self.assertEqual(sock.fileno(), -1)
+
+    @gen_test
+    def test_backend_closes_after_greeting(self):
+        yield gen.sleep(0.05)
+        sockets = [item[0] for item in self.warm_pool._idle]
+        for stream in self.echo_server.streams:
+            stream.write(b'Hello')
+        yield gen.sleep(0.05)
+        for stream in self.echo_server.streams:
+            stream.close()
+        yield gen.sleep(0.05)
+        # Dead connections are dropped instead of being handed out
+        self.assertIsNone(self.warm_pool.take())
+        for sock in sockets:
+            self.assertEqual(sock.fileno(), -1)
+        yield gen.sleep(0.05)
+        sock, backend = self.warm_pool.take()
+        self.addCleanup(sock.close)
+        self.assertNotIn(sock, sockets)
+
+    @gen_test
+    def test_max_idle(self):
+        yield gen.sleep(0.05)
+        sockets = [item[0] for item in self.warm_pool._idle]
+        yield gen.sleep(0.5)
+        self.assertEqual(len(self.warm_pool), 2)
+        for sock in sockets:
+            self.assertEqual(sock.fileno(), -1)
+
+
+@unittest.skipUnless(HANDOFF_AVAILABLE, 'sendmsg(2) is not available')
+class HandoffTest(AsyncTestCase):
+    def get_unused_port(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        return port
+
+    def take_over(self, path):
+        connection = connect(path)
+        return connection, receive_listeners(connection)
+
+    @gen_test
+    def test_handoff(self):
+        echo_server = TestEchoServer()
+        echo_server.listen(self.get_unused_port())
+        port = self.get_unused_port()
+        conf = ForwardServer().parse_config(data='127.0.0.1:{0} => 127.0.0.1:{1}'.format(port, echo_server.port))
+        old_server = ForwardServer()
+        old_server.bind_conf(conf)
+        new_server = ForwardServer()
+        path = tempfile.mktemp()
+        drained = []
+        handoff_server = HandoffServer(old_server, path, lambda: old_server.drain(lambda: drained.append(True)))
+        handoff_server.start()
+        client = TCPClient()
+        old_stream = new_stream = None
+        try:
+            old_stream = yield client.connect('127.0.0.1', port)
+            old_stream.write(b'old')
+            yield old_stream.read_bytes(3)
+
+            connection, sockets = yield IOLoop.current().run_in_executor(None, self.take_over, path)
+            self.assertEqual(list(sockets), [('127.0.0.1', port)])
+            new_server.inherit_sockets(sockets)
+            new_server.bind_conf(conf)
+            new_server.close_inherited_sockets()
+            yield IOLoop.current().run_in_executor(None, confirm, connection)
+            self.assertEqual(old_server.get_listeners(), {})
+            self.assertEqual(drained, [])
+
+            new_stream = yield client.connect('127.0.0.1', port)
+            new_stream.write(b'new')
+            data = yield new_stream.read_bytes(3)
+            self.assertEqual(data, b'new')
+            self.assertEqual(len(new_server._connections), 1)
+            # Connections accepted by the old process are still relayed
+            old_stream.write(b'old')
+            data = yield old_stream.read_bytes(3)
+            self.assertEqual(data, b'old')
+            old_stream.close()
+            yield gen.sleep(0.05)
+            self.assertEqual(drained, [True])
+        finally:
+            for stream in (old_stream, new_stream):
+                if stream:
+                    stream.close()
+            handoff_server.stop()
+            for server in (old_server, new_server, echo_server):
+                server.stop()
+            os.remove(path)
+
+
+class UDPEchoServer(object):
+    def __init__(self):
+        self.socket = bind_udp_socket(0, '127.0.0.1')
+        self.port = self.socket.getsockname()[1]
+        self.clients = set()
+        IOLoop.current().add_handler(self.socket.fileno(), self.handle_datagram, IOLoop.READ)
+
+    def handle_datagram(self, fd, events):
+        data, address = self.socket.recvfrom(65535)
+        self.clients.add(address)
+        self.socket.sendto(data, address)
+
+    def stop(self):
+        IOLoop.current().remove_handler(self.socket.fileno())
+        self.socket.close()
+
+
+class UDPForwardingTest(AsyncTestCase):
+    def setUp(self):
+        super(UDPForwardingTest, self).setUp()
+        self.echo_server = UDPEchoServer()
+        sock = bind_udp_socket(0, '127.0.0.1')
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.forwarder_server = ForwardServer()
+        self.clients = []
+
+    def tearDown(self):
+        for sock in self.clients:
+            sock.close()
+        self.forwarder_server.stop()
+        self.echo_server.stop()
+        super(UDPForwardingTest, self).tearDown()
+
+    def bind(self, options=''):
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1} proto=udp {2}'.format(self.port, self.echo_server.port, options)))
+
+    def make_client(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(('127.0.0.1', self.port))
+        self.clients.append(sock)
+        return sock
+
+    @gen.coroutine
+    def exchange(self, sock, data):
+        sock.send(data)
+        for _ in range(100):
+            try:
+                raise gen.Return(sock.recv(65535))
+            except socket.error:
+                yield gen.sleep(0.01)
+        self.fail('No reply')
+
+    @gen_test
+    def test_relay(self):
+        self.bind()
+        client1, client2 = self.make_client(), self.make_client()
+        for i in range(3):
+            for client in (client1, client2):
+                data = yield self.exchange(client, b'ping' * (i + 1))
+                self.assertEqual(data, b'ping' * (i + 1))
+        address = ('127.0.0.1', self.port)
+        self.assertEqual(len(self.forwarder_server._udp[address].sessions), 2)
+        self.assertEqual(len(self.echo_server.clients), 2)
+        self.assertEqual(self.forwarder_server.count_connections(address), 2)
+        self.assertEqual(self.forwarder_server.metrics.get(address).accepted, 2)
+
+        self.bind('idle_timeout=0.1')
+        yield gen.sleep(0.3)
+        self.assertEqual(self.forwarder_server.count_connections(address), 0)
+        stats = self.forwarder_server.metrics.get(address)
+        self.assertEqual((stats.bytes_upstream, stats.bytes_downstream), (48, 48))
+
+    @gen_test
+    def test_max_sessions(self):
+        self.bind('max_sessions=1')
+        client1, client2 = self.make_client(), self.make_client()
+        yield self.exchange(client1, b'1')
+        yield self.exchange(client2, b'2')
+        sessions = self.forwarder_server._udp['127.0.0.1', self.port].sessions
+        self.assertEqual(list(sessions), [client2.getsockname()])
+        yield self.exchange(client1, b'1')
+        self.assertEqual(list(sessions), [client1.getsockname()])
+
+    @gen_test
+    def test_rebind(self):
+        self.bind()
+        client = self.make_client()
+        yield self.exchange(client, b'x')
+        # Forwarding is bound again when protocol is changed
+        self.forwarder_server.bind_conf(self.forwarder_server.parse_config(
+            data='127.0.0.1:{0} => 127.0.0.1:{1}'.format(self.port, self.echo_server.port)))
+        self.assertEqual(self.forwarder_server._udp, {})
+        self.assertIn(('127.0.0.1', self.port), self.forwarder_server._fds)
+        self.bind()
+        self.assertNotIn(('127.0.0.1', self.port), self.forwarder_server._fds)
+        data = yield self.exchange(client, b'y')
+        self.assertEqual(data, b'y')
+
+
+    def test_receive_error(self):
+        self.bind()
+        udp = self.forwarder_server._udp['127.0.0.1', self.port]
+        with mock.patch.object(udp, 'socket') as sock:
+            # Persistent error isn't retried in the same event
+            sock.recvfrom_into.side_effect = socket.error(errno.EBADF, 'Bad file descriptor')
+            udp._handle_datagrams(sock.fileno(), IOLoop.READ)
+            self.assertEqual(sock.recvfrom_into.call_count, 1)
+            # ICMP error of a sent datagram doesn't stop receiving the next ones
+            sock.recvfrom_into.reset_mock()
+            sock.recvfrom_into.side_effect = [socket.error(errno.ECONNREFUSED, 'Connection refused'),
+                                              socket.error(errno.EAGAIN, 'Resource temporarily unavailable')]
+            udp._handle_datagrams(sock.fileno(), IOLoop.READ)
+            self.assertEqual(sock.recvfrom_into.call_count, 2)
+
+
+class ForwarderBackpressureTest(AsyncTestCase):
+    """
+    A fast backend sends a lot of data to a client that does not read it.
+    Forwarder must stop reading from backend instead of buffering everything.
+    """
+    engine = 'tornado'
+    high_water_mark = 256 * 1024
+    low_water_mark = 64 * 1024
+
+    def setUp(self):
+        super(ForwarderBackpressureTest, self).setUp()
+        self.source_server = TestSourceServer(b'x' * 16 * 1024 * 1024)
+        sock, source_port = bind_unused_port()
+        self.source_server.add_socket(sock)
+
+        sock, self.forwarder_port = bind_unused_port()
+        sock.close()
+        self.forwarder_server = ForwardServer(engine=self.engine,
+                                              high_water_mark=self.high_water_mark,
+                                              low_water_mark=self.low_water_mark)
+        self.forwarder_server.bind_conf({
+            ('127.0.0.1', self.forwarder_port): ('127.0.0.1', source_port)
+        })
+
+    def tearDown(self):
+        self.forwarder_server.stop()
+        self.source_server.stop()
+        super(ForwarderBackpressureTest, self).tearDown()
+
+    @gen_test(timeout=30)
+    def test_slow_reader(self):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(('127.0.0.1', self.forwarder_port))
+        yield gen.sleep(1)
+
+        connection, = self.forwarder_server._connections
+        pump = connection.pumps[0]
+        self.assertTrue(pump.paused)
+        self.assertLessEqual(pump.pending, self.high_water_mark + self.forwarder_server.read_chunk_size)
+        self.assertLess(pump.transferred, len(self.source_server.data))
+
+        stream = IOStream(sock)
+        with closing(stream):
+            data = yield stream.read_until_close()
+        self.assertEqual(len(data), len(self.source_server.data))
+        self.assertEqual(pump.transferred, len(self.source_server.data))
+
+
+@unittest.skipUnless(SPLICE_AVAILABLE, 'splice(2) is not available')
+class SpliceForwarderIntegrationTest(ForwarderIntegrationTest):
+    engine = 'splice'
+
+
+@unittest.skipUnless(SPLICE_AVAILABLE, 'splice(2) is not available')
+class SpliceForwarderBackpressureTest(ForwarderBackpressureTest):
+    engine = 'splice'
+
+
+@unittest.skipUnless(ASYNCIO_AVAILABLE, 'asyncio engine is not available')
+class AsyncioForwarderIntegrationTest(ForwarderIntegrationTest):
+    engine = 'asyncio'
+
+
+@unittest.skipUnless(ASYNCIO_AVAILABLE, 'asyncio engine is not available')
+class AsyncioForwarderBackpressureTest(ForwarderBackpressureTest):
+    engine = 'asyncio'